@@ -6,13 +6,23 @@ from fastapi import HTTPException, status, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from config import settings
 from database import db
-from models import TokenData, UserResponse, UserUpdate
+from models import TokenData, UserResponse, UserUpdate, UserRole
+from cachetools import TTLCache
+import hashlib
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing: Argon2id with the OWASP minimum parameters.
+# Existing bcrypt hashes still verify and are upgraded on the next login.
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__type="ID",
+    argon2__time_cost=2,
+    argon2__memory_cost=19456,
+    argon2__parallelism=1
+)
 
 # HTTP Bearer token
 security = HTTPBearer()
@@ -22,14 +32,69 @@ failed_login_attempts: Dict[str, Dict[str, Any]] = {}
 MAX_LOGIN_ATTEMPTS = 5
 LOCKOUT_DURATION = timedelta(minutes=15)
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verify a password against its hash"""
+# Resolved users keyed by token hash, so parallel requests from one page share a lookup.
+# Entries are dropped whenever the user's row changes.
+USER_CACHE_TTL_SECONDS = 30
+_user_cache: TTLCache = TTLCache(maxsize=10_000, ttl=USER_CACHE_TTL_SECONDS)
+
+# User rows keyed by email for login, so retries against one account skip the lookup
+_user_record_cache: TTLCache = TTLCache(maxsize=10_000, ttl=USER_CACHE_TTL_SECONDS)
+
+# Keys each user holds in the two caches above, mapped to the cache holding them, so invalidation
+# only touches that user's entries. Re-set on every add so an index entry outlives the keys it lists.
+_user_cache_keys: TTLCache = TTLCache(maxsize=20_000, ttl=USER_CACHE_TTL_SECONDS)
+
+def _token_cache_key(token: str) -> str:
+    """Cache key for a bearer token; the raw token is never kept in memory"""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def _index_cached_key(user_id: str, cache: TTLCache, key: str):
+    """Record that a cache holds an entry for a user"""
+    keys = _user_cache_keys.get(user_id, {})
+    keys[key] = cache
+    _user_cache_keys[user_id] = keys
+
+def invalidate_cached_user(user_id: str):
+    """Drop every cached session for a user after their record changes"""
+    for key, cache in _user_cache_keys.pop(user_id, {}).items():
+        cache.pop(key, None)
+
+def get_cached_user_record(email: str) -> Optional[Dict[str, Any]]:
+    """Return the cached user row for an email, if still fresh"""
+    return _user_record_cache.get(email)
+
+def cache_user_record(record: Dict[str, Any]):
+    """Remember a user row fetched from the database by its email"""
+    _user_record_cache[record["email"]] = record
+    _index_cached_key(record["id"], _user_record_cache, record["email"])
+
+def invalidate_cached_token(token: str):
+    """Drop the cached session for a single token"""
+    _user_cache.pop(_token_cache_key(token), None)
+
+def verify_password(plain_password: str, hashed_password: Optional[str]) -> bool:
+    """Verify a password against its hash
+
+    Pass None for an unknown user: a dummy hash is still checked so the
+    response time does not reveal whether the account exists.
+    """
     try:
+        if hashed_password is None:
+            pwd_context.dummy_verify()
+            return False
         return pwd_context.verify(plain_password, hashed_password)
     except Exception as e:
         logger.error(f"Password verification error: {e}")
         return False
 
+def password_needs_rehash(hashed_password: str) -> bool:
+    """Check whether a stored hash uses a deprecated scheme or outdated parameters"""
+    try:
+        return pwd_context.needs_update(hashed_password)
+    except Exception as e:
+        logger.error(f"Password hash inspection error: {e}")
+        return False
+
 def get_password_hash(password: str) -> str:
     """Hash a password"""
     try:
@@ -150,17 +215,17 @@ async def get_user_by_email(email: str) -> Optional[dict]:
 
 async def update_user_profile(user_id: str, updates: UserUpdate) -> Optional[UserResponse]:
     """Update user profile information"""
+    invalidate_cached_user(user_id)
     try:
         if settings.use_in_memory_db:
             memory_store = db.get_memory_store()
-            # Find user by ID in memory store
-            for email, user_data in memory_store["users"].items():
-                if user_data["id"] == user_id:
-                    if updates.name is not None:
-                        user_data["name"] = updates.name
-                    user_data["updated_at"] = datetime.utcnow().isoformat()
-                    return UserResponse(**user_data)
-            return None
+            user_data = memory_store["users_by_id"].get(user_id)
+            if not user_data:
+                return None
+            if updates.name is not None:
+                user_data["name"] = updates.name
+            user_data["updated_at"] = datetime.utcnow().isoformat()
+            return UserResponse(**user_data)
         
         supabase = db.get_client()
         if supabase:
@@ -194,11 +259,17 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         headers={"WWW-Authenticate": "Bearer"},
     )
     
+    # Always verify, so an expired token is refused even while its user is cached
+    token_data = verify_token(credentials.credentials)
+    if token_data is None or token_data.email is None:
+        raise credentials_exception
+    
+    cache_key = _token_cache_key(credentials.credentials)
+    cached_user = _user_cache.get(cache_key)
+    if cached_user is not None:
+        return cached_user
+    
     try:
-        token_data = verify_token(credentials.credentials)
-        if token_data is None or token_data.email is None:
-            raise credentials_exception
-        
         user_data = await get_user_by_email(token_data.email)
         if not user_data:
             raise credentials_exception
@@ -210,15 +281,19 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
                 detail="User account is deactivated"
             )
         
-        return UserResponse(
+        user = UserResponse(
             id=user_data["id"],
             email=user_data["email"],
             name=user_data["name"],
             credits=user_data.get("credits", 0.0),
+            role=user_data.get("role") or UserRole.USER.value,
             created_at=user_data["created_at"],
             updated_at=user_data.get("updated_at"),
             last_login=user_data.get("last_login")
         )
+        _user_cache[cache_key] = user
+        _index_cached_key(user.id, _user_cache, cache_key)
+        return user
         
     except HTTPException:
         raise
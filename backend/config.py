@@ -15,6 +15,9 @@ class Settings(BaseSettings):
     
     # Database Configuration (fallback for direct PostgreSQL)
     database_url: Optional[str] = None
+    db_pool_min_size: int = 10
+    db_pool_max_size: int = 50
+    db_statement_cache_size: int = 512
     
     # JWT Configuration
     secret_key: str = Field(default_factory=lambda: secrets.token_urlsafe(32))
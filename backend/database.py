@@ -53,8 +53,9 @@ class Database:
         self.pg_pool: Optional[asyncpg.Pool] = None
         self._connection_retries = 3
         self._connection_timeout = 30
-        self._pool_min_size = 5
-        self._pool_max_size = 20
+        self._pool_min_size = settings.db_pool_min_size
+        self._pool_max_size = settings.db_pool_max_size
+        self._statement_cache_size = settings.db_statement_cache_size
         self._query_timeout = 30
         self._health_check_cache: Optional[HealthStatus] = None
         self._health_check_interval = 300  # 5 minutes
@@ -66,9 +67,13 @@ class Database:
         }
         self.in_memory_store: Dict[str, Any] = {
             "users": {},
+            # Same user records keyed by id, for lookups that only have the id
+            "users_by_id": {},
             "projects": [],
             "vms": [],
             "billing_records": [],
+            # Same billing records per user, kept in created_at order
+            "billing_by_user": {},
             "vm_metrics": [],
             "audit_logs": [],
             "system_health": []
@@ -114,26 +119,41 @@ class Database:
             self.connect()
         return self.supabase
     
+    @property
+    def pg_enabled(self) -> bool:
+        """Whether queries can go straight to PostgreSQL through the pool"""
+        return bool(settings.database_url) and not settings.use_in_memory_db
+    
+    async def init_pool(self) -> Optional[asyncpg.Pool]:
+        """Create the PostgreSQL connection pool if it does not exist yet"""
+        if not self.pg_enabled:
+            return None
+        
+        if not self.pg_pool:
+            self.pg_pool = await asyncpg.create_pool(
+                settings.database_url,
+                min_size=self._pool_min_size,
+                max_size=self._pool_max_size,
+                command_timeout=self._query_timeout,
+                statement_cache_size=self._statement_cache_size,  # Reuse prepared statements per connection
+                server_settings={
+                    'application_name': 'zentry_cloud_backend',
+                    'jit': 'off'  # Disable JIT for better performance on small queries
+                }
+            )
+        
+        return self.pg_pool
+    
     async def get_pg_connection(self):
         """Get PostgreSQL connection with retry logic"""
-        if settings.use_in_memory_db or not settings.database_url:
+        if not self.pg_enabled:
             return None
         
         for attempt in range(self._connection_retries):
             try:
-                if not self.pg_pool:
-                    self.pg_pool = await asyncpg.create_pool(
-                        settings.database_url,
-                        min_size=self._pool_min_size,
-                        max_size=self._pool_max_size,
-                        command_timeout=self._query_timeout,
-                        server_settings={
-                            'application_name': 'zentry_cloud_backend',
-                            'jit': 'off'  # Disable JIT for better performance on small queries
-                        }
-                    )
-                
-                return await self.pg_pool.acquire()
+                await self.init_pool()
+                # Bounded wait so an exhausted pool surfaces as an error instead of hanging the request
+                return await self.pg_pool.acquire(timeout=self._connection_timeout)
                 
             except Exception as e:
                 logger.warning(f"Connection attempt {attempt + 1} failed: {e}")
@@ -422,4 +442,8 @@ class Database:
             logger.info("Database connection pool closed")
 
 # Global database instance
-db = Database()
\ No newline at end of file
+db = Database()
+
+def get_supabase_client() -> Optional[Client]:
+    """FastAPI dependency returning the shared Supabase client (None when in-memory)"""
+    return db.get_client()
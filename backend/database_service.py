@@ -9,9 +9,21 @@ from datetime import datetime, timedelta
 from database import db, DatabaseError, TransactionError
 from config import settings
 import json
+import re
 
 logger = logging.getLogger(__name__)
 
+# Monthly billing partitions are named billing_records_pYYYYMM (see migration 004)
+BILLING_PARTITION_NAME = re.compile(r"^billing_records_p(\d{4})(\d{2})$")
+
+BILLING_PARTITIONS_QUERY = """
+    SELECT c.relname AS partition_name
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'billing_records'::regclass
+    ORDER BY c.relname
+"""
+
 class DatabaseService:
     """High-level database service providing common operations"""
     
@@ -72,7 +84,7 @@ class DatabaseService:
         try:
             if settings.use_in_memory_db:
                 # For in-memory database, calculate stats from stored data
-                user_data = self.db.in_memory_store["users"].get(user_id)
+                user_data = self.db.in_memory_store["users_by_id"].get(user_id)
                 if not user_data:
                     return None
                 
@@ -256,10 +268,12 @@ class DatabaseService:
                     [retention_days],
                     fetch_mode="val"
                 )
+                dropped_partitions = await self._drop_old_billing_partitions(retention_days)
                 
                 return {
                     "success": True,
                     "records_cleaned": result.rows[0]["value"] if result.rows else 0,
+                    "billing_partitions_dropped": dropped_partitions,
                     "retention_days": retention_days
                 }
                 
@@ -270,6 +284,36 @@ class DatabaseService:
                 "error": str(e)
             }
     
+    async def _drop_old_billing_partitions(self, retention_days: int) -> List[str]:
+        """Detach and drop monthly billing partitions that ended before the retention cutoff"""
+        cutoff_date = datetime.utcnow() - timedelta(days=retention_days)
+        
+        # Keep next month's partition in place so inserts never fall back to the default partition
+        await self.db.execute_query(
+            "SELECT create_billing_records_partition(CURRENT_TIMESTAMP + INTERVAL '1 month')",
+            fetch_mode="val"
+        )
+        
+        result = await self.db.execute_query(BILLING_PARTITIONS_QUERY)
+        dropped = []
+        for row in result.rows:
+            match = BILLING_PARTITION_NAME.match(row["partition_name"])
+            if not match:
+                continue
+            year, month = int(match.group(1)), int(match.group(2))
+            partition_end = datetime(year + month // 12, month % 12 + 1, 1)
+            if partition_end > cutoff_date:
+                continue
+            
+            # Names come from the catalog and match the partition pattern, so they are safe to inline
+            await self.db.execute_query(f"ALTER TABLE billing_records DETACH PARTITION {row['partition_name']}", fetch_mode="execute")
+            await self.db.execute_query(f"DROP TABLE {row['partition_name']}", fetch_mode="execute")
+            dropped.append(row["partition_name"])
+        
+        if dropped:
+            logger.info(f"Dropped billing partitions older than {retention_days} days: {', '.join(dropped)}")
+        return dropped
+    
     async def get_database_statistics(self) -> Dict[str, Any]:
         """Get comprehensive database statistics"""
         try:
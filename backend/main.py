@@ -1,7 +1,9 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from prometheus_client import make_asgi_app
+from contextlib import asynccontextmanager
 from datetime import datetime
 import logging
 import sys
@@ -13,6 +15,8 @@ from models import HealthCheck
 
 # Import routers
 from routers import auth, projects, vms, health, api_version, billing, monitoring
+from services.base_service import start_audit_log_writer, stop_audit_log_writer
+from services.billing_service import start_billing_record_writer, stop_billing_record_writer
 
 # Configure logging
 logging.basicConfig(
@@ -25,6 +29,13 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open the connection pool and background tasks for the lifetime of the app"""
+    await startup_event()
+    yield
+    await shutdown_event()
+
 # Create FastAPI application with comprehensive documentation
 app = FastAPI(
     title="Zentry Cloud API",
@@ -158,7 +169,9 @@ app = FastAPI(
             "name": "API Versioning",
             "description": "API version management, compatibility checking, and changelog information"
         }
-    ]
+    ],
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Add security scheme for JWT authentication
@@ -220,6 +233,9 @@ app.include_router(billing.router)
 app.include_router(monitoring.router)
 app.include_router(health.router)
 
+# Prometheus scrape endpoint for the latency histograms
+app.mount("/metrics", make_asgi_app())
+
 # Root endpoint with comprehensive API information
 @app.get("/", 
          tags=["System"],
@@ -407,7 +423,6 @@ for exc_type, handler in exception_handlers.items():
     app.add_exception_handler(exc_type, handler)
 
 # Startup event
-@app.on_event("startup")
 async def startup_event():
     logger.info(f"Starting Zentry Cloud API in {settings.environment} mode")
     logger.info(f"CORS origins: {settings.cors_origins_list}")
@@ -420,6 +435,22 @@ async def startup_event():
     except Exception as e:
         logger.error(f"Failed to initialize service container: {e}")
     
+    # Warm up the PostgreSQL pool so the first requests don't pay for connecting
+    try:
+        if await db.init_pool():
+            logger.info("PostgreSQL connection pool created")
+    except Exception as e:
+        logger.error(f"Failed to create PostgreSQL connection pool: {e}")
+    
+    # Keep the system health snapshot warm for /monitoring/system/health
+    monitoring.start_system_health_refresher()
+    
+    # Batch audit log inserts off the request path
+    start_audit_log_writer()
+    
+    # Coalesce concurrent billing inserts into one Supabase call
+    start_billing_record_writer()
+    
     # Test database connection
     try:
         health = await db.health_check()
@@ -438,10 +469,13 @@ async def startup_event():
         logger.error(f"Database connection failed: {e}")
 
 # Shutdown event
-@app.on_event("shutdown")
 async def shutdown_event():
     logger.info("Shutting down Zentry Cloud API")
     
+    await monitoring.stop_system_health_refresher()
+    await stop_billing_record_writer()
+    await stop_audit_log_writer()
+    
     # Close database connections
     try:
         await db.close()
@@ -9,6 +9,7 @@ from fastapi.exceptions import RequestValidationError
 from starlette.exceptions import HTTPException as StarletteHTTPException
 from services.base_service import ServiceError, ValidationError, NotFoundError, InsufficientCreditsError
 from datetime import datetime
+from functools import wraps
 import logging
 import traceback
 from config import settings
@@ -183,6 +184,27 @@ class ErrorHandler:
             details=details
         )
 
+def service_errors_to_http(fallback_detail: str):
+    """Translate service exceptions raised by a route handler into HTTPExceptions"""
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(*args, **kwargs):
+            try:
+                return await handler(*args, **kwargs)
+            except HTTPException:
+                raise
+            except (ValidationError, InsufficientCreditsError) as e:
+                raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=e.message)
+            except NotFoundError as e:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=e.message)
+            except ServiceError as e:
+                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=e.message)
+            except Exception as e:
+                logger.error(f"Error in {handler.__name__}: {e}")
+                raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=fallback_detail)
+        return wrapper
+    return decorator
+
 # Exception handlers for FastAPI app
 exception_handlers = {
     ServiceError: ErrorHandler.service_error_handler,
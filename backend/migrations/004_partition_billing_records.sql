@@ -0,0 +1,60 @@
+-- Partition billing records by month
+-- Retention cleanup can then detach and drop whole months instead of deleting rows
+
+ALTER TABLE billing_records RENAME TO billing_records_unpartitioned;
+
+-- The partition key must be part of the primary key
+CREATE TABLE billing_records (
+    id UUID NOT NULL DEFAULT uuid_generate_v4(),
+    user_id UUID NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    vm_id UUID REFERENCES vms(id) ON DELETE SET NULL,
+    action_type VARCHAR(50) NOT NULL,
+    amount DECIMAL(10,4) NOT NULL,
+    description TEXT,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at),
+    CONSTRAINT chk_billing_amount_not_zero_partitioned CHECK (amount != 0)
+) PARTITION BY RANGE (created_at);
+
+-- Catch-all for rows outside the pre-created monthly partitions
+CREATE TABLE IF NOT EXISTS billing_records_default PARTITION OF billing_records DEFAULT;
+
+-- Function to create the monthly partition containing a timestamp
+CREATE OR REPLACE FUNCTION create_billing_records_partition(p_month TIMESTAMP WITH TIME ZONE)
+RETURNS TEXT AS $$
+DECLARE
+    month_start DATE := date_trunc('month', p_month)::date;
+    partition_name TEXT := 'billing_records_p' || to_char(date_trunc('month', p_month), 'YYYYMM');
+BEGIN
+    EXECUTE format(
+        'CREATE TABLE IF NOT EXISTS %I PARTITION OF billing_records FOR VALUES FROM (%L) TO (%L)',
+        partition_name, month_start, (month_start + INTERVAL '1 month')::date
+    );
+
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Partitions from the oldest existing record through the next year
+SELECT create_billing_records_partition(month)
+FROM generate_series(
+    date_trunc('month', COALESCE((SELECT MIN(created_at) FROM billing_records_unpartitioned), CURRENT_TIMESTAMP)),
+    date_trunc('month', CURRENT_TIMESTAMP) + INTERVAL '12 months',
+    INTERVAL '1 month'
+) AS month;
+
+INSERT INTO billing_records (id, user_id, vm_id, action_type, amount, description, created_at)
+SELECT id, user_id, vm_id, action_type, amount, description, COALESCE(created_at, CURRENT_TIMESTAMP)
+FROM billing_records_unpartitioned;
+
+-- Dropping the old table also drops its indexes and spending trigger
+DROP TABLE billing_records_unpartitioned;
+
+CREATE INDEX IF NOT EXISTS idx_billing_records_user_id ON billing_records(user_id);
+CREATE INDEX IF NOT EXISTS idx_billing_records_created_at ON billing_records(created_at);
+CREATE INDEX IF NOT EXISTS idx_billing_records_user_date ON billing_records(user_id, created_at DESC);
+
+CREATE TRIGGER update_user_spending_trigger
+    AFTER INSERT ON billing_records
+    FOR EACH ROW
+    EXECUTE FUNCTION update_user_spending();
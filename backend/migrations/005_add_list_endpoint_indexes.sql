@@ -0,0 +1,10 @@
+-- Indexes for the VM and project list endpoints
+-- Single-column user_id/project_id indexes already exist (001); these also cover the ORDER BY created_at DESC
+
+CREATE INDEX IF NOT EXISTS idx_vms_user_created ON vms(user_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_vms_project_created ON vms(project_id, created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_projects_user_created ON projects(user_id, created_at DESC);
+
+-- Serves the ownership-checked project detail join and the name uniqueness check on VM creation
+CREATE INDEX IF NOT EXISTS idx_vms_user_project ON vms(user_id, project_id);
+CREATE INDEX IF NOT EXISTS idx_vms_project_name ON vms(project_id, name) WHERE status <> 'terminated';
@@ -0,0 +1,16 @@
+-- Per-user profile statistics in a single call
+-- Used by the profile endpoints instead of four separate count/sum queries
+
+CREATE OR REPLACE FUNCTION get_user_stats(uid UUID)
+RETURNS TABLE (
+    vm_count INTEGER,
+    active_vm_count INTEGER,
+    project_count INTEGER,
+    total_spent DOUBLE PRECISION
+) AS $$
+    SELECT
+        (SELECT COUNT(*)::int FROM vms WHERE user_id = uid),
+        (SELECT COUNT(*)::int FROM vms WHERE user_id = uid AND status = 'running'),
+        (SELECT COUNT(*)::int FROM projects WHERE user_id = uid),
+        (SELECT COALESCE(SUM(amount), 0)::float8 FROM billing_records WHERE user_id = uid AND amount > 0);
+$$ LANGUAGE sql STABLE;
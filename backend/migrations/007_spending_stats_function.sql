@@ -0,0 +1,14 @@
+-- Spending totals for one user over a period in a single call
+-- Used by the usage summary instead of fetching every billing row in the window
+
+CREATE OR REPLACE FUNCTION get_spending_stats(uid UUID, start_date TIMESTAMP WITH TIME ZONE, end_date TIMESTAMP WITH TIME ZONE)
+RETURNS TABLE (
+    total_spent DOUBLE PRECISION,
+    record_count INTEGER
+) AS $$
+    SELECT
+        COALESCE(SUM(amount) FILTER (WHERE amount > 0), 0)::float8,
+        COUNT(*)::int
+    FROM billing_records
+    WHERE user_id = uid AND created_at BETWEEN start_date AND end_date;
+$$ LANGUAGE sql STABLE;
@@ -0,0 +1,14 @@
+-- Total and running VM counts for one user in a single scan
+-- Both counts are answered from idx_vms_user_status
+
+CREATE OR REPLACE FUNCTION vm_counts(uid UUID)
+RETURNS TABLE (
+    total_vms INTEGER,
+    active_vms INTEGER
+) AS $$
+    SELECT
+        COUNT(*)::int,
+        (COUNT(*) FILTER (WHERE status = 'running'))::int
+    FROM vms
+    WHERE user_id = uid;
+$$ LANGUAGE sql STABLE;
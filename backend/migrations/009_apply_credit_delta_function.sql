@@ -0,0 +1,37 @@
+-- Atomic credit balance change with its billing record
+-- The balance check, update and insert happen in one statement, so concurrent
+-- credit changes cannot overwrite each other or drive the balance negative
+
+CREATE OR REPLACE FUNCTION apply_credit_delta(
+    p_id UUID,
+    p_user_id UUID,
+    p_delta DECIMAL(10,4),
+    p_action_type VARCHAR(50),
+    p_description TEXT,
+    p_vm_id UUID DEFAULT NULL
+)
+RETURNS TABLE (
+    id UUID,
+    user_id UUID,
+    vm_id UUID,
+    action_type VARCHAR(50),
+    amount DECIMAL(10,4),
+    description TEXT,
+    created_at TIMESTAMP WITH TIME ZONE,
+    credits DECIMAL(10,2)
+) AS $$
+    WITH upd AS (
+        UPDATE users
+        SET credits = users.credits + p_delta
+        WHERE users.id = p_user_id AND users.credits + p_delta >= 0
+        RETURNING users.credits
+    ), ins AS (
+        INSERT INTO billing_records (id, user_id, vm_id, action_type, amount, description)
+        SELECT p_id, p_user_id, p_vm_id, p_action_type, p_delta, p_description FROM upd
+        RETURNING billing_records.id, billing_records.user_id, billing_records.vm_id,
+                  billing_records.action_type, billing_records.amount,
+                  billing_records.description, billing_records.created_at
+    )
+    SELECT ins.id, ins.user_id, ins.vm_id, ins.action_type, ins.amount, ins.description, ins.created_at, upd.credits
+    FROM ins CROSS JOIN upd;
+$$ LANGUAGE sql;
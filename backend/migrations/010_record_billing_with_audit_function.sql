@@ -0,0 +1,23 @@
+-- Billing record and its audit entry written in one statement
+-- The audit row commits or rolls back with the charge it describes
+
+CREATE OR REPLACE FUNCTION record_billing_with_audit(payload JSONB, audit JSONB)
+RETURNS SETOF billing_records AS $$
+    WITH billing AS (
+        INSERT INTO billing_records (id, user_id, vm_id, action_type, amount, description, created_at)
+        SELECT
+            (payload->>'id')::uuid,
+            (payload->>'user_id')::uuid,
+            (payload->>'vm_id')::uuid,
+            payload->>'action_type',
+            (payload->>'amount')::numeric,
+            payload->>'description',
+            COALESCE((payload->>'created_at')::timestamptz, CURRENT_TIMESTAMP)
+        RETURNING *
+    ), logged AS (
+        INSERT INTO audit_logs (id, user_id, action, resource_type, resource_id, new_values, created_at)
+        SELECT (audit->>'id')::uuid, billing.user_id, audit->>'action', 'billing_records', billing.id, audit->'details', billing.created_at
+        FROM billing
+    )
+    SELECT * FROM billing;
+$$ LANGUAGE sql;
@@ -0,0 +1,9 @@
+-- Combined hourly cost of a user's running VMs
+-- Answered from idx_vms_user_status without returning one row per VM
+
+CREATE OR REPLACE FUNCTION sum_running_cost(uid UUID)
+RETURNS DOUBLE PRECISION AS $$
+    SELECT COALESCE(SUM(cost_per_hour), 0)::float8
+    FROM vms
+    WHERE user_id = uid AND status = 'running';
+$$ LANGUAGE sql STABLE;
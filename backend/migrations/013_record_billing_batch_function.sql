@@ -0,0 +1,25 @@
+-- Several billing records and their audit entries written in one statement
+-- Used by the billing batch writer; each audit entry names its billing record in resource_id
+
+CREATE OR REPLACE FUNCTION record_billing_batch_with_audit(payloads JSONB, audits JSONB)
+RETURNS SETOF billing_records AS $$
+    WITH billing AS (
+        INSERT INTO billing_records (id, user_id, vm_id, action_type, amount, description, created_at)
+        SELECT
+            (payload->>'id')::uuid,
+            (payload->>'user_id')::uuid,
+            (payload->>'vm_id')::uuid,
+            payload->>'action_type',
+            (payload->>'amount')::numeric,
+            payload->>'description',
+            COALESCE((payload->>'created_at')::timestamptz, CURRENT_TIMESTAMP)
+        FROM jsonb_array_elements(payloads) AS payload
+        RETURNING *
+    ), logged AS (
+        INSERT INTO audit_logs (id, user_id, action, resource_type, resource_id, new_values, created_at)
+        SELECT (audit->>'id')::uuid, billing.user_id, audit->>'action', 'billing_records', billing.id, audit->'details', billing.created_at
+        FROM jsonb_array_elements(audits) AS audit
+        JOIN billing ON billing.id = (audit->>'resource_id')::uuid
+    )
+    SELECT * FROM billing;
+$$ LANGUAGE sql;
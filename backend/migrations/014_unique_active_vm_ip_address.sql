@@ -0,0 +1,4 @@
+-- One active VM per IP address, so workers allocating addresses concurrently cannot hand out the same one
+-- Terminated VMs keep their address for history and release it for reuse
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_vms_active_ip_address ON vms(ip_address) WHERE status <> 'terminated';
@@ -307,6 +307,27 @@ class VMMetricsCreate(BaseModel):
     network_in: float = Field(default=0.0, ge=0, description="Network bytes in")
     network_out: float = Field(default=0.0, ge=0, description="Network bytes out")
 
+class VMMetricsSample(BaseModel):
+    timestamp: datetime = Field(..., description="Sample timestamp")
+    cpu_usage: float = Field(..., description="CPU usage percentage")
+    memory_usage: float = Field(..., description="Memory usage percentage")
+    disk_usage: float = Field(..., description="Disk usage percentage")
+    network_in: float = Field(..., description="Network bytes in")
+    network_out: float = Field(..., description="Network bytes out")
+
+class VMMetricsHistoryResponse(BaseModel):
+    vm_id: str
+    vm_name: str
+    period_hours: int = Field(..., description="Number of hours covered")
+    interval_minutes: int = Field(..., description="Minutes between samples")
+    data_points: int = Field(..., description="Number of samples returned")
+    period_start: datetime
+    period_end: datetime
+    metrics: List[VMMetricsSample] = Field(default_factory=list, description="Time-series samples")
+    averages: Dict[str, float] = Field(default_factory=dict, description="Average usage over the period")
+    peaks: Dict[str, float] = Field(default_factory=dict, description="Peak usage over the period")
+    generated_at: datetime
+
 class VMSpecs(BaseModel):
     cpu: str = Field(..., description="CPU specification")
     ram: str = Field(..., description="RAM specification")
@@ -0,0 +1,20 @@
+"""Short-lived caches for API responses, invalidated wherever the cached data changes"""
+from cachetools import TTLCache
+
+# Invalidation only reaches the local worker, so keep the window short for multi-worker deployments
+LIST_CACHE_TTL_SECONDS = 10
+
+vm_list_cache: TTLCache = TTLCache(maxsize=10_000, ttl=LIST_CACHE_TTL_SECONDS)
+project_list_cache: TTLCache = TTLCache(maxsize=10_000, ttl=LIST_CACHE_TTL_SECONDS)
+
+def invalidate_user_lists(user_id: str):
+    """Drop a user's cached VM and project lists; project stats are derived from VMs, so both go together"""
+    vm_list_cache.pop(user_id, None)
+    project_list_cache.pop(user_id, None)
+
+# VM metadata read by the metrics endpoints, keyed by VM ID; dropped by VMService whenever the VM row changes
+vm_metadata_cache: TTLCache = TTLCache(maxsize=10_000, ttl=LIST_CACHE_TTL_SECONDS)
+
+def invalidate_vm_metadata(vm_id: str):
+    """Drop a VM's cached metadata so monitoring sees its new status and timestamps"""
+    vm_metadata_cache.pop(vm_id, None)
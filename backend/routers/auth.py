@@ -1,8 +1,10 @@
-from fastapi import APIRouter, HTTPException, status, Depends, Query
+from fastapi import APIRouter, HTTPException, status, Depends, Query, Response
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from typing import Optional
 from datetime import timedelta
 from database import db
 from models import UserSignup, UserLogin, UserUpdate, Token, UserResponse, APIResponse
-from auth import verify_password, get_password_hash, create_access_token, get_current_active_user
+from auth import verify_password, get_password_hash, create_access_token, get_current_active_user, invalidate_cached_token
 from services.service_container import service_container
 from services.base_service import ServiceError, ValidationError, NotFoundError
 from config import settings
@@ -12,6 +14,9 @@ logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/auth", tags=["Authentication"])
 
+# Logout accepts a missing token, but drops the cached session when one is sent
+optional_security = HTTPBearer(auto_error=False)
+
 @router.post("/signup", 
              response_model=Token, 
              status_code=status.HTTP_201_CREATED,
@@ -234,13 +239,14 @@ async def login(user_data: UserLogin):
             detail="Internal server error during login"
         )
 
+# The profile is serialised by pydantic-core directly; UserResponse only documents the schema
 @router.get("/me", 
-            response_model=UserResponse,
             summary="Get Current User Profile",
             description="Get current authenticated user's profile information and account details",
             response_description="Complete user profile with current credit balance and statistics",
             responses={
                 200: {
+                    "model": UserResponse,
                     "description": "User profile retrieved successfully",
                     "content": {
                         "application/json": {
@@ -310,7 +316,8 @@ async def get_current_user_info(current_user: UserResponse = Depends(get_current
     """
     try:
         auth_service = service_container.get_auth_service()
-        return await auth_service.get_user_profile(current_user.id)
+        profile = await auth_service.get_user_profile(current_user.id)
+        return Response(content=profile.model_dump_json(), media_type="application/json")
         
     except NotFoundError as e:
         raise HTTPException(
@@ -350,7 +357,7 @@ async def get_current_user_info(current_user: UserResponse = Depends(get_current
                      "description": "Authentication required - invalid or missing token"
                  }
              })
-async def logout():
+async def logout(credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)):
     """
     Logout user by invalidating client-side token.
     
@@ -375,6 +382,9 @@ async def logout():
     
     **Rate Limit:** 10 requests per minute per user
     """
+    if credentials:
+        invalidate_cached_token(credentials.credentials)
+    
     return APIResponse(
         success=True,
         message="Successfully logged out. Please remove the token from client storage."
@@ -2,22 +2,66 @@
 Billing and credit management endpoints
 """
 
-from fastapi import APIRouter, HTTPException, status, Depends, Query
+from fastapi import APIRouter, HTTPException, status, Depends, Query, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from typing import List, Optional
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from database import db
 from models import (
     UserResponse, BillingRecord, BillingRecordCreate, UsageSummary, 
-    CreditUpdate, APIResponse, PaginationParams, PaginatedResponse
+    CreditUpdate, APIResponse, PaginationParams, PaginatedResponse, BillingActionType
 )
 from auth import get_current_active_user
 from services.service_container import service_container
 from services.base_service import ServiceError, ValidationError, NotFoundError
+from services.billing_loader import BillingLoader
+import hashlib
 import logging
+import orjson
+import uuid
 
 logger = logging.getLogger(__name__)
 
-router = APIRouter(prefix="/billing", tags=["Billing"])
+router = APIRouter(prefix="/billing", tags=["Billing"], default_response_class=ORJSONResponse)
+
+# Aggregate endpoints are polled by dashboards; let clients reuse a response briefly
+AGGREGATE_CACHE_CONTROL = "private, max-age=30"
+
+# Hot read paths go straight to PostgreSQL when a pool is configured; asyncpg
+# prepares these statements once per connection and reuses the plans.
+CREDIT_BALANCE_SQL = """
+    SELECT
+        COALESCE(SUM(amount) FILTER (WHERE amount > 0 AND created_at >= $2), 0)::float8 AS monthly_spending,
+        COALESCE(SUM(amount) FILTER (WHERE amount > 0 AND created_at >= $3), 0)::float8 AS weekly_spending,
+        COALESCE(SUM(amount) FILTER (WHERE amount > 0 AND created_at >= $4), 0)::float8 AS daily_spending,
+        MAX(created_at) AS last_transaction,
+        COUNT(*) AS credit_history_count
+    FROM billing_records
+    WHERE user_id = $1
+"""
+
+BILLING_RECORD_COLUMNS = "id::text AS id, user_id::text AS user_id, vm_id::text AS vm_id, action_type, amount::float8 AS amount, description, created_at"
+
+COST_ANALYSIS_RECORDS_SQL = """
+    SELECT vm_id::text AS vm_id, action_type, amount::float8 AS amount, created_at
+    FROM billing_records
+    WHERE user_id = $1 AND created_at >= $2
+"""
+
+COST_ANALYSIS_VMS_SQL = """
+    SELECT id::text AS id, name, instance_type, status
+    FROM vms
+    WHERE user_id = $1
+"""
+
+def _parse_iso(value: str) -> datetime:
+    """Parse an ISO 8601 query parameter, accepting a trailing Z"""
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+def _aggregate_etag(user_id: str, period_days: int, last_tx_id: Optional[str]) -> str:
+    """Build an ETag for an aggregate over the user's billing records"""
+    digest = hashlib.blake2b(f"{user_id}:{period_days}:{last_tx_id}".encode(), digest_size=8).hexdigest()
+    return f'"{digest}"'
 
 @router.get("/credits",
            summary="Get Current Credit Balance",
@@ -68,29 +112,46 @@ async def get_credit_balance(current_user: UserResponse = Depends(get_current_ac
     **Rate Limit:** 100 requests per minute per user
     """
     try:
-        supabase = db.get_client()
+        now = datetime.now(timezone.utc)
+        now_iso = now.isoformat().replace("+00:00", "Z")
         
         # Get recent billing records for calculations
-        thirty_days_ago = datetime.utcnow() - timedelta(days=30)
-        seven_days_ago = datetime.utcnow() - timedelta(days=7)
-        one_day_ago = datetime.utcnow() - timedelta(days=1)
-        
-        # Calculate spending periods
-        monthly_records = supabase.table("billing_records").select("amount").eq("user_id", current_user.id).gte("created_at", thirty_days_ago.isoformat()).execute()
-        weekly_records = supabase.table("billing_records").select("amount").eq("user_id", current_user.id).gte("created_at", seven_days_ago.isoformat()).execute()
-        daily_records = supabase.table("billing_records").select("amount").eq("user_id", current_user.id).gte("created_at", one_day_ago.isoformat()).execute()
-        
-        monthly_spending = sum(record["amount"] for record in monthly_records.data if record["amount"] > 0)
-        weekly_spending = sum(record["amount"] for record in weekly_records.data if record["amount"] > 0)
-        daily_spending = sum(record["amount"] for record in daily_records.data if record["amount"] > 0)
-        
-        # Get last transaction
-        last_transaction_result = supabase.table("billing_records").select("created_at").eq("user_id", current_user.id).order("created_at", desc=True).limit(1).execute()
-        last_transaction = last_transaction_result.data[0]["created_at"] if last_transaction_result.data else None
-        
-        # Get total credit history count
-        history_count_result = supabase.table("billing_records").select("id", count="exact").eq("user_id", current_user.id).execute()
-        history_count = history_count_result.count or 0
+        thirty_days_ago = now - timedelta(days=30)
+        seven_days_ago = now - timedelta(days=7)
+        one_day_ago = now - timedelta(days=1)
+        
+        if db.pg_enabled:
+            # All spending windows, last transaction and count in one round-trip
+            result = await db.execute_query(
+                CREDIT_BALANCE_SQL,
+                [current_user.id, thirty_days_ago, seven_days_ago, one_day_ago],
+                fetch_mode="one"
+            )
+            row = result.rows[0]
+            monthly_spending = row["monthly_spending"]
+            weekly_spending = row["weekly_spending"]
+            daily_spending = row["daily_spending"]
+            last_transaction = row["last_transaction"]
+            history_count = row["credit_history_count"]
+        else:
+            supabase = db.get_client()
+            
+            # Calculate spending periods
+            monthly_records = supabase.table("billing_records").select("amount").eq("user_id", current_user.id).gte("created_at", thirty_days_ago.isoformat()).execute()
+            weekly_records = supabase.table("billing_records").select("amount").eq("user_id", current_user.id).gte("created_at", seven_days_ago.isoformat()).execute()
+            daily_records = supabase.table("billing_records").select("amount").eq("user_id", current_user.id).gte("created_at", one_day_ago.isoformat()).execute()
+            
+            monthly_spending = sum(record["amount"] for record in monthly_records.data if record["amount"] > 0)
+            weekly_spending = sum(record["amount"] for record in weekly_records.data if record["amount"] > 0)
+            daily_spending = sum(record["amount"] for record in daily_records.data if record["amount"] > 0)
+            
+            # Get last transaction
+            last_transaction_result = supabase.table("billing_records").select("created_at").eq("user_id", current_user.id).order("created_at", desc=True).limit(1).execute()
+            last_transaction = last_transaction_result.data[0]["created_at"] if last_transaction_result.data else None
+            
+            # Get total credit history count
+            history_count_result = supabase.table("billing_records").select("id", count="exact", head=True).eq("user_id", current_user.id).execute()
+            history_count = history_count_result.count or 0
         
         # Calculate projected monthly cost based on daily average
         projected_monthly = daily_spending * 30 if daily_spending > 0 else 0
@@ -104,7 +165,7 @@ async def get_credit_balance(current_user: UserResponse = Depends(get_current_ac
             "projected_monthly_cost": projected_monthly,
             "last_transaction": last_transaction,
             "credit_history_count": history_count,
-            "timestamp": datetime.utcnow().isoformat() + "Z"
+            "timestamp": now_iso
         }
         
     except Exception as e:
@@ -114,6 +175,97 @@ async def get_credit_balance(current_user: UserResponse = Depends(get_current_ac
             detail="Failed to fetch credit balance"
         )
 
+@router.get("/credits/bulk",
+           summary="Get Spending Summaries for Several Users",
+           description="Get spending summaries for a batch of users in a single query (admin only)",
+           response_description="Spending summaries keyed by user ID",
+           responses={
+               200: {
+                   "description": "Spending summaries retrieved successfully",
+                   "content": {
+                       "application/json": {
+                           "example": {
+                               "users": {
+                                   "123e4567-e89b-12d3-a456-426614174000": {
+                                       "user_id": "123e4567-e89b-12d3-a456-426614174000",
+                                       "monthly_spending": 2.30,
+                                       "weekly_spending": 0.85,
+                                       "daily_spending": 0.15,
+                                       "last_transaction": "2024-01-15T10:30:00Z",
+                                       "credit_history_count": 12
+                                   }
+                               },
+                               "timestamp": "2024-01-15T10:35:00Z"
+                           }
+                       }
+                   }
+               },
+               401: {
+                   "description": "Authentication required"
+               },
+               403: {
+                   "description": "Insufficient permissions (admin required)"
+               }
+           })
+async def get_bulk_credit_balances(
+    user_ids: List[str] = Query(..., min_length=1, max_length=100, description="User IDs to summarize"),
+    current_user: UserResponse = Depends(get_current_active_user)
+):
+    """
+    Get spending summaries for several users at once.
+    
+    **Query Parameters:**
+    - `user_ids`: Repeat for each user (max 100)
+    
+    **Returns:**
+    - Spending breakdown (monthly, weekly, daily) per user
+    - Last transaction timestamp and credit history count per user
+    
+    **Use Cases:**
+    - Admin dashboards listing many accounts
+    - Background aggregation jobs
+    
+    **Performance:**
+    - Lookups are batched into one grouped query instead of one set of queries per user
+    
+    **Authentication:** Requires valid JWT token; non-admins may only request their own ID
+    """
+    # Canonical lower-case form, matching the user_id::text keys the summaries come back under
+    try:
+        user_ids = [str(uuid.UUID(user_id)) for user_id in user_ids]
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="user_ids must be valid UUIDs"
+        )
+    
+    if current_user.role != "admin" and set(user_ids) != {current_user.id}:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Admin privileges required"
+        )
+    
+    try:
+        loader = BillingLoader(service_container.get_billing_service())
+        summaries = await loader.load_many(user_ids)
+        
+        return {
+            "users": {summary["user_id"]: summary for summary in summaries},
+            "timestamp": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+        }
+    
+    except ServiceError as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=e.message
+        )
+    except Exception as e:
+        logger.error(f"Error fetching bulk credit balances: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to fetch credit balances"
+        )
+
 @router.get("/history",
            response_model=PaginatedResponse,
            summary="Get Billing History",
@@ -193,32 +345,66 @@ async def get_billing_history(
     **Rate Limit:** 100 requests per minute per user
     """
     try:
-        supabase = db.get_client()
-        
-        # Build query
-        query = supabase.table("billing_records").select("*").eq("user_id", current_user.id)
-        
-        # Apply filters
-        if action_type:
-            query = query.eq("action_type", action_type)
-        if vm_id:
-            query = query.eq("vm_id", vm_id)
-        if start_date:
-            query = query.gte("created_at", start_date)
-        if end_date:
-            query = query.lte("created_at", end_date)
-        
-        # Get total count
-        count_result = query.execute()
-        total = len(count_result.data)
-        
-        # Apply pagination
         offset = (page - 1) * limit
-        result = query.order("created_at", desc=True).range(offset, offset + limit - 1).execute()
+        
+        if db.pg_enabled:
+            # Build parameterized filters
+            conditions = ["user_id = $1"]
+            params: List = [current_user.id]
+            if action_type:
+                params.append(action_type)
+                conditions.append(f"action_type = ${len(params)}")
+            if vm_id:
+                params.append(vm_id)
+                conditions.append(f"vm_id = ${len(params)}")
+            if start_date:
+                params.append(_parse_iso(start_date))
+                conditions.append(f"created_at >= ${len(params)}")
+            if end_date:
+                params.append(_parse_iso(end_date))
+                conditions.append(f"created_at <= ${len(params)}")
+            where = " AND ".join(conditions)
+            
+            # Get total count
+            count_result = await db.execute_query(
+                f"SELECT COUNT(*) FROM billing_records WHERE {where}", params, fetch_mode="val"
+            )
+            total = count_result.rows[0]["value"] if count_result.rows else 0
+            
+            # Apply pagination
+            page_result = await db.execute_query(
+                f"SELECT {BILLING_RECORD_COLUMNS} FROM billing_records WHERE {where} "
+                f"ORDER BY created_at DESC LIMIT ${len(params) + 1} OFFSET ${len(params) + 2}",
+                params + [limit, offset]
+            )
+            records = page_result.rows
+        else:
+            supabase = db.get_client()
+            
+            # Build query
+            query = supabase.table("billing_records").select("*").eq("user_id", current_user.id)
+            
+            # Apply filters
+            if action_type:
+                query = query.eq("action_type", action_type)
+            if vm_id:
+                query = query.eq("vm_id", vm_id)
+            if start_date:
+                query = query.gte("created_at", start_date)
+            if end_date:
+                query = query.lte("created_at", end_date)
+            
+            # Get total count
+            count_result = query.execute()
+            total = len(count_result.data)
+            
+            # Apply pagination
+            result = query.order("created_at", desc=True).range(offset, offset + limit - 1).execute()
+            records = result.data
         
         # Convert to response models
         items = []
-        for record in result.data:
+        for record in records:
             items.append(BillingRecord(
                 id=record["id"],
                 user_id=record["user_id"],
@@ -243,6 +429,39 @@ async def get_billing_history(
             detail="Failed to fetch billing history"
         )
 
+@router.get("/history/export",
+           summary="Export Billing History",
+           description="Stream the complete billing history as newline-delimited JSON",
+           response_description="One billing record per line, newest first",
+           responses={
+               200: {
+                   "description": "Billing history stream",
+                   "content": {"application/x-ndjson": {}}
+               },
+               401: {
+                   "description": "Authentication required"
+               }
+           })
+async def export_billing_history(
+    action_type: Optional[BillingActionType] = Query(None, description="Filter by action type"),
+    current_user: UserResponse = Depends(get_current_active_user)
+):
+    """
+    Export every billing record for the current user.
+    
+    Records are fetched from the database a page at a time and written to the
+    response as they arrive, so large histories are never held in memory at once.
+    
+    **Authentication:** Requires valid JWT token
+    """
+    billing_service = service_container.get_billing_service()
+    
+    async def record_lines():
+        async for record in billing_service.iter_user_billing_history(current_user.id, action_type):
+            yield orjson.dumps(record.model_dump()) + b"\n"
+    
+    return StreamingResponse(record_lines(), media_type="application/x-ndjson")
+
 @router.get("/usage-summary",
            response_model=UsageSummary,
            summary="Get Usage Summary",
@@ -273,6 +492,8 @@ async def get_billing_history(
                }
            })
 async def get_usage_summary(
+    request: Request,
+    response: Response,
     period_days: int = Query(30, ge=1, le=365, description="Number of days to include in summary"),
     current_user: UserResponse = Depends(get_current_active_user)
 ):
@@ -302,12 +523,23 @@ async def get_usage_summary(
     - Usage trend analysis
     - Cost optimization planning
     
+    **Caching:** Responses carry an `ETag`; send it back in `If-None-Match`
+    to receive `304 Not Modified` until a new transaction is recorded.
+    
     **Authentication:** Requires valid JWT token
     
     **Rate Limit:** 100 requests per minute per user
     """
     try:
         billing_service = service_container.get_billing_service()
+        
+        last_tx_id = await billing_service.get_last_transaction_id(current_user.id)
+        etag = _aggregate_etag(current_user.id, period_days, last_tx_id)
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+        
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = AGGREGATE_CACHE_CONTROL
         return await billing_service.get_usage_summary(current_user.id, period_days)
         
     except ServiceError as e:
@@ -397,6 +629,7 @@ async def add_credits(
     """
     try:
         billing_service = service_container.get_billing_service()
+        now_iso = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
         billing_record = await billing_service.add_credits(
             current_user.id, 
             credit_data.amount, 
@@ -415,7 +648,7 @@ async def add_credits(
                 "previous_balance": current_user.credits,
                 "new_balance": updated_user.credits,
                 "transaction_id": billing_record.id,
-                "timestamp": datetime.utcnow().isoformat() + "Z"
+                "timestamp": now_iso
             }
         )
         
@@ -475,6 +708,8 @@ async def add_credits(
                }
            })
 async def get_cost_analysis(
+    request: Request,
+    response: Response,
     period_days: int = Query(30, ge=1, le=365, description="Analysis period in days"),
     current_user: UserResponse = Depends(get_current_active_user)
 ):
@@ -505,20 +740,46 @@ async def get_cost_analysis(
     - Budget variance analysis
     - Resource utilization review
     
+    **Caching:** Responses carry an `ETag`; send it back in `If-None-Match`
+    to receive `304 Not Modified` until a new transaction is recorded.
+    
     **Authentication:** Requires valid JWT token
     
     **Rate Limit:** 50 requests per minute per user
     """
     try:
-        supabase = db.get_client()
+        billing_service = service_container.get_billing_service()
+        last_tx_id = await billing_service.get_last_transaction_id(current_user.id)
+        etag = _aggregate_etag(current_user.id, period_days, last_tx_id)
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
         
-        # Calculate period
-        period_start = datetime.utcnow() - timedelta(days=period_days)
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = AGGREGATE_CACHE_CONTROL
         
-        # Get billing records for period
-        billing_result = supabase.table("billing_records").select("*").eq("user_id", current_user.id).gte("created_at", period_start.isoformat()).execute()
+        now = datetime.now(timezone.utc)
+        now_iso = now.isoformat().replace("+00:00", "Z")
+        
+        # Calculate period
+        period_start = now - timedelta(days=period_days)
+        
+        if db.pg_enabled:
+            records_result = await db.execute_query(COST_ANALYSIS_RECORDS_SQL, [current_user.id, period_start])
+            vms_result = await db.execute_query(COST_ANALYSIS_VMS_SQL, [current_user.id])
+            # Keep created_at comparable with the ISO week bounds below
+            records = [{**record, "created_at": record["created_at"].isoformat()} for record in records_result.rows]
+            user_vms = vms_result.rows
+        else:
+            supabase = db.get_client()
+            
+            # Get billing records for period
+            billing_result = supabase.table("billing_records").select("*").eq("user_id", current_user.id).gte("created_at", period_start.isoformat()).execute()
+            records = billing_result.data
+            
+            # Get VM information for cost by type analysis
+            vms_result = supabase.table("vms").select("id, name, instance_type, status").eq("user_id", current_user.id).execute()
+            user_vms = vms_result.data
         
-        records = billing_result.data
         total_cost = sum(record["amount"] for record in records if record["amount"] > 0)
         
         # Cost by action type
@@ -528,9 +789,7 @@ async def get_cost_analysis(
                 action = record["action_type"]
                 cost_by_action[action] = cost_by_action.get(action, 0) + record["amount"]
         
-        # Get VM information for cost by type analysis
-        vms_result = supabase.table("vms").select("id, name, instance_type").eq("user_id", current_user.id).execute()
-        vm_info = {vm["id"]: vm for vm in vms_result.data}
+        vm_info = {vm["id"]: vm for vm in user_vms}
         
         # Cost by VM type
         cost_by_vm_type = {}
@@ -546,14 +805,16 @@ async def get_cost_analysis(
         
         # Find most expensive VM
         most_expensive_vm = None
-        if vm_costs:
-            most_expensive_vm_id = max(vm_costs, key=vm_costs.get)
-            if most_expensive_vm_id in vm_info:
-                most_expensive_vm = {
-                    "vm_id": most_expensive_vm_id,
-                    "name": vm_info[most_expensive_vm_id]["name"],
-                    "cost": vm_costs[most_expensive_vm_id]
-                }
+        most_expensive_vm_id, most_expensive_cost = None, -1.0
+        for vm_id, cost in vm_costs.items():
+            if cost > most_expensive_cost:
+                most_expensive_vm_id, most_expensive_cost = vm_id, cost
+        if most_expensive_vm_id in vm_info:
+            most_expensive_vm = {
+                "vm_id": most_expensive_vm_id,
+                "name": vm_info[most_expensive_vm_id]["name"],
+                "cost": most_expensive_cost
+            }
         
         # Calculate daily average
         daily_average = total_cost / period_days if period_days > 0 else 0
@@ -561,11 +822,11 @@ async def get_cost_analysis(
         # Generate weekly trend (simplified)
         weekly_trend = []
         for i in range(7):
-            week_start = datetime.utcnow() - timedelta(days=(i+1)*7)
-            week_end = datetime.utcnow() - timedelta(days=i*7)
+            week_start = (now - timedelta(days=(i+1)*7)).isoformat()
+            week_end = (now - timedelta(days=i*7)).isoformat()
             
             week_records = [r for r in records 
-                          if week_start.isoformat() <= r["created_at"] <= week_end.isoformat()]
+                          if week_start <= r["created_at"] <= week_end]
             week_cost = sum(r["amount"] for r in week_records if r["amount"] > 0)
             weekly_trend.append(round(week_cost, 2))
         
@@ -575,7 +836,7 @@ async def get_cost_analysis(
         optimization_tips = []
         
         # Check for stopped VMs that might be forgotten
-        stopped_vms = [vm for vm in vms_result.data if vm.get("status") == "stopped"]
+        stopped_vms = [vm for vm in user_vms if vm.get("status") == "stopped"]
         if stopped_vms:
             optimization_tips.append(f"You have {len(stopped_vms)} stopped VMs. Consider terminating unused ones.")
         
@@ -592,8 +853,8 @@ async def get_cost_analysis(
         
         return {
             "period_days": period_days,
-            "period_start": period_start.isoformat() + "Z",
-            "period_end": datetime.utcnow().isoformat() + "Z",
+            "period_start": period_start.isoformat().replace("+00:00", "Z"),
+            "period_end": now_iso,
             "total_cost": round(total_cost, 2),
             "cost_by_vm_type": {k: round(v, 2) for k, v in cost_by_vm_type.items()},
             "cost_by_action": {k: round(v, 2) for k, v in cost_by_action.items()},
@@ -601,7 +862,7 @@ async def get_cost_analysis(
             "weekly_trend": weekly_trend,
             "most_expensive_vm": most_expensive_vm,
             "cost_optimization_tips": optimization_tips,
-            "analysis_timestamp": datetime.utcnow().isoformat() + "Z"
+            "analysis_timestamp": now_iso
         }
         
     except Exception as e:
@@ -2,20 +2,270 @@
 VM monitoring and metrics endpoints
 """
 
-from fastapi import APIRouter, HTTPException, status, Depends, Query, Path
-from typing import List, Optional, Dict, Any
-from datetime import datetime, timedelta
-from database import db
-from models import UserResponse, VMMetrics, VMMetricsCreate, APIResponse
+from fastapi import APIRouter, HTTPException, status, Depends, Query, Path, Request, Response
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+from typing import List, Optional, Dict, Any, Tuple
+from datetime import datetime, timedelta, timezone
+from database import db, get_supabase_client
+from supabase import Client
+from models import UserResponse, VMMetrics, VMMetricsCreate, VMMetricsHistoryResponse, APIResponse
 from auth import get_current_active_user
+from response_cache import vm_metadata_cache
 from services.service_container import service_container
 from services.base_service import ServiceError, ValidationError, NotFoundError
+from cachetools import LRUCache, TTLCache
+from functools import lru_cache, wraps
+from prometheus_client import Histogram
+import asyncio
+import hashlib
 import logging
 import random
+import time
+import numpy as np
+import orjson
+
+try:
+    # C parser for the VM timestamps read on every metrics request
+    from ciso8601 import parse_datetime as _parse_iso_datetime
+except ImportError:
+    _parse_iso_datetime = datetime.fromisoformat
 
 logger = logging.getLogger(__name__)
 
-router = APIRouter(prefix="/monitoring", tags=["Monitoring"])
+# Datetimes are serialized natively as UTC with a Z suffix, naive values included
+ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+def _orjson_default(obj: Any) -> Any:
+    """Serialize pydantic models nested in service results"""
+    if isinstance(obj, BaseModel):
+        return obj.model_dump()
+    raise TypeError
+
+def _dumps(content: Any) -> bytes:
+    """Encode a monitoring payload with the shared orjson options"""
+    return orjson.dumps(content, default=_orjson_default, option=ORJSON_OPTIONS)
+
+class MonitoringJSONResponse(ORJSONResponse):
+    """ORJSONResponse using the monitoring serialization options"""
+    
+    def render(self, content: Any) -> bytes:
+        return _dumps(content)
+
+router = APIRouter(prefix="/monitoring", tags=["Monitoring"], default_response_class=MonitoringJSONResponse)
+
+# Prometheus latency histograms, exported on /metrics
+REQUEST_LATENCY = Histogram("monitoring_request_duration_seconds", "Monitoring endpoint latency", ["endpoint"])
+DB_QUERY_LATENCY = Histogram("monitoring_db_query_seconds", "Monitoring database query latency", ["op"])
+_VM_LOOKUP_LATENCY = DB_QUERY_LATENCY.labels(op="vm_lookup")
+_OWNERSHIP_QUERY_LATENCY = DB_QUERY_LATENCY.labels(op="vm_ownership")
+_OVERVIEW_QUERY_LATENCY = DB_QUERY_LATENCY.labels(op="dashboard_overview")
+
+# Metrics dashboards poll the same VMs constantly; VM metadata comes from vm_metadata_cache
+# for a few seconds and only ownership is re-checked on a hit
+
+# Dedicated generators for simulated metrics, kept apart from the global random state;
+# the NumPy generator draws whole series in C
+_rng = random.Random()
+_NP_RNG = np.random.default_rng()
+
+# Last (memory, disk) usage reported while each VM was running, served while it is stopped
+STOPPED_VM_SNAPSHOT = (10.0, 40.0)
+_last_snapshot: LRUCache = LRUCache(maxsize=10_000)
+
+# Hourly VM pricing by instance type
+_VM_PRICING: Dict[str, float] = {
+    "small": 0.05,
+    "medium": 0.10,
+    "large": 0.20,
+    "xlarge": 0.40
+}
+
+# Only the columns the metrics handlers read
+VM_METRICS_COLUMNS = "id,name,instance_type,status,created_at,last_started"
+
+VM_METRICS_SQL = """
+    SELECT id::text AS id, name, instance_type, status, created_at, last_started
+    FROM vms
+    WHERE id = $1 AND user_id = $2
+"""
+
+VM_OWNERSHIP_SQL = "SELECT 1 FROM vms WHERE id = $1 AND user_id = $2 LIMIT 1"
+
+# Most samples a metrics history request may ask for
+MAX_HISTORY_POINTS = 500
+
+# Dashboard (per user) and system health (global) are polled by the UI; serve
+# rendered bodies for a few seconds and let clients revalidate with ETags
+POLLING_CACHE_CONTROL = "private, max-age=10"
+_dash_cache: TTLCache = TTLCache(maxsize=10_000, ttl=10)
+
+# System health is rebuilt by a background task; requests only read the latest snapshot
+SYSTEM_HEALTH_REFRESH_SECONDS = 5.0
+_system_health: Optional[Tuple[bytes, str]] = None
+_health_refresh_task: Optional[asyncio.Task] = None
+
+def _timed(endpoint: str):
+    """Record a handler's latency in REQUEST_LATENCY under the given endpoint label"""
+    histogram = REQUEST_LATENCY.labels(endpoint=endpoint)
+    
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with histogram.time():
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+async def _owns_vm(vm_id: str, user_id: str, supabase: Optional[Client]) -> bool:
+    """Check VM ownership without fetching the row"""
+    with _OWNERSHIP_QUERY_LATENCY.time():
+        if db.pg_enabled:
+            result = await db.execute_query(VM_OWNERSHIP_SQL, [vm_id, user_id], fetch_mode="val")
+            return bool(result.rows)
+        return bool(supabase.table("vms").select("id").eq("id", vm_id).eq("user_id", user_id).limit(1).execute().data)
+
+async def _get_vm_cached(vm_id: str, user_id: str, supabase: Optional[Client]) -> Optional[Dict[str, Any]]:
+    """Get a VM owned by the user, reusing cached metadata when possible"""
+    vm = vm_metadata_cache.get(vm_id)
+    if vm is not None:
+        return vm if await _owns_vm(vm_id, user_id, supabase) else None
+    
+    with _VM_LOOKUP_LATENCY.time():
+        if db.pg_enabled:
+            # Non-blocking lookup on the shared asyncpg pool
+            vm_result = await db.execute_query(VM_METRICS_SQL, [vm_id, user_id], fetch_mode="one")
+            rows = vm_result.rows
+        else:
+            rows = supabase.table("vms").select(VM_METRICS_COLUMNS).eq("id", vm_id).eq("user_id", user_id).limit(1).execute().data
+    if not rows:
+        return None
+    
+    vm = rows[0]
+    vm_metadata_cache[vm_id] = vm
+    return vm
+
+def _parse_ts(value: Any) -> datetime:
+    """Accept timestamps as asyncpg datetimes or PostgREST ISO strings"""
+    return value if isinstance(value, datetime) else _parse_iso_datetime(value)
+
+@lru_cache(maxsize=4)
+def _iso_second(epoch_seconds: int) -> str:
+    """Format a UTC epoch second as ISO 8601; polls within the same second reuse the string"""
+    return datetime.fromtimestamp(epoch_seconds, timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def _render_cache_entry(payload: Any) -> Tuple[bytes, str]:
+    """Render a payload to JSON once and derive its ETag"""
+    body = _dumps(payload)
+    return body, f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+
+def _cached_response(request: Request, entry: Tuple[bytes, str]) -> Response:
+    """Serve a rendered cache entry, or 304 when the client already has it"""
+    body, etag = entry
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers={"ETag": etag, "Cache-Control": POLLING_CACHE_CONTROL}
+    )
+
+# OpenAPI response examples
+_METRICS_EXAMPLE = {
+    "vm_id": "vm-123e4567-e89b-12d3-a456-426614174000",
+    "vm_name": "web-server-01",
+    "instance_type": "small",
+    "status": "running",
+    "cpu_usage": 25.5,
+    "memory_usage": 45.2,
+    "disk_usage": 32.1,
+    "network_in": 1024.5,
+    "network_out": 512.3,
+    "uptime_hours": 24.5,
+    "cost_per_hour": 0.05,
+    "total_cost": 1.275,
+    "current_session_hours": 2.5,
+    "recorded_at": "2024-01-15T10:30:00Z"
+}
+
+_HISTORY_EXAMPLE = {
+    "vm_id": "vm-123e4567-e89b-12d3-a456-426614174000",
+    "vm_name": "web-server-01",
+    "period_hours": 24,
+    "data_points": 48,
+    "metrics": [
+        {
+            "timestamp": "2024-01-15T09:00:00Z",
+            "cpu_usage": 25.5,
+            "memory_usage": 45.2,
+            "disk_usage": 32.1,
+            "network_in": 1024.5,
+            "network_out": 512.3
+        }
+    ],
+    "averages": {
+        "cpu_usage": 28.3,
+        "memory_usage": 42.1,
+        "disk_usage": 32.1
+    },
+    "peaks": {
+        "cpu_usage": 78.5,
+        "memory_usage": 89.2,
+        "network_in": 5024.1
+    }
+}
+
+_DASH_EXAMPLE = {
+    "overview": {
+        "total_vms": 5,
+        "running_vms": 3,
+        "stopped_vms": 2,
+        "total_cost": 15.75,
+        "hourly_cost": 0.35
+    },
+    "vm_summary": [
+        {
+            "vm_id": "vm-123",
+            "name": "web-server-01",
+            "status": "running",
+            "cpu_usage": 25.5,
+            "memory_usage": 45.2,
+            "cost_per_hour": 0.05
+        }
+    ],
+    "alerts": [
+        {
+            "type": "high_cpu",
+            "vm_id": "vm-456",
+            "message": "CPU usage above 80%",
+            "severity": "warning"
+        }
+    ],
+    "resource_utilization": {
+        "avg_cpu": 32.1,
+        "avg_memory": 48.5,
+        "avg_disk": 35.2
+    }
+}
+
+_HEALTH_EXAMPLE = {
+    "overall_status": "healthy",
+    "components": {
+        "api": {"status": "healthy", "response_time": 45},
+        "database": {"status": "healthy", "connections": 12},
+        "vm_manager": {"status": "healthy", "active_vms": 150}
+    },
+    "performance": {
+        "avg_response_time": 120,
+        "requests_per_minute": 450,
+        "error_rate": 0.02
+    },
+    "capacity": {
+        "total_vms": 150,
+        "vm_capacity_used": 75.5,
+        "storage_used": 45.2
+    }
+}
 
 @router.get("/vms/{vm_id}/metrics",
            summary="Get Current VM Metrics",
@@ -26,22 +276,7 @@ router = APIRouter(prefix="/monitoring", tags=["Monitoring"])
                    "description": "VM metrics retrieved successfully",
                    "content": {
                        "application/json": {
-                           "example": {
-                               "vm_id": "vm-123e4567-e89b-12d3-a456-426614174000",
-                               "vm_name": "web-server-01",
-                               "instance_type": "small",
-                               "status": "running",
-                               "cpu_usage": 25.5,
-                               "memory_usage": 45.2,
-                               "disk_usage": 32.1,
-                               "network_in": 1024.5,
-                               "network_out": 512.3,
-                               "uptime_hours": 24.5,
-                               "cost_per_hour": 0.05,
-                               "total_cost": 1.275,
-                               "current_session_hours": 2.5,
-                               "recorded_at": "2024-01-15T10:30:00Z"
-                           }
+                           "example": _METRICS_EXAMPLE
                        }
                    }
                },
@@ -52,9 +287,11 @@ router = APIRouter(prefix="/monitoring", tags=["Monitoring"])
                    "description": "Authentication required"
                }
            })
+@_timed("get_vm_metrics")
 async def get_vm_metrics(
     vm_id: str = Path(..., description="VM identifier"),
-    current_user: UserResponse = Depends(get_current_active_user)
+    current_user: UserResponse = Depends(get_current_active_user),
+    supabase: Optional[Client] = Depends(get_supabase_client)
 ):
     """
     Get real-time metrics for a specific virtual machine.
@@ -91,54 +328,42 @@ async def get_vm_metrics(
     **Rate Limit:** 100 requests per minute per user
     """
     try:
-        supabase = db.get_client()
+        now = time.time()
         
         # Verify VM exists and belongs to user
-        vm_result = supabase.table("vms").select("*").eq("id", vm_id).eq("user_id", current_user.id).execute()
+        vm = await _get_vm_cached(vm_id, current_user.id, supabase)
         
-        if not vm_result.data:
+        if not vm:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="VM not found"
             )
         
-        vm = vm_result.data[0]
-        
         # Generate simulated metrics (in production, this would come from actual monitoring)
         if vm["status"] == "running":
-            # Simulate realistic metrics for running VM
-            cpu_usage = random.uniform(10, 80)
-            memory_usage = random.uniform(20, 90)
-            disk_usage = random.uniform(15, 75)
-            network_in = random.uniform(100, 5000)
-            network_out = random.uniform(50, 2000)
+            # Simulate realistic metrics for running VM, drawn as integer tenths so no rounding is needed
+            cpu_usage = _rng.randint(100, 800) / 10
+            memory_usage = _rng.randint(200, 900) / 10
+            disk_usage = _rng.randint(150, 750) / 10
+            network_in = _rng.randint(1000, 50000) / 10
+            network_out = _rng.randint(500, 20000) / 10
+            _last_snapshot[vm["id"]] = (memory_usage, disk_usage)
         else:
-            # Return last known metrics for stopped VMs
-            cpu_usage = 0.0
-            memory_usage = random.uniform(5, 15)  # Base memory usage
-            disk_usage = random.uniform(15, 75)   # Disk usage persists
-            network_in = 0.0
-            network_out = 0.0
+            # Return last known metrics for stopped VMs without drawing new samples
+            cpu_usage = network_in = network_out = 0.0
+            memory_usage, disk_usage = _last_snapshot.get(vm["id"], STOPPED_VM_SNAPSHOT)
         
         # Calculate uptime and costs
-        created_at = datetime.fromisoformat(vm["created_at"].replace('Z', '+00:00'))
-        uptime_hours = (datetime.utcnow() - created_at).total_seconds() / 3600
+        created_at = _parse_ts(vm["created_at"])
+        uptime_hours = (now - created_at.timestamp()) / 3600
         
-        # VM pricing lookup
-        vm_pricing = {
-            "small": 0.05,
-            "medium": 0.10,
-            "large": 0.20,
-            "xlarge": 0.40
-        }
-        
-        cost_per_hour = vm_pricing.get(vm["instance_type"], 0.05)
+        cost_per_hour = _VM_PRICING.get(vm["instance_type"], 0.05)
         
         # Calculate current session hours if running
         current_session_hours = 0.0
         if vm["status"] == "running" and vm.get("last_started"):
-            last_started = datetime.fromisoformat(vm["last_started"].replace('Z', '+00:00'))
-            current_session_hours = (datetime.utcnow() - last_started).total_seconds() / 3600
+            last_started = _parse_ts(vm["last_started"])
+            current_session_hours = (now - last_started.timestamp()) / 3600
         
         # Estimate total cost (simplified calculation)
         total_cost = uptime_hours * cost_per_hour * 0.1  # Assuming 10% average uptime
@@ -148,16 +373,16 @@ async def get_vm_metrics(
             "vm_name": vm["name"],
             "instance_type": vm["instance_type"],
             "status": vm["status"],
-            "cpu_usage": round(cpu_usage, 1),
-            "memory_usage": round(memory_usage, 1),
-            "disk_usage": round(disk_usage, 1),
-            "network_in": round(network_in, 1),
-            "network_out": round(network_out, 1),
+            "cpu_usage": cpu_usage,
+            "memory_usage": memory_usage,
+            "disk_usage": disk_usage,
+            "network_in": network_in,
+            "network_out": network_out,
             "uptime_hours": round(uptime_hours, 2),
             "cost_per_hour": cost_per_hour,
             "total_cost": round(total_cost, 3),
             "current_session_hours": round(current_session_hours, 2),
-            "recorded_at": datetime.utcnow().isoformat() + "Z"
+            "recorded_at": _iso_second(int(now))
         }
         
     except HTTPException:
@@ -169,7 +394,74 @@ async def get_vm_metrics(
             detail="Failed to fetch VM metrics"
         )
 
+def _build_history_payload(vm: Dict[str, Any], hours: int, interval_minutes: int, end_time: datetime) -> Dict[str, Any]:
+    """Synthesize the metrics history payload; CPU-bound, so handlers run it in an executor"""
+    start_time = end_time - timedelta(hours=hours)
+    
+    # Calculate number of data points
+    total_minutes = hours * 60
+    data_points = min(total_minutes // interval_minutes, MAX_HISTORY_POINTS)
+    
+    # Generate realistic time-series data with some patterns, one array per channel
+    steps = np.arange(data_points)
+    cpu_values = np.clip(30 + 20 * np.sin(steps * 0.1) + _NP_RNG.uniform(-10, 10, data_points), 5, 95)  # Sine wave pattern
+    memory_values = np.clip(40 + 15 * np.sin(steps * 0.05) + _NP_RNG.uniform(-5, 5, data_points), 10, 90)
+    disk_values = np.clip(32 + _NP_RNG.uniform(-2, 2, data_points), 15, 85)  # Slowly growing
+    if vm["status"] == "running":
+        network_in_values = _NP_RNG.uniform(100, 2000, data_points)
+    else:
+        network_in_values = np.zeros(data_points)
+    network_out_values = network_in_values * _NP_RNG.uniform(0.3, 0.8, data_points)
+    
+    # One (channel, sample) matrix: rounding and statistics each take a single pass
+    samples = np.stack([cpu_values, memory_values, disk_values, network_in_values, network_out_values])
+    metrics = [
+        {
+            "timestamp": start_time + timedelta(minutes=step * interval_minutes),
+            "cpu_usage": row[0],
+            "memory_usage": row[1],
+            "disk_usage": row[2],
+            "network_in": row[3],
+            "network_out": row[4]
+        }
+        for step, row in enumerate(np.round(samples, 1).T.tolist())
+    ]
+    
+    # Calculate statistics
+    if data_points:
+        means = np.round(samples.mean(axis=1), 1).tolist()
+        maxima = np.round(samples.max(axis=1), 1).tolist()
+    else:
+        means = maxima = [0] * len(samples)
+    
+    averages = {
+        "cpu_usage": means[0],
+        "memory_usage": means[1],
+        "disk_usage": means[2]
+    }
+    
+    peaks = {
+        "cpu_usage": maxima[0],
+        "memory_usage": maxima[1],
+        "network_in": maxima[3]
+    }
+    
+    return {
+        "vm_id": vm["id"],
+        "vm_name": vm["name"],
+        "period_hours": hours,
+        "interval_minutes": interval_minutes,
+        "data_points": len(metrics),
+        "period_start": start_time,
+        "period_end": end_time,
+        "metrics": metrics,
+        "averages": averages,
+        "peaks": peaks,
+        "generated_at": end_time
+    }
+
 @router.get("/vms/{vm_id}/metrics/history",
+           response_model=VMMetricsHistoryResponse,
            summary="Get VM Metrics History",
            description="Get historical metrics data for a virtual machine",
            response_description="Time-series metrics data for the specified period",
@@ -178,35 +470,13 @@ async def get_vm_metrics(
                    "description": "Metrics history retrieved successfully",
                    "content": {
                        "application/json": {
-                           "example": {
-                               "vm_id": "vm-123e4567-e89b-12d3-a456-426614174000",
-                               "vm_name": "web-server-01",
-                               "period_hours": 24,
-                               "data_points": 48,
-                               "metrics": [
-                                   {
-                                       "timestamp": "2024-01-15T09:00:00Z",
-                                       "cpu_usage": 25.5,
-                                       "memory_usage": 45.2,
-                                       "disk_usage": 32.1,
-                                       "network_in": 1024.5,
-                                       "network_out": 512.3
-                                   }
-                               ],
-                               "averages": {
-                                   "cpu_usage": 28.3,
-                                   "memory_usage": 42.1,
-                                   "disk_usage": 32.1
-                               },
-                               "peaks": {
-                                   "cpu_usage": 78.5,
-                                   "memory_usage": 89.2,
-                                   "network_in": 5024.1
-                               }
-                           }
+                           "example": _HISTORY_EXAMPLE
                        }
                    }
                },
+               400: {
+                   "description": "Requested resolution exceeds the data point limit"
+               },
                404: {
                    "description": "VM not found"
                },
@@ -214,11 +484,13 @@ async def get_vm_metrics(
                    "description": "Authentication required"
                }
            })
+@_timed("get_vm_metrics_history")
 async def get_vm_metrics_history(
     vm_id: str = Path(..., description="VM identifier"),
     hours: int = Query(24, ge=1, le=168, description="Number of hours of history (1-168)"),
-    interval: int = Query(30, ge=5, le=3600, description="Data point interval in minutes"),
-    current_user: UserResponse = Depends(get_current_active_user)
+    interval: int = Query(30, ge=5, le=1440, description="Data point interval in minutes"),
+    current_user: UserResponse = Depends(get_current_active_user),
+    supabase: Optional[Client] = Depends(get_supabase_client)
 ):
     """
     Get historical metrics data for a virtual machine.
@@ -228,7 +500,8 @@ async def get_vm_metrics_history(
     
     **Query Parameters:**
     - `hours`: Number of hours of history to retrieve (1-168, default: 24)
-    - `interval`: Data point interval in minutes (5-3600, default: 30)
+    - `interval`: Data point interval in minutes (5-1440, default: 30)
+    - At most 500 data points per request (`hours * 60 / interval`); finer resolutions return 400
     
     **Historical Data:**
     - Time-series metrics data points
@@ -260,91 +533,27 @@ async def get_vm_metrics_history(
     
     **Rate Limit:** 50 requests per minute per user
     """
+    if hours * 60 // interval > MAX_HISTORY_POINTS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Resolution too fine for period: at most {MAX_HISTORY_POINTS} data points per request"
+        )
+    
     try:
-        supabase = db.get_client()
-        
         # Verify VM exists and belongs to user
-        vm_result = supabase.table("vms").select("*").eq("id", vm_id).eq("user_id", current_user.id).execute()
+        vm = await _get_vm_cached(vm_id, current_user.id, supabase)
         
-        if not vm_result.data:
+        if not vm:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail="VM not found"
             )
         
-        vm = vm_result.data[0]
-        
-        # Generate simulated historical data
+        # Generate simulated historical data off the event loop
         end_time = datetime.utcnow()
-        start_time = end_time - timedelta(hours=hours)
-        
-        # Calculate number of data points
-        interval_minutes = interval
-        total_minutes = hours * 60
-        data_points = min(total_minutes // interval_minutes, 1000)  # Cap at 1000 points
-        
-        metrics = []
-        cpu_values = []
-        memory_values = []
-        disk_values = []
-        network_in_values = []
-        
-        for i in range(data_points):
-            timestamp = start_time + timedelta(minutes=i * interval_minutes)
-            
-            # Generate realistic time-series data with some patterns
-            base_cpu = 30 + 20 * random.sin(i * 0.1)  # Sine wave pattern
-            cpu_usage = max(5, min(95, base_cpu + random.uniform(-10, 10)))
-            
-            base_memory = 40 + 15 * random.sin(i * 0.05)
-            memory_usage = max(10, min(90, base_memory + random.uniform(-5, 5)))
-            
-            disk_usage = 32 + random.uniform(-2, 2)  # Slowly growing
-            disk_usage = max(15, min(85, disk_usage))
-            
-            network_in = random.uniform(100, 2000) if vm["status"] == "running" else 0
-            network_out = network_in * random.uniform(0.3, 0.8)
-            
-            metrics.append({
-                "timestamp": timestamp.isoformat() + "Z",
-                "cpu_usage": round(cpu_usage, 1),
-                "memory_usage": round(memory_usage, 1),
-                "disk_usage": round(disk_usage, 1),
-                "network_in": round(network_in, 1),
-                "network_out": round(network_out, 1)
-            })
-            
-            cpu_values.append(cpu_usage)
-            memory_values.append(memory_usage)
-            disk_values.append(disk_usage)
-            network_in_values.append(network_in)
-        
-        # Calculate statistics
-        averages = {
-            "cpu_usage": round(sum(cpu_values) / len(cpu_values), 1) if cpu_values else 0,
-            "memory_usage": round(sum(memory_values) / len(memory_values), 1) if memory_values else 0,
-            "disk_usage": round(sum(disk_values) / len(disk_values), 1) if disk_values else 0
-        }
-        
-        peaks = {
-            "cpu_usage": round(max(cpu_values), 1) if cpu_values else 0,
-            "memory_usage": round(max(memory_values), 1) if memory_values else 0,
-            "network_in": round(max(network_in_values), 1) if network_in_values else 0
-        }
-        
-        return {
-            "vm_id": vm["id"],
-            "vm_name": vm["name"],
-            "period_hours": hours,
-            "interval_minutes": interval_minutes,
-            "data_points": len(metrics),
-            "period_start": start_time.isoformat() + "Z",
-            "period_end": end_time.isoformat() + "Z",
-            "metrics": metrics,
-            "averages": averages,
-            "peaks": peaks,
-            "generated_at": datetime.utcnow().isoformat() + "Z"
-        }
+        loop = asyncio.get_running_loop()
+        payload = await loop.run_in_executor(None, _build_history_payload, vm, hours, interval, end_time)
+        return MonitoringJSONResponse(payload)
         
     except HTTPException:
         raise
@@ -364,38 +573,7 @@ async def get_vm_metrics_history(
                    "description": "Dashboard data retrieved successfully",
                    "content": {
                        "application/json": {
-                           "example": {
-                               "overview": {
-                                   "total_vms": 5,
-                                   "running_vms": 3,
-                                   "stopped_vms": 2,
-                                   "total_cost": 15.75,
-                                   "hourly_cost": 0.35
-                               },
-                               "vm_summary": [
-                                   {
-                                       "vm_id": "vm-123",
-                                       "name": "web-server-01",
-                                       "status": "running",
-                                       "cpu_usage": 25.5,
-                                       "memory_usage": 45.2,
-                                       "cost_per_hour": 0.05
-                                   }
-                               ],
-                               "alerts": [
-                                   {
-                                       "type": "high_cpu",
-                                       "vm_id": "vm-456",
-                                       "message": "CPU usage above 80%",
-                                       "severity": "warning"
-                                   }
-                               ],
-                               "resource_utilization": {
-                                   "avg_cpu": 32.1,
-                                   "avg_memory": 48.5,
-                                   "avg_disk": 35.2
-                               }
-                           }
+                           "example": _DASH_EXAMPLE
                        }
                    }
                },
@@ -403,7 +581,8 @@ async def get_vm_metrics_history(
                    "description": "Authentication required"
                }
            })
-async def get_monitoring_dashboard(current_user: UserResponse = Depends(get_current_active_user)):
+@_timed("get_monitoring_dashboard")
+async def get_monitoring_dashboard(request: Request, current_user: UserResponse = Depends(get_current_active_user)):
     """
     Get comprehensive monitoring dashboard data for all user VMs.
     
@@ -443,14 +622,21 @@ async def get_monitoring_dashboard(current_user: UserResponse = Depends(get_curr
     - Real-time data for running VMs
     - Refreshed every 30 seconds
     - Historical trends updated hourly
+    - Responses are cached for 10 seconds; send `If-None-Match` with the last ETag to get a 304
     
     **Authentication:** Requires valid JWT token
     
     **Rate Limit:** 100 requests per minute per user
     """
     try:
-        monitoring_service = service_container.get_monitoring_service()
-        return await monitoring_service.get_user_monitoring_overview(current_user.id)
+        entry = _dash_cache.get(current_user.id)
+        if entry is None:
+            monitoring_service = service_container.get_monitoring_service()
+            with _OVERVIEW_QUERY_LATENCY.time():
+                overview = await monitoring_service.get_user_monitoring_overview(current_user.id)
+            entry = _dash_cache[current_user.id] = _render_cache_entry(overview)
+        
+        return _cached_response(request, entry)
         
     except ServiceError as e:
         raise HTTPException(
@@ -464,6 +650,128 @@ async def get_monitoring_dashboard(current_user: UserResponse = Depends(get_curr
             detail="Failed to generate monitoring dashboard"
         )
 
+def _build_system_health_payload() -> Dict[str, Any]:
+    """Simulate system health data (in production, this would come from actual monitoring)"""
+    now = datetime.utcnow()
+    
+    # Component health checks
+    components = {
+        "api": {
+            "status": "healthy",
+            "response_time_ms": _rng.randint(30, 100),
+            "uptime_hours": _rng.randint(100, 1000),
+            "last_check": now
+        },
+        "database": {
+            "status": "healthy",
+            "active_connections": _rng.randint(5, 25),
+            "query_time_ms": _rng.randint(10, 50),
+            "last_check": now
+        },
+        "vm_manager": {
+            "status": "healthy",
+            "active_vms": _rng.randint(100, 200),
+            "pending_operations": _rng.randint(0, 5),
+            "last_check": now
+        },
+        "storage": {
+            "status": "healthy",
+            "usage_percentage": _rng.uniform(30, 70),
+            "available_gb": _rng.randint(1000, 5000),
+            "last_check": now
+        }
+    }
+    
+    # Performance metrics
+    performance = {
+        "avg_response_time_ms": _rng.randint(80, 200),
+        "requests_per_minute": _rng.randint(300, 800),
+        "error_rate_percentage": _rng.uniform(0.01, 0.1),
+        "success_rate_percentage": _rng.uniform(99.8, 99.99),
+        "peak_requests_per_minute": _rng.randint(800, 1500)
+    }
+    
+    # Capacity metrics
+    capacity = {
+        "total_vms": _rng.randint(150, 300),
+        "vm_capacity_used_percentage": _rng.uniform(60, 85),
+        "storage_used_percentage": _rng.uniform(40, 75),
+        "cpu_capacity_used_percentage": _rng.uniform(45, 80),
+        "memory_capacity_used_percentage": _rng.uniform(50, 85)
+    }
+    
+    # Determine overall status
+    component_statuses = [comp["status"] for comp in components.values()]
+    overall_status = "healthy" if all(status == "healthy" for status in component_statuses) else "degraded"
+    
+    # Generate alerts if any issues
+    alerts = []
+    if performance["error_rate_percentage"] > 0.05:
+        alerts.append({
+            "type": "high_error_rate",
+            "message": f"Error rate at {performance['error_rate_percentage']:.2f}%",
+            "severity": "warning"
+        })
+    
+    if capacity["vm_capacity_used_percentage"] > 80:
+        alerts.append({
+            "type": "high_capacity",
+            "message": f"VM capacity at {capacity['vm_capacity_used_percentage']:.1f}%",
+            "severity": "info"
+        })
+    
+    return {
+        "overall_status": overall_status,
+        "components": components,
+        "performance": performance,
+        "capacity": capacity,
+        "alerts": alerts,
+        "recommendations": [
+            recommendation for recommendation, applies in (
+                ("Consider scaling up VM capacity", capacity["vm_capacity_used_percentage"] > 75),
+                ("Monitor error rates closely", performance["error_rate_percentage"] > 0.03),
+                ("Storage cleanup recommended", capacity["storage_used_percentage"] > 70)
+            )
+            if applies
+        ],
+        "last_updated": now,
+        "next_update": now + timedelta(minutes=5)
+    }
+
+async def _refresh_system_health() -> Tuple[bytes, str]:
+    """Rebuild the system health snapshot off the event loop"""
+    global _system_health
+    loop = asyncio.get_running_loop()
+    payload = await loop.run_in_executor(None, _build_system_health_payload)
+    _system_health = _render_cache_entry(payload)
+    return _system_health
+
+async def _refresh_system_health_loop(interval: float):
+    """Refresh the system health snapshot every `interval` seconds until cancelled"""
+    while True:
+        try:
+            await _refresh_system_health()
+        except Exception as e:
+            logger.error(f"Error refreshing system health: {e}")
+        await asyncio.sleep(interval)
+
+def start_system_health_refresher(interval: float = SYSTEM_HEALTH_REFRESH_SECONDS):
+    """Start the background system health refresher (called on app startup)"""
+    global _health_refresh_task
+    if _health_refresh_task is None or _health_refresh_task.done():
+        _health_refresh_task = asyncio.create_task(_refresh_system_health_loop(interval))
+
+async def stop_system_health_refresher():
+    """Cancel the background system health refresher (called on app shutdown)"""
+    global _health_refresh_task
+    if _health_refresh_task is not None:
+        _health_refresh_task.cancel()
+        try:
+            await _health_refresh_task
+        except asyncio.CancelledError:
+            pass
+        _health_refresh_task = None
+
 @router.get("/system/health",
            summary="Get System Health Status",
            description="Get comprehensive system health and performance status",
@@ -473,29 +781,13 @@ async def get_monitoring_dashboard(current_user: UserResponse = Depends(get_curr
                    "description": "System health retrieved successfully",
                    "content": {
                        "application/json": {
-                           "example": {
-                               "overall_status": "healthy",
-                               "components": {
-                                   "api": {"status": "healthy", "response_time": 45},
-                                   "database": {"status": "healthy", "connections": 12},
-                                   "vm_manager": {"status": "healthy", "active_vms": 150}
-                               },
-                               "performance": {
-                                   "avg_response_time": 120,
-                                   "requests_per_minute": 450,
-                                   "error_rate": 0.02
-                               },
-                               "capacity": {
-                                   "total_vms": 150,
-                                   "vm_capacity_used": 75.5,
-                                   "storage_used": 45.2
-                               }
-                           }
+                           "example": _HEALTH_EXAMPLE
                        }
                    }
                }
            })
-async def get_system_health(current_user: UserResponse = Depends(get_current_active_user)):
+@_timed("get_system_health")
+async def get_system_health(request: Request, current_user: UserResponse = Depends(get_current_active_user)):
     """
     Get comprehensive system health and performance status.
     
@@ -530,93 +822,16 @@ async def get_system_health(current_user: UserResponse = Depends(get_current_act
     - Capacity planning
     - Issue diagnosis and troubleshooting
     
+    **Caching:** Shared snapshot refreshed in the background every 5 seconds; send `If-None-Match` with the last ETag to get a 304
+    
     **Authentication:** Requires valid JWT token
     
     **Rate Limit:** 50 requests per minute per user
     """
     try:
-        # Simulate system health data (in production, this would come from actual monitoring)
-        
-        # Component health checks
-        components = {
-            "api": {
-                "status": "healthy",
-                "response_time_ms": random.randint(30, 100),
-                "uptime_hours": random.randint(100, 1000),
-                "last_check": datetime.utcnow().isoformat() + "Z"
-            },
-            "database": {
-                "status": "healthy",
-                "active_connections": random.randint(5, 25),
-                "query_time_ms": random.randint(10, 50),
-                "last_check": datetime.utcnow().isoformat() + "Z"
-            },
-            "vm_manager": {
-                "status": "healthy",
-                "active_vms": random.randint(100, 200),
-                "pending_operations": random.randint(0, 5),
-                "last_check": datetime.utcnow().isoformat() + "Z"
-            },
-            "storage": {
-                "status": "healthy",
-                "usage_percentage": random.uniform(30, 70),
-                "available_gb": random.randint(1000, 5000),
-                "last_check": datetime.utcnow().isoformat() + "Z"
-            }
-        }
-        
-        # Performance metrics
-        performance = {
-            "avg_response_time_ms": random.randint(80, 200),
-            "requests_per_minute": random.randint(300, 800),
-            "error_rate_percentage": random.uniform(0.01, 0.1),
-            "success_rate_percentage": random.uniform(99.8, 99.99),
-            "peak_requests_per_minute": random.randint(800, 1500)
-        }
-        
-        # Capacity metrics
-        capacity = {
-            "total_vms": random.randint(150, 300),
-            "vm_capacity_used_percentage": random.uniform(60, 85),
-            "storage_used_percentage": random.uniform(40, 75),
-            "cpu_capacity_used_percentage": random.uniform(45, 80),
-            "memory_capacity_used_percentage": random.uniform(50, 85)
-        }
-        
-        # Determine overall status
-        component_statuses = [comp["status"] for comp in components.values()]
-        overall_status = "healthy" if all(status == "healthy" for status in component_statuses) else "degraded"
-        
-        # Generate alerts if any issues
-        alerts = []
-        if performance["error_rate_percentage"] > 0.05:
-            alerts.append({
-                "type": "high_error_rate",
-                "message": f"Error rate at {performance['error_rate_percentage']:.2f}%",
-                "severity": "warning"
-            })
-        
-        if capacity["vm_capacity_used_percentage"] > 80:
-            alerts.append({
-                "type": "high_capacity",
-                "message": f"VM capacity at {capacity['vm_capacity_used_percentage']:.1f}%",
-                "severity": "info"
-            })
-        
-        return {
-            "overall_status": overall_status,
-            "components": components,
-            "performance": performance,
-            "capacity": capacity,
-            "alerts": alerts,
-            "recommendations": [
-                "Consider scaling up VM capacity" if capacity["vm_capacity_used_percentage"] > 75 else None,
-                "Monitor error rates closely" if performance["error_rate_percentage"] > 0.03 else None,
-                "Storage cleanup recommended" if capacity["storage_used_percentage"] > 70 else None
-            ],
-            "last_updated": datetime.utcnow().isoformat() + "Z",
-            "next_update": (datetime.utcnow() + timedelta(minutes=5)).isoformat() + "Z"
-        }
+        # Only the first request before the refresher has run builds a snapshot itself
+        entry = _system_health or await _refresh_system_health()
+        return _cached_response(request, entry)
         
     except Exception as e:
         logger.error(f"Error fetching system health: {e}")
@@ -1,150 +1,85 @@
-from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi import APIRouter, status, Depends, Response
+from fastapi.responses import ORJSONResponse
 from typing import List
 from database import db
+from response_cache import project_list_cache, invalidate_user_lists
 from models import ProjectCreate, ProjectUpdate, ProjectResponse, ProjectWithVMs, UserResponse, APIResponse, VMResponse
 from auth import get_current_active_user
 from services.service_container import service_container
-from services.base_service import ServiceError, ValidationError, NotFoundError
+from services.project_service import ProjectService
+from middleware.error_handler import service_errors_to_http
 import logging
+import orjson
 
 logger = logging.getLogger(__name__)
 
-router = APIRouter(prefix="/projects", tags=["Projects"])
+router = APIRouter(prefix="/projects", tags=["Projects"], default_response_class=ORJSONResponse)
+
+async def get_project_service() -> ProjectService:
+    """Resolve the shared project service; async so FastAPI does not dispatch it to the threadpool"""
+    return service_container.get_project_service()
 
 @router.post("/", response_model=ProjectResponse, status_code=status.HTTP_201_CREATED)
+@service_errors_to_http("Internal server error during project creation")
 async def create_project(
     project_data: ProjectCreate,
-    current_user: UserResponse = Depends(get_current_active_user)
+    current_user: UserResponse = Depends(get_current_active_user),
+    project_service: ProjectService = Depends(get_project_service)
 ):
     """Create a new project"""
-    try:
-        project_service = service_container.get_project_service()
-        return await project_service.create_project(project_data, current_user.id)
-        
-    except ValidationError as e:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=e.message
-        )
-    except ServiceError as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=e.message
-        )
-    except Exception as e:
-        logger.error(f"Project creation error: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Internal server error during project creation"
-        )
+    project = await project_service.create_project(project_data, current_user.id)
+    invalidate_user_lists(current_user.id)
+    return project
 
-@router.get("/", response_model=List[ProjectResponse])
-async def get_projects(current_user: UserResponse = Depends(get_current_active_user)):
+# Rendered once per user until a mutation invalidates it, with no response_model revalidation
+@router.get("/", responses={200: {"model": List[ProjectResponse]}})
+@service_errors_to_http("Failed to fetch projects")
+async def get_projects(
+    current_user: UserResponse = Depends(get_current_active_user),
+    project_service: ProjectService = Depends(get_project_service)
+):
     """Get all projects for the current user"""
-    try:
-        project_service = service_container.get_project_service()
-        return await project_service.get_user_projects(current_user.id)
-        
-    except ServiceError as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=e.message
-        )
-    except Exception as e:
-        logger.error(f"Error fetching projects: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to fetch projects"
-        )
+    body = project_list_cache.get(current_user.id)
+    if body is None:
+        projects = await project_service.get_user_projects(current_user.id)
+        body = project_list_cache[current_user.id] = orjson.dumps([project.model_dump(mode="json") for project in projects])
+    return Response(content=body, media_type="application/json")
 
 @router.get("/{project_id}", response_model=ProjectWithVMs)
+@service_errors_to_http("Failed to fetch project")
 async def get_project(
     project_id: str,
-    current_user: UserResponse = Depends(get_current_active_user)
+    current_user: UserResponse = Depends(get_current_active_user),
+    project_service: ProjectService = Depends(get_project_service)
 ):
     """Get a specific project with its VMs"""
-    try:
-        project_service = service_container.get_project_service()
-        return await project_service.get_project(project_id, current_user.id, include_vms=True)
-        
-    except NotFoundError as e:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=e.message
-        )
-    except ServiceError as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=e.message
-        )
-    except Exception as e:
-        logger.error(f"Error fetching project: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to fetch project"
-        )
+    return await project_service.get_project(project_id, current_user.id, include_vms=True)
 
 @router.put("/{project_id}", response_model=ProjectResponse)
+@service_errors_to_http("Failed to update project")
 async def update_project(
     project_id: str,
     project_data: ProjectUpdate,
-    current_user: UserResponse = Depends(get_current_active_user)
+    current_user: UserResponse = Depends(get_current_active_user),
+    project_service: ProjectService = Depends(get_project_service)
 ):
     """Update a project"""
-    try:
-        project_service = service_container.get_project_service()
-        return await project_service.update_project(project_id, project_data, current_user.id)
-        
-    except NotFoundError as e:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=e.message
-        )
-    except ValidationError as e:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=e.message
-        )
-    except ServiceError as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=e.message
-        )
-    except Exception as e:
-        logger.error(f"Error updating project: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to update project"
-        )
+    project = await project_service.update_project(project_id, project_data, current_user.id)
+    invalidate_user_lists(current_user.id)
+    return project
 
 @router.delete("/{project_id}", response_model=APIResponse)
+@service_errors_to_http("Failed to delete project")
 async def delete_project(
     project_id: str,
-    current_user: UserResponse = Depends(get_current_active_user)
+    current_user: UserResponse = Depends(get_current_active_user),
+    project_service: ProjectService = Depends(get_project_service)
 ):
     """Delete a project and all its VMs"""
-    try:
-        project_service = service_container.get_project_service()
-        result = await project_service.delete_project(project_id, current_user.id)
-        
-        return APIResponse(
-            success=result["success"],
-            message=result["message"]
-        )
-        
-    except NotFoundError as e:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=e.message
-        )
-    except ServiceError as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=e.message
-        )
-    except Exception as e:
-        logger.error(f"Error deleting project: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to delete project"
-        )
\ No newline at end of file
+    result = await project_service.delete_project(project_id, current_user.id)
+    invalidate_user_lists(current_user.id)
+    
+    return APIResponse.model_construct(
+        success=result["success"],
+        message=result["message"]
+    )
\ No newline at end of file
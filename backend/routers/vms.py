@@ -1,17 +1,69 @@
-from fastapi import APIRouter, HTTPException, status, Depends
+from fastapi import APIRouter, status, Depends, Response, BackgroundTasks
+from fastapi.responses import ORJSONResponse
 from typing import List
 from database import db
-from models import VMCreate, VMResponse, UserResponse, APIResponse, VMStatus
+from response_cache import vm_list_cache, invalidate_user_lists
+from models import VMCreate, VMResponse, UserResponse, APIResponse, VMStatus, INSTANCE_SPECS
 from auth import get_current_active_user
 from services.service_container import service_container
-from services.base_service import ServiceError, ValidationError, NotFoundError, InsufficientCreditsError
+from services.vm_service import VMService
+from services.base_service import ServiceError
+from middleware.error_handler import service_errors_to_http
 import logging
-import random
+import orjson
 
 logger = logging.getLogger(__name__)
 
-router = APIRouter(prefix="/vms", tags=["Virtual Machines"])
+router = APIRouter(prefix="/vms", tags=["Virtual Machines"], default_response_class=ORJSONResponse)
 
+async def get_vm_service() -> VMService:
+    """Dependency returning the container's VM service"""
+    return service_container.get_vm_service()
+
+async def _apply_state_change(operation, vm_id: str, user_id: str):
+    """Run a queued power operation, logging failures since the client already has its response"""
+    try:
+        await operation(vm_id, user_id)
+    except ServiceError as e:
+        logger.error(f"Queued {operation.__name__} failed for VM {vm_id}: {e.message}")
+    except Exception as e:
+        logger.error(f"Queued {operation.__name__} failed for VM {vm_id}: {e}")
+    finally:
+        invalidate_user_lists(user_id)
+
+# Pricing only changes with INSTANCE_SPECS, i.e. between deploys
+_PRICING_RESPONSE = {
+    "pricing": {
+        instance_type.value: specs["cost_per_hour"]
+        for instance_type, specs in INSTANCE_SPECS.items()
+    },
+    "currency": "USD",
+    "billing": "per_hour",
+    "description": "Pricing is charged per hour of usage",
+    "specifications": {
+        instance_type.value: {
+            "cpu": specs["cpu"],
+            "ram": specs["ram"],
+            "storage": specs["storage"]
+        }
+        for instance_type, specs in INSTANCE_SPECS.items()
+    },
+    "billing_details": {
+        "minimum_charge": "1 minute",
+        "billing_increment": "per minute",
+        "creation_fee": "One-time $0.01 per VM",
+        "stopped_vm_charge": "$0.00/hour",
+        "currency": "USD",
+        "tax_inclusive": False
+    },
+    "cost_optimization": {
+        "stop_when_unused": "Stop VMs to avoid hourly charges",
+        "right_sizing": "Choose appropriate instance type for workload",
+        "monitoring": "Use /vms/{id}/metrics to track usage",
+        "project_tracking": "Organize VMs in projects for cost visibility"
+    }
+}
+_PRICING_BYTES = orjson.dumps(_PRICING_RESPONSE)
 
 
 @router.post("/", 
@@ -73,9 +125,11 @@ router = APIRouter(prefix="/vms", tags=["Virtual Machines"])
                      "description": "Authentication required"
                  }
              })
+@service_errors_to_http("Internal server error during VM creation")
 async def create_vm(
     vm_data: VMCreate,
-    current_user: UserResponse = Depends(get_current_active_user)
+    current_user: UserResponse = Depends(get_current_active_user),
+    vm_service: VMService = Depends(get_vm_service)
 ):
     """
     Create a new virtual machine in a project.
@@ -124,210 +178,87 @@ async def create_vm(
     
     **Rate Limit:** 10 requests per minute per user
     """
-    try:
-        vm_service = service_container.get_vm_service()
-        return await vm_service.create_vm(vm_data, current_user)
-        
-    except ValidationError as e:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=e.message
-        )
-    except NotFoundError as e:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=e.message
-        )
-    except InsufficientCreditsError as e:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=e.message
-        )
-    except ServiceError as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=e.message
-        )
-    except Exception as e:
-        logger.error(f"VM creation error: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Internal server error during VM creation"
-        )
+    vm = await vm_service.create_vm(vm_data, current_user)
+    invalidate_user_lists(current_user.id)
+    return vm
 
-@router.get("/", response_model=List[VMResponse])
-async def get_vms(current_user: UserResponse = Depends(get_current_active_user)):
+# Rendered once per user until a mutation invalidates it, with no response_model revalidation
+@router.get("/", responses={200: {"model": List[VMResponse]}})
+@service_errors_to_http("Failed to fetch VMs")
+async def get_vms(
+    current_user: UserResponse = Depends(get_current_active_user),
+    vm_service: VMService = Depends(get_vm_service)
+):
     """Get all VMs for the current user"""
-    try:
-        vm_service = service_container.get_vm_service()
-        return await vm_service.get_user_vms(current_user.id)
-        
-    except ServiceError as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=e.message
-        )
-    except Exception as e:
-        logger.error(f"Error fetching VMs: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to fetch VMs"
-        )
+    body = vm_list_cache.get(current_user.id)
+    if body is None:
+        vms = await vm_service.get_user_vms(current_user.id)
+        body = vm_list_cache[current_user.id] = orjson.dumps([vm.model_dump(mode="json") for vm in vms])
+    return Response(content=body, media_type="application/json")
 
 @router.get("/{vm_id}", response_model=VMResponse)
+@service_errors_to_http("Failed to fetch VM")
 async def get_vm(
     vm_id: str,
-    current_user: UserResponse = Depends(get_current_active_user)
+    current_user: UserResponse = Depends(get_current_active_user),
+    vm_service: VMService = Depends(get_vm_service)
 ):
     """Get a specific VM"""
-    try:
-        vm_service = service_container.get_vm_service()
-        return await vm_service.get_vm(vm_id, current_user.id)
-        
-    except NotFoundError as e:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=e.message
-        )
-    except ServiceError as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=e.message
-        )
-    except Exception as e:
-        logger.error(f"Error fetching VM: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to fetch VM"
-        )
+    return await vm_service.get_vm(vm_id, current_user.id)
 
 @router.post("/{vm_id}/start", response_model=APIResponse)
+@service_errors_to_http("Failed to start VM")
 async def start_vm(
     vm_id: str,
-    current_user: UserResponse = Depends(get_current_active_user)
+    background_tasks: BackgroundTasks,
+    current_user: UserResponse = Depends(get_current_active_user),
+    vm_service: VMService = Depends(get_vm_service)
 ):
     """Start a stopped VM"""
-    try:
-        vm_service = service_container.get_vm_service()
-        return await vm_service.start_vm(vm_id, current_user.id)
-        
-    except NotFoundError as e:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=e.message
-        )
-    except ValidationError as e:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=e.message
-        )
-    except ServiceError as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=e.message
-        )
-    except Exception as e:
-        logger.error(f"Error starting VM: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to start VM"
-        )
+    # Reject bad requests up front, then apply the change after responding
+    await vm_service.check_state_change(vm_id, current_user.id, "start")
+    background_tasks.add_task(_apply_state_change, vm_service.start_vm, vm_id, current_user.id)
+    return vm_service.create_success_response("VM start queued")
 
 @router.post("/{vm_id}/stop", response_model=APIResponse)
+@service_errors_to_http("Failed to stop VM")
 async def stop_vm(
     vm_id: str,
-    current_user: UserResponse = Depends(get_current_active_user)
+    background_tasks: BackgroundTasks,
+    current_user: UserResponse = Depends(get_current_active_user),
+    vm_service: VMService = Depends(get_vm_service)
 ):
     """Stop a running VM"""
-    try:
-        vm_service = service_container.get_vm_service()
-        return await vm_service.stop_vm(vm_id, current_user.id)
-        
-    except NotFoundError as e:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=e.message
-        )
-    except ValidationError as e:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=e.message
-        )
-    except ServiceError as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=e.message
-        )
-    except Exception as e:
-        logger.error(f"Error stopping VM: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to stop VM"
-        )
+    # Reject bad requests up front, then apply the change after responding
+    await vm_service.check_state_change(vm_id, current_user.id, "stop")
+    background_tasks.add_task(_apply_state_change, vm_service.stop_vm, vm_id, current_user.id)
+    return vm_service.create_success_response("VM stop queued")
 
 @router.post("/{vm_id}/restart", response_model=APIResponse)
+@service_errors_to_http("Failed to restart VM")
 async def restart_vm(
     vm_id: str,
-    current_user: UserResponse = Depends(get_current_active_user)
+    background_tasks: BackgroundTasks,
+    current_user: UserResponse = Depends(get_current_active_user),
+    vm_service: VMService = Depends(get_vm_service)
 ):
     """Restart a VM (stop then start)"""
-    try:
-        vm_service = service_container.get_vm_service()
-        return await vm_service.restart_vm(vm_id, current_user.id)
-        
-    except NotFoundError as e:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=e.message
-        )
-    except ValidationError as e:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=e.message
-        )
-    except ServiceError as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=e.message
-        )
-    except Exception as e:
-        logger.error(f"Error restarting VM: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to restart VM"
-        )
+    # Reject bad requests up front, then apply the change after responding
+    await vm_service.check_state_change(vm_id, current_user.id, "restart")
+    background_tasks.add_task(_apply_state_change, vm_service.restart_vm, vm_id, current_user.id)
+    return vm_service.create_success_response("VM restart queued")
 
 @router.delete("/{vm_id}", response_model=APIResponse)
+@service_errors_to_http("Failed to delete VM")
 async def delete_vm(
     vm_id: str,
-    current_user: UserResponse = Depends(get_current_active_user)
+    current_user: UserResponse = Depends(get_current_active_user),
+    vm_service: VMService = Depends(get_vm_service)
 ):
     """Delete/terminate a VM"""
-    try:
-        vm_service = service_container.get_vm_service()
-        return await vm_service.delete_vm(vm_id, current_user.id)
-        
-    except NotFoundError as e:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=e.message
-        )
-    except ValidationError as e:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail=e.message
-        )
-    except ServiceError as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=e.message
-        )
-    except Exception as e:
-        logger.error(f"Error deleting VM: {e}")
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail="Failed to delete VM"
-        )
+    result = await vm_service.delete_vm(vm_id, current_user.id)
+    invalidate_user_lists(current_user.id)
+    return result
 
 @router.get("/pricing/info",
            summary="Get VM Pricing Information",
@@ -419,39 +350,5 @@ async def get_vm_pricing():
     
     **No authentication required** - This is a public pricing endpoint.
     """
-    from models import INSTANCE_SPECS
-    
-    # Extract pricing from instance specs
-    pricing = {
-        instance_type.value: specs["cost_per_hour"] 
-        for instance_type, specs in INSTANCE_SPECS.items()
-    }
-    
-    return {
-        "pricing": pricing,
-        "currency": "USD",
-        "billing": "per_hour",
-        "description": "Pricing is charged per hour of usage",
-        "specifications": {
-            instance_type.value: {
-                "cpu": specs["cpu"],
-                "ram": specs["ram"],
-                "storage": specs["storage"]
-            }
-            for instance_type, specs in INSTANCE_SPECS.items()
-        },
-        "billing_details": {
-            "minimum_charge": "1 minute",
-            "billing_increment": "per minute", 
-            "creation_fee": "One-time $0.01 per VM",
-            "stopped_vm_charge": "$0.00/hour",
-            "currency": "USD",
-            "tax_inclusive": False
-        },
-        "cost_optimization": {
-            "stop_when_unused": "Stop VMs to avoid hourly charges",
-            "right_sizing": "Choose appropriate instance type for workload",
-            "monitoring": "Use /vms/{id}/metrics to track usage",
-            "project_tracking": "Organize VMs in projects for cost visibility"
-        }
-    }
\ No newline at end of file
+    # Static for the life of the process, so the encoded body is reused as-is
+    return Response(content=_PRICING_BYTES, media_type="application/json")
\ No newline at end of file
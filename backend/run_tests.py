@@ -7,9 +7,18 @@ Provides convenient ways to run different test suites
 import sys
 import subprocess
 import argparse
+import importlib.util
 import os
 from pathlib import Path
 
+PYTEST_COMMAND = ["python", "-m", "pytest"]
+
+def xdist_args():
+    """Spread tests across CPUs by module when pytest-xdist is installed"""
+    if importlib.util.find_spec("xdist") is None:
+        return []
+    return ["-n", "auto", "--dist", "loadfile"]
+
 def run_command(cmd, description):
     """Run a command and handle the result"""
     print(f"\n{'='*60}")
@@ -17,6 +26,21 @@ def run_command(cmd, description):
     print(f"Command: {' '.join(cmd)}")
     print(f"{'='*60}")
     
+    # Run pytest in this interpreter to skip a second Python startup
+    if cmd[:3] == PYTEST_COMMAND:
+        try:
+            import pytest
+        except ImportError:
+            print("\n❌ Pytest not available. Install with: pip install pytest")
+            return False
+        
+        exit_code = pytest.main(cmd[3:])
+        if exit_code == 0:
+            print(f"\n✅ {description} completed successfully")
+            return True
+        print(f"\n❌ {description} failed with exit code {int(exit_code)}")
+        return False
+    
     try:
         result = subprocess.run(cmd, check=True, capture_output=False)
         print(f"\n✅ {description} completed successfully")
@@ -68,7 +92,7 @@ def main():
     os.chdir(backend_dir)
     
     # Base pytest command
-    cmd = ["python", "-m", "pytest"]
+    cmd = list(PYTEST_COMMAND)
     
     # Add verbosity
     if args.verbose:
@@ -122,7 +146,7 @@ def run_quick_tests():
         "tests/test_api_documentation.py::TestAPIDocumentation::test_openapi_schema_generation"
     ]
     
-    cmd = ["python", "-m", "pytest", "-v"] + quick_tests
+    cmd = PYTEST_COMMAND + ["-v"] + xdist_args() + quick_tests
     return run_command(cmd, "Quick development tests")
 
 def run_smoke_tests():
@@ -136,7 +160,7 @@ def run_smoke_tests():
         "tests/test_integration.py::TestUserWorkflow::test_complete_user_journey"
     ]
     
-    cmd = ["python", "-m", "pytest", "-v"] + smoke_tests
+    cmd = PYTEST_COMMAND + ["-v"] + xdist_args() + smoke_tests
     return run_command(cmd, "Smoke tests")
 
 def check_test_environment():
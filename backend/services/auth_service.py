@@ -1,15 +1,32 @@
 from typing import Optional, Dict, Any
 from datetime import datetime, timedelta
 from fastapi import HTTPException, status
+from postgrest.exceptions import APIError
 from models import UserSignup, UserLogin, UserUpdate, Token, UserResponse, UserRole
 from .base_service import BaseService, ServiceError, ValidationError, NotFoundError
+from .user_service import USER_STATS_SQL
 from auth import (
-    verify_password, get_password_hash, create_access_token, create_refresh_token,
-    check_rate_limit, record_failed_login, clear_failed_login
+    verify_password, get_password_hash, password_needs_rehash, create_access_token, create_refresh_token,
+    check_rate_limit, record_failed_login, clear_failed_login, invalidate_cached_user,
+    get_cached_user_record, cache_user_record
 )
 from config import settings
 import re
 
+# Access token lifetime, fixed for the life of the process
+ACCESS_TOKEN_TTL = timedelta(minutes=settings.access_token_expire_minutes)
+ACCESS_TOKEN_TTL_SECONDS = settings.access_token_expire_minutes * 60
+
+# PostgreSQL unique_violation, raised when the email is already registered
+UNIQUE_VIOLATION = "23505"
+
+# Signup field rules, compiled once at import
+LETTER_PATTERN = re.compile(r'[A-Za-z]')
+DIGIT_PATTERN = re.compile(r'\d')
+# Both classes in one anchored match; the single patterns only pick the error message
+PASSWORD_CLASSES_PATTERN = re.compile(r'(?=.*?[A-Za-z])(?=.*?\d)', re.S)
+NAME_PATTERN = re.compile(r"^[a-zA-Z\s\-']+$")
+
 class AuthService(BaseService):
     """Authentication service handling user registration, login, and profile management"""
     
@@ -19,12 +36,11 @@ class AuthService(BaseService):
             # Validate input
             await self._validate_signup_data(user_data)
             
-            # Check if user already exists
-            if await self._user_exists(user_data.email):
-                raise ValidationError("Email already registered")
+            # One timestamp for the whole signup
+            now = datetime.utcnow()
             
             # Hash password and create user record
-            hashed_password = get_password_hash(user_data.password)
+            hashed_password = await self.run_in_hash_pool(get_password_hash, user_data.password)
             
             user_record = {
                 "id": self.generate_id(),
@@ -38,21 +54,20 @@ class AuthService(BaseService):
                 "active_vm_count": 0,
                 "is_active": True,
                 "role": UserRole.USER.value,
-                "created_at": datetime.utcnow(),
+                "created_at": now,
                 "updated_at": None,
                 "last_login": None
             }
             
-            # Save user to database
+            # Save user to database; the unique email constraint rejects duplicates
             created_user = await self._create_user(user_record)
             if not created_user:
                 raise ServiceError("Failed to create user account", "USER_CREATION_FAILED")
             
             # Create access token
-            access_token_expires = timedelta(minutes=settings.access_token_expire_minutes)
             access_token = create_access_token(
                 data={"sub": created_user["email"]}, 
-                expires_delta=access_token_expires
+                expires_delta=ACCESS_TOKEN_TTL
             )
             
             # Log audit event
@@ -61,14 +76,15 @@ class AuthService(BaseService):
                 action="user_signup",
                 resource_type="users",
                 resource_id=created_user["id"],
-                details={"email": user_data.email, "name": user_data.name}
+                details={"email": user_data.email, "name": user_data.name},
+                now=now
             )
             
-            user_response = UserResponse(**created_user)
+            user_response = self.build_user_response(created_user)
             
             return Token(
                 access_token=access_token,
-                expires_in=settings.access_token_expire_minutes * 60,
+                expires_in=ACCESS_TOKEN_TTL_SECONDS,
                 user=user_response
             )
             
@@ -90,12 +106,10 @@ class AuthService(BaseService):
             
             # Get user from database
             user_record = await self._get_user_by_email(user_data.email)
-            if not user_record:
-                record_failed_login(user_data.email)
-                raise ValidationError("Invalid email or password")
             
-            # Verify password
-            if not verify_password(user_data.password, user_record["hashed_password"]):
+            # Verify password, spending the same hashing time when the email is unknown
+            hashed_password = user_record["hashed_password"] if user_record else None
+            if not await self.run_in_hash_pool(verify_password, user_data.password, hashed_password) or not user_record:
                 record_failed_login(user_data.email)
                 raise ValidationError("Invalid email or password")
             
@@ -105,15 +119,19 @@ class AuthService(BaseService):
             
             # Clear failed login attempts
             clear_failed_login(user_data.email)
+            now = datetime.utcnow()
+            
+            # Move bcrypt hashes over to Argon2id while the plaintext is at hand
+            if password_needs_rehash(user_record["hashed_password"]):
+                await self._update_user(user_record["id"], {"hashed_password": await self.run_in_hash_pool(get_password_hash, user_data.password)})
             
-            # Update last login timestamp
-            await self._update_last_login(user_record["id"])
+            # Update last login timestamp after responding; it never fails the login
+            self.run_in_background(self._update_last_login(user_record["id"], now))
             
             # Create access token
-            access_token_expires = timedelta(minutes=settings.access_token_expire_minutes)
             access_token = create_access_token(
                 data={"sub": user_record["email"]}, 
-                expires_delta=access_token_expires
+                expires_delta=ACCESS_TOKEN_TTL
             )
             
             # Log audit event
@@ -122,14 +140,15 @@ class AuthService(BaseService):
                 action="user_login",
                 resource_type="users",
                 resource_id=user_record["id"],
-                details={"email": user_data.email}
+                details={"email": user_data.email},
+                now=now
             )
             
-            user_response = UserResponse(**user_record)
+            user_response = self.build_user_response(user_record)
             
             return Token(
                 access_token=access_token,
-                expires_in=settings.access_token_expire_minutes * 60,
+                expires_in=ACCESS_TOKEN_TTL_SECONDS,
                 user=user_response
             )
             
@@ -150,7 +169,7 @@ class AuthService(BaseService):
             stats = await self._calculate_user_stats(user_id)
             user_record.update(stats)
             
-            return UserResponse(**user_record)
+            return self.build_user_response(user_record)
             
         except ServiceError:
             raise
@@ -170,15 +189,16 @@ class AuthService(BaseService):
             if not user_record:
                 raise NotFoundError("User", user_id)
             
-            # Prepare update data
+            # Prepare update data, skipping fields that already hold the requested value
             update_data = {}
-            if updates.name is not None:
+            if updates.name is not None and updates.name != user_record.get("name"):
                 update_data["name"] = updates.name
             
             if not update_data:
-                return UserResponse(**user_record)
+                return self.build_user_response(user_record)
             
-            update_data["updated_at"] = datetime.utcnow()
+            now = datetime.utcnow()
+            update_data["updated_at"] = now
             
             # Update user in database
             updated_user = await self._update_user(user_id, update_data)
@@ -191,10 +211,11 @@ class AuthService(BaseService):
                 action="profile_update",
                 resource_type="users",
                 resource_id=user_id,
-                details=update_data
+                details=update_data,
+                now=now
             )
             
-            return UserResponse(**updated_user)
+            return self.build_user_response(updated_user)
             
         except ServiceError:
             raise
@@ -244,10 +265,9 @@ class AuthService(BaseService):
         if len(user_data.password) < 8:
             raise ValidationError("Password must be at least 8 characters long")
         
-        if not re.search(r'[A-Za-z]', user_data.password):
-            raise ValidationError("Password must contain at least one letter")
-        
-        if not re.search(r'\d', user_data.password):
+        if not PASSWORD_CLASSES_PATTERN.match(user_data.password):
+            if not LETTER_PATTERN.search(user_data.password):
+                raise ValidationError("Password must contain at least one letter")
             raise ValidationError("Password must contain at least one number")
     
     async def _validate_name(self, name: str):
@@ -255,21 +275,23 @@ class AuthService(BaseService):
         if not name.strip():
             raise ValidationError("Name cannot be empty")
         
-        if not re.match(r"^[a-zA-Z\s\-']+$", name.strip()):
+        if not NAME_PATTERN.match(name.strip()):
             raise ValidationError("Name can only contain letters, spaces, hyphens, and apostrophes")
     
-    async def _user_exists(self, email: str) -> bool:
-        """Check if user exists by email"""
-        user = await self._get_user_by_email(email)
-        return user is not None
-    
     async def _get_user_by_email(self, email: str) -> Optional[Dict[str, Any]]:
         """Get user by email"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
+            supabase = self.db.get_client()
+            if supabase:
+                cached_record = get_cached_user_record(email)
+                if cached_record is not None:
+                    return cached_record
+                
                 result = supabase.table("users").select("*").eq("email", email).execute()
-                return result.data[0] if result.data else None
+                if not result.data:
+                    return None
+                cache_user_record(result.data[0])
+                return result.data[0]
             else:
                 memory_store = self.db.get_memory_store()
                 return memory_store["users"].get(email)
@@ -280,16 +302,13 @@ class AuthService(BaseService):
     async def _get_user_by_id(self, user_id: str) -> Optional[Dict[str, Any]]:
         """Get user by ID"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
+            supabase = self.db.get_client()
+            if supabase:
                 result = supabase.table("users").select("*").eq("id", user_id).execute()
                 return result.data[0] if result.data else None
             else:
                 memory_store = self.db.get_memory_store()
-                for user_data in memory_store["users"].values():
-                    if user_data.get("id") == user_id:
-                        return user_data
-                return None
+                return memory_store["users_by_id"].get(user_id)
         except Exception as e:
             self.logger.error(f"Error getting user by ID: {e}")
             return None
@@ -297,40 +316,56 @@ class AuthService(BaseService):
     async def _create_user(self, user_record: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Create user in database"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                result = supabase.table("users").insert(user_record).execute()
+            supabase = self.db.get_client()
+            if supabase:
+                try:
+                    result = supabase.table("users").insert(self.json_ready(user_record)).execute()
+                except APIError as e:
+                    if e.code == UNIQUE_VIOLATION:
+                        raise ValidationError("Email already registered")
+                    raise
                 return result.data[0] if result.data else None
             else:
                 memory_store = self.db.get_memory_store()
+                if user_record["email"] in memory_store["users"]:
+                    raise ValidationError("Email already registered")
                 memory_store["users"][user_record["email"]] = user_record
+                memory_store["users_by_id"][user_record["id"]] = user_record
                 return user_record
+        except ValidationError:
+            raise
         except Exception as e:
             self.logger.error(f"Error creating user: {e}")
             return None
     
     async def _update_user(self, user_id: str, update_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Update user in database"""
+        # A bare last_login change leaves cached sessions valid; the fresh row is re-cached below
+        if update_data.keys() - {"last_login"}:
+            invalidate_cached_user(user_id)
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                result = supabase.table("users").update(update_data).eq("id", user_id).execute()
-                return result.data[0] if result.data else None
+            supabase = self.db.get_client()
+            if supabase:
+                result = supabase.table("users").update(self.json_ready(update_data)).eq("id", user_id).execute()
+                if not result.data:
+                    return None
+                # The updated row is current, so keep it for the next login
+                cache_user_record(result.data[0])
+                return result.data[0]
             else:
                 memory_store = self.db.get_memory_store()
-                for email, user_data in memory_store["users"].items():
-                    if user_data.get("id") == user_id:
-                        user_data.update(update_data)
-                        return user_data
-                return None
+                user_data = memory_store["users_by_id"].get(user_id)
+                if user_data:
+                    user_data.update(update_data)
+                return user_data
         except Exception as e:
             self.logger.error(f"Error updating user: {e}")
             return None
     
-    async def _update_last_login(self, user_id: str):
+    async def _update_last_login(self, user_id: str, now: Optional[datetime] = None):
         """Update user's last login timestamp"""
         try:
-            await self._update_user(user_id, {"last_login": datetime.utcnow()})
+            await self._update_user(user_id, {"last_login": now or datetime.utcnow()})
         except Exception as e:
             self.logger.warning(f"Failed to update last login for user {user_id}: {e}")
     
@@ -344,42 +379,36 @@ class AuthService(BaseService):
                 "total_spent": 0.0
             }
             
-            if self.db.get_client():
+            # All four aggregates come from get_user_stats in one round-trip, summed in Postgres
+            if self.db.pg_enabled:
+                result = await self.db.execute_query(USER_STATS_SQL, [user_id], fetch_mode="one")
+                if result.rows:
+                    stats.update(result.rows[0])
+            elif self.db.get_client():
                 supabase = self.db.get_client()
-                
-                # Count VMs
-                vm_result = supabase.table("vms").select("*", count="exact").eq("user_id", user_id).execute()
-                stats["vm_count"] = vm_result.count or 0
-                
-                # Count active VMs
-                active_vm_result = supabase.table("vms").select("*", count="exact").eq("user_id", user_id).eq("status", "running").execute()
-                stats["active_vm_count"] = active_vm_result.count or 0
-                
-                # Count projects
-                project_result = supabase.table("projects").select("*", count="exact").eq("user_id", user_id).execute()
-                stats["project_count"] = project_result.count or 0
-                
-                # Calculate total spent
-                billing_result = supabase.table("billing_records").select("amount").eq("user_id", user_id).execute()
-                if billing_result.data:
-                    stats["total_spent"] = sum(float(record["amount"]) for record in billing_result.data if float(record["amount"]) > 0)
+                result = supabase.rpc("get_user_stats", {"uid": user_id}).execute()
+                if result.data:
+                    row = result.data[0]
+                    stats["vm_count"] = int(row["vm_count"] or 0)
+                    stats["active_vm_count"] = int(row["active_vm_count"] or 0)
+                    stats["project_count"] = int(row["project_count"] or 0)
+                    stats["total_spent"] = float(row["total_spent"] or 0.0)
             else:
                 memory_store = self.db.get_memory_store()
                 
-                # Count VMs
-                stats["vm_count"] = len([vm for vm in memory_store["vms"] if vm.get("user_id") == user_id])
-                
-                # Count active VMs
-                stats["active_vm_count"] = len([vm for vm in memory_store["vms"] if vm.get("user_id") == user_id and vm.get("status") == "running"])
+                # Count VMs and active VMs in one pass
+                for vm in memory_store["vms"]:
+                    if vm.get("user_id") == user_id:
+                        stats["vm_count"] += 1
+                        if vm.get("status") == "running":
+                            stats["active_vm_count"] += 1
                 
                 # Count projects
-                stats["project_count"] = len([project for project in memory_store["projects"] if project.get("user_id") == user_id])
+                stats["project_count"] = sum(1 for project in memory_store["projects"] if project.get("user_id") == user_id)
                 
-                # Calculate total spent
-                stats["total_spent"] = sum(
-                    float(record["amount"]) for record in memory_store["billing_records"]
-                    if record.get("user_id") == user_id and float(record["amount"]) > 0
-                )
+                # Calculate total spent, converting each amount once
+                amounts = (float(record["amount"]) for record in memory_store["billing_by_user"].get(user_id, []))
+                stats["total_spent"] = sum(amount for amount in amounts if amount > 0)
             
             return stats
         except Exception as e:
@@ -1,11 +1,52 @@
 from abc import ABC, abstractmethod
-from typing import Optional, Dict, Any, List, Union
-from datetime import datetime
+from typing import Optional, Dict, Any, List, Union, Callable, TypeVar, Set, Coroutine
+from datetime import date, datetime
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import logging
+import os
+import secrets
+import time
 from database import db, DatabaseError
-from models import APIResponse, ErrorResponse
+from auth import invalidate_cached_user
+from models import APIResponse, ErrorResponse, UserResponse, UserRole
 import uuid
 
+T = TypeVar("T")
+
+# users.credits is the running balance, kept current by apply_credit_delta
+USER_CREDITS_SQL = "SELECT credits::float8 FROM users WHERE id = $1::uuid"
+
+# Audit records are written to Supabase in batches by a background task
+AUDIT_BATCH_SIZE = 100
+AUDIT_FLUSH_INTERVAL_SECONDS = 0.5
+_audit_queue: Optional["asyncio.Queue[Dict[str, Any]]"] = None
+_audit_writer_task: Optional[asyncio.Task] = None
+_audit_logger = logging.getLogger("AuditLogWriter")
+
+# Strong references to fire-and-forget tasks so they are not garbage collected mid-flight
+_background_tasks: Set[asyncio.Task] = set()
+
+# Random bits for IDs are read from the OS a page at a time, 10 bytes per ID
+_ID_ENTROPY_BYTES = 4096
+_id_entropy = b""
+_id_entropy_offset = 0
+
+def uuid7() -> uuid.UUID:
+    """Time-ordered UUID (RFC 9562 version 7): a millisecond timestamp followed by random bits"""
+    global _id_entropy, _id_entropy_offset
+    if _id_entropy_offset + 10 > len(_id_entropy):
+        _id_entropy = secrets.token_bytes(_ID_ENTROPY_BYTES)
+        _id_entropy_offset = 0
+    random_bits = int.from_bytes(_id_entropy[_id_entropy_offset:_id_entropy_offset + 10], "big")
+    _id_entropy_offset += 10
+    
+    value = (time.time_ns() // 1_000_000 & 0xFFFF_FFFF_FFFF) << 80 | random_bits
+    # Overwrite the version nibble and variant bits
+    value = value & ~(0xF << 76) | (0x7 << 76)
+    value = value & ~(0x3 << 62) | (0x2 << 62)
+    return uuid.UUID(int=value)
+
 class ServiceError(Exception):
     """Base service error"""
     def __init__(self, message: str, error_code: str = "SERVICE_ERROR", details: Optional[Dict[str, Any]] = None):
@@ -36,35 +77,90 @@ class InsufficientCreditsError(ServiceError):
 class BaseService(ABC):
     """Base service class with common functionality"""
     
+    # argon2-cffi releases the GIL while hashing, so worker threads hash on every core
+    _hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="password-hash")
+    
     def __init__(self):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.db = db
     
     def generate_id(self) -> str:
-        """Generate a unique UUID"""
-        return str(uuid.uuid4())
+        """Generate a unique, time-ordered UUID so new rows append to the primary key index"""
+        return str(uuid7())
+    
+    @staticmethod
+    def json_ready(payload: Any) -> Any:
+        """Replace the datetime and UUID values httpx's JSON encoder rejects with ISO strings and text
+        
+        Everything else is passed through untouched; the payload is only serialised once, by the client.
+        """
+        if isinstance(payload, dict):
+            return {key: BaseService.json_ready(value) for key, value in payload.items()}
+        if isinstance(payload, (list, tuple)):
+            return [BaseService.json_ready(value) for value in payload]
+        if isinstance(payload, (datetime, date)):
+            return payload.isoformat()
+        if isinstance(payload, uuid.UUID):
+            return str(payload)
+        return payload
+    
+    def run_in_background(self, coro: Coroutine[Any, Any, Any]) -> asyncio.Task:
+        """Schedule non-critical work without making the caller wait for it"""
+        task = asyncio.create_task(coro)
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+        return task
+    
+    async def run_in_hash_pool(self, func: Callable[..., T], *args: Any) -> T:
+        """Run a CPU-bound password hashing call off the event loop"""
+        return await asyncio.get_running_loop().run_in_executor(self._hash_pool, func, *args)
+    
+    def parse_timestamp(self, value: Any) -> Optional[datetime]:
+        """Coerce an ISO string from Supabase into a datetime, passing datetimes and None through"""
+        if isinstance(value, str):
+            return datetime.fromisoformat(value.replace("Z", "+00:00"))
+        return value
     
-    def create_success_response(self, message: str, data: Optional[Dict[str, Any]] = None) -> APIResponse:
+    def build_user_response(self, user_record: Dict[str, Any]) -> UserResponse:
+        """Build a user response from a database row without re-running validation"""
+        return UserResponse.model_construct(
+            id=str(user_record["id"]),
+            email=user_record["email"],
+            name=user_record["name"],
+            credits=float(user_record.get("credits") or 0.0),
+            total_spent=float(user_record.get("total_spent") or 0.0),
+            vm_count=int(user_record.get("vm_count") or 0),
+            project_count=int(user_record.get("project_count") or 0),
+            active_vm_count=int(user_record.get("active_vm_count") or 0),
+            is_active=bool(user_record.get("is_active", True)),
+            role=UserRole(user_record.get("role") or UserRole.USER.value).value,
+            created_at=self.parse_timestamp(user_record["created_at"]),
+            updated_at=self.parse_timestamp(user_record.get("updated_at")),
+            last_login=self.parse_timestamp(user_record.get("last_login"))
+        )
+    
+    def create_success_response(self, message: str, data: Optional[Dict[str, Any]] = None, now: Optional[datetime] = None) -> APIResponse:
         """Create a success API response"""
-        return APIResponse(
+        # Fields are built here, so skip validation
+        return APIResponse.model_construct(
             success=True,
             message=message,
             data=data,
-            timestamp=datetime.utcnow()
+            timestamp=now or datetime.utcnow()
         )
     
-    def create_error_response(self, error: ServiceError) -> ErrorResponse:
+    def create_error_response(self, error: ServiceError, now: Optional[datetime] = None) -> ErrorResponse:
         """Create an error response from a service error"""
         return ErrorResponse(
             success=False,
             error_code=error.error_code,
             message=error.message,
             details=error.details,
-            timestamp=datetime.utcnow()
+            timestamp=now or datetime.utcnow()
         )
     
-    async def log_audit_event(self, user_id: str, action: str, resource_type: str, resource_id: Optional[str] = None, details: Optional[Dict[str, Any]] = None):
-        """Log an audit event"""
+    async def log_audit_event(self, user_id: str, action: str, resource_type: str, resource_id: Optional[str] = None, details: Optional[Dict[str, Any]] = None, now: Optional[datetime] = None):
+        """Log an audit event, stamped with the caller's request time when given"""
         try:
             audit_record = {
                 "id": self.generate_id(),
@@ -72,14 +168,17 @@ class BaseService(ABC):
                 "action": action,
                 "resource_type": resource_type,
                 "resource_id": resource_id,
-                "details": details,
-                "timestamp": datetime.utcnow().isoformat()
+                "details": self.json_ready(details) if details else details,
+                "timestamp": (now or datetime.utcnow()).isoformat()
             }
             
-            if self.db.get_client():
-                # Supabase implementation
-                supabase = self.db.get_client()
-                supabase.table("audit_logs").insert(audit_record).execute()
+            supabase = self.db.get_client()
+            if supabase:
+                # Supabase implementation, batched when the writer is running
+                if _audit_writer_task is not None and not _audit_writer_task.done():
+                    _audit_queue.put_nowait(audit_record)
+                else:
+                    supabase.table("audit_logs").insert(audit_record).execute()
             else:
                 # In-memory implementation
                 memory_store = self.db.get_memory_store()
@@ -91,8 +190,8 @@ class BaseService(ABC):
     async def validate_user_ownership(self, user_id: str, resource_type: str, resource_id: str) -> bool:
         """Validate that a user owns a specific resource"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
+            supabase = self.db.get_client()
+            if supabase:
                 result = supabase.table(resource_type).select("user_id").eq("id", resource_id).execute()
                 if result.data and result.data[0]["user_id"] == user_id:
                     return True
@@ -121,16 +220,20 @@ class BaseService(ABC):
     async def get_user_credits(self, user_id: str) -> float:
         """Get current user credits"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
+            if self.db.pg_enabled:
+                result = await self.db.execute_query(USER_CREDITS_SQL, [user_id], fetch_mode="val")
+                return float(result.rows[0]["value"]) if result.rows else 0.0
+            
+            supabase = self.db.get_client()
+            if supabase:
                 result = supabase.table("users").select("credits").eq("id", user_id).execute()
                 if result.data:
                     return float(result.data[0]["credits"])
             else:
                 memory_store = self.db.get_memory_store()
-                for user_data in memory_store["users"].values():
-                    if user_data.get("id") == user_id:
-                        return float(user_data.get("credits", 0.0))
+                user_data = memory_store["users_by_id"].get(user_id)
+                if user_data:
+                    return float(user_data.get("credits", 0.0))
             
             return 0.0
         except Exception as e:
@@ -139,17 +242,18 @@ class BaseService(ABC):
     
     async def update_user_credits(self, user_id: str, new_credits: float) -> bool:
         """Update user credits"""
+        invalidate_cached_user(user_id)
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
+            supabase = self.db.get_client()
+            if supabase:
                 result = supabase.table("users").update({"credits": new_credits}).eq("id", user_id).execute()
                 return bool(result.data)
             else:
                 memory_store = self.db.get_memory_store()
-                for user_data in memory_store["users"].values():
-                    if user_data.get("id") == user_id:
-                        user_data["credits"] = new_credits
-                        return True
+                user_data = memory_store["users_by_id"].get(user_id)
+                if user_data:
+                    user_data["credits"] = new_credits
+                    return True
             
             return False
         except Exception as e:
@@ -159,4 +263,57 @@ class BaseService(ABC):
     @abstractmethod
     async def health_check(self) -> Dict[str, Any]:
         """Service-specific health check"""
-        pass
\ No newline at end of file
+        pass
+
+def _insert_audit_batch(batch: List[Dict[str, Any]]):
+    """Write a batch of audit records in one insert"""
+    try:
+        supabase = db.get_client()
+        if supabase:
+            supabase.table("audit_logs").insert(batch).execute()
+    except Exception as e:
+        _audit_logger.warning(f"Failed to write {len(batch)} audit events: {e}")
+
+async def _write_audit_logs_loop(batch_size: int, interval: float):
+    """Collect queued audit records until the batch fills or the interval passes, then insert them"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _audit_queue.get()]
+        deadline = loop.time() + interval
+        try:
+            while len(batch) < batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(_audit_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            # Also runs on cancellation so a partly collected batch is not lost
+            _insert_audit_batch(batch)
+
+def start_audit_log_writer(batch_size: int = AUDIT_BATCH_SIZE, interval: float = AUDIT_FLUSH_INTERVAL_SECONDS):
+    """Start the background audit log writer (called on app startup)"""
+    global _audit_queue, _audit_writer_task
+    if _audit_writer_task is None or _audit_writer_task.done():
+        # Created here so the queue belongs to the running event loop
+        _audit_queue = asyncio.Queue()
+        _audit_writer_task = asyncio.create_task(_write_audit_logs_loop(batch_size, interval))
+
+async def stop_audit_log_writer():
+    """Stop the audit log writer and flush whatever is still queued (called on app shutdown)"""
+    global _audit_writer_task
+    if _audit_writer_task is not None:
+        _audit_writer_task.cancel()
+        try:
+            await _audit_writer_task
+        except asyncio.CancelledError:
+            pass
+        _audit_writer_task = None
+    
+    pending = []
+    while _audit_queue is not None and not _audit_queue.empty():
+        pending.append(_audit_queue.get_nowait())
+    for start in range(0, len(pending), AUDIT_BATCH_SIZE):
+        _insert_audit_batch(pending[start:start + AUDIT_BATCH_SIZE])
@@ -0,0 +1,20 @@
+from typing import List, Dict, Any
+from aiodataloader import DataLoader
+
+
+class BillingLoader(DataLoader):
+    """Batch per-user spending lookups into a single billing query
+    
+    Meant for code that resolves users one at a time with ``load(user_id)``: calls made
+    in the same tick are coalesced into one get_spending_by_users query. The bulk credits
+    endpoint is the only caller so far. Create one loader per request or job so cached
+    results never outlive it.
+    """
+
+    def __init__(self, billing_service, **kwargs):
+        super().__init__(**kwargs)
+        self.billing_service = billing_service
+
+    async def batch_load_fn(self, user_ids: List[str]) -> List[Dict[str, Any]]:
+        summaries = await self.billing_service.get_spending_by_users(list(user_ids))
+        return [summaries[user_id] for user_id in user_ids]
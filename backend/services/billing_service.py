@@ -1,11 +1,108 @@
-from typing import List, Optional, Dict, Any
+import asyncio
+import bisect
+import logging
+import orjson
+import time
+from typing import List, Optional, Dict, Any, AsyncIterator, Tuple
 from datetime import datetime, timedelta
+from pydantic import TypeAdapter
+from cachetools import TTLCache
 from models import BillingRecord, BillingRecordCreate, BillingActionType, UsageSummary
+from auth import invalidate_cached_user
+from database import db
 from .base_service import BaseService, ServiceError, ValidationError
 
+# Spending windows for a batch of users, grouped server-side
+SPENDING_BY_USERS_SQL = """
+    SELECT
+        user_id::text AS user_id,
+        COALESCE(SUM(amount) FILTER (WHERE amount > 0 AND created_at >= $2), 0)::float8 AS monthly_spending,
+        COALESCE(SUM(amount) FILTER (WHERE amount > 0 AND created_at >= $3), 0)::float8 AS weekly_spending,
+        COALESCE(SUM(amount) FILTER (WHERE amount > 0 AND created_at >= $4), 0)::float8 AS daily_spending,
+        MAX(created_at) AS last_transaction,
+        COUNT(*) AS credit_history_count
+    FROM billing_records
+    WHERE user_id = ANY($1::uuid[])
+    GROUP BY user_id
+"""
+
+SPENDING_STATS_SQL = "SELECT total_spent, record_count FROM get_spending_stats($1::uuid, $2, $3)"
+
+VM_COUNTS_SQL = "SELECT total_vms, active_vms FROM vm_counts($1::uuid)"
+
+RUNNING_COST_SQL = "SELECT sum_running_cost($1::uuid)"
+
+# Action type strings for the credit paths, resolved once
+CREDIT_ADD_ACTION = BillingActionType.CREDIT_ADD.value
+CREDIT_DEDUCT_ACTION = BillingActionType.CREDIT_DEDUCT.value
+
+# Billing projections assume a 30-day month
+HOURS_PER_DAY = 24
+HOURS_PER_MONTH = HOURS_PER_DAY * 30
+
+# Validates a whole page of billing rows in one call into pydantic-core
+BILLING_RECORDS_ADAPTER = TypeAdapter(List[BillingRecord])
+
+# Concurrent billing writes to Supabase are coalesced into one call by a background task
+BILLING_BATCH_SIZE = 100
+BILLING_FLUSH_INTERVAL_SECONDS = 0.005
+_billing_queue: Optional["asyncio.Queue[Tuple[Dict[str, Any], Dict[str, Any], asyncio.Future]]"] = None
+_billing_writer_task: Optional[asyncio.Task] = None
+_billing_logger = logging.getLogger("BillingRecordWriter")
+
+# Rows fetched per round trip when streaming billing history
+BILLING_HISTORY_PAGE_SIZE = 500
+
+# Absorbs dashboard refreshes; entries are dropped whenever the user's billing changes
+USAGE_SUMMARY_TTL_SECONDS = 5
+_usage_summary_cache: TTLCache = TTLCache(maxsize=10_000, ttl=USAGE_SUMMARY_TTL_SECONDS)
+
+# Health probes within this window reuse the last healthy result
+HEALTH_CHECK_INTERVAL_SECONDS = 30
+
+# Only the columns calculate_vm_costs reports on
+VM_COST_COLUMNS = "id, name, status, total_cost, cost_per_hour, uptime_hours"
+
+APPLY_CREDIT_DELTA_SQL = """
+    SELECT
+        id::text AS id,
+        user_id::text AS user_id,
+        vm_id::text AS vm_id,
+        action_type,
+        amount::float8 AS amount,
+        description,
+        created_at,
+        credits::float8 AS credits
+    FROM apply_credit_delta($1::uuid, $2::uuid, $3, $4, $5, $6::uuid)
+"""
+
+RECORD_BILLING_WITH_AUDIT_SQL = """
+    SELECT
+        id::text AS id,
+        user_id::text AS user_id,
+        vm_id::text AS vm_id,
+        action_type,
+        amount::float8 AS amount,
+        description,
+        created_at
+    FROM record_billing_with_audit($1::jsonb, $2::jsonb)
+"""
+
+def invalidate_usage_summary(user_id: str):
+    """Drop a user's cached usage summaries after their billing changes"""
+    _usage_summary_cache.pop(user_id, None)
+
+def _created_at(record: Dict[str, Any]) -> datetime:
+    """Ordering key for in-memory billing records"""
+    return record["created_at"]
+
 class BillingService(BaseService):
     """Billing and credit management service"""
     
+    # Shared across instances so every router's service sees the same probe result
+    _health_status: Optional[Dict[str, Any]] = None
+    _health_checked_at = 0.0
+
     async def record_transaction(self, user_id: str, action_type: str, amount: float, description: str, vm_id: Optional[str] = None) -> BillingRecord:
         """Record a billing transaction"""
         try:
@@ -23,24 +120,16 @@ class BillingService(BaseService):
                 "created_at": datetime.utcnow()
             }
             
-            # Save to database
-            created_record = await self._create_billing_record(billing_record)
+            # Save to database together with its audit event
+            created_record = await self._create_billing_record_with_audit(billing_record, {
+                "action_type": action_type,
+                "amount": amount,
+                "vm_id": vm_id
+            })
             if not created_record:
                 raise ServiceError("Failed to record billing transaction", "BILLING_RECORD_FAILED")
             
-            # Log audit event
-            await self.log_audit_event(
-                user_id=user_id,
-                action="billing_transaction",
-                resource_type="billing_records",
-                resource_id=created_record["id"],
-                details={
-                    "action_type": action_type,
-                    "amount": amount,
-                    "vm_id": vm_id
-                }
-            )
-            
+            invalidate_usage_summary(user_id)
             return BillingRecord(**created_record)
             
         except ServiceError:
@@ -52,32 +141,122 @@ class BillingService(BaseService):
     async def get_user_billing_history(self, user_id: str, limit: int = 50, action_type: Optional[BillingActionType] = None) -> List[BillingRecord]:
         """Get user's billing history"""
         try:
-            records = await self._get_billing_records_by_user(user_id, limit, action_type)
-            return [BillingRecord(**record) for record in records]
+            return [record async for record in self.iter_user_billing_history(user_id, action_type, limit)]
         except Exception as e:
             self.logger.error(f"Error getting billing history: {e}")
             raise ServiceError("Failed to retrieve billing history", "BILLING_HISTORY_ERROR")
     
+    async def iter_user_billing_history(self, user_id: str, action_type: Optional[BillingActionType] = None, limit: Optional[int] = None, page_size: int = BILLING_HISTORY_PAGE_SIZE) -> AsyncIterator[BillingRecord]:
+        """Yield user's billing history newest first, holding one page in memory at a time
+        
+        Database errors are raised rather than ending the iteration, so a failed page
+        cannot pass for the end of the history.
+        """
+        offset = 0
+        while limit is None or offset < limit:
+            size = page_size if limit is None else min(page_size, limit - offset)
+            records = await self._fetch_billing_records_by_user(user_id, size, action_type, offset)
+            for record in BILLING_RECORDS_ADAPTER.validate_python(records):
+                yield record
+            if len(records) < size:
+                return
+            offset += size
+    
+    async def get_last_transaction_id(self, user_id: str) -> Optional[str]:
+        """Get the ID of the user's most recent billing transaction"""
+        try:
+            supabase = self.db.get_client()
+            if supabase:
+                result = supabase.table("billing_records").select("id").eq("user_id", user_id).order("created_at", desc=True).limit(1).execute()
+                return result.data[0]["id"] if result.data else None
+            else:
+                records = await self._get_billing_records_by_user(user_id, 1)
+                return records[0]["id"] if records else None
+        except Exception as e:
+            self.logger.error(f"Error getting last transaction: {e}")
+            return None
+
+    async def get_spending_by_users(self, user_ids: List[str], now: Optional[datetime] = None) -> Dict[str, Dict[str, Any]]:
+        """Get credit spending windows for several users in one query"""
+        now = now or datetime.utcnow()
+        month_start = now - timedelta(days=30)
+        week_start = now - timedelta(days=7)
+        day_start = now - timedelta(days=1)
+        summaries = {
+            user_id: {
+                "user_id": user_id,
+                "monthly_spending": 0.0,
+                "weekly_spending": 0.0,
+                "daily_spending": 0.0,
+                "last_transaction": None,
+                "credit_history_count": 0
+            }
+            for user_id in user_ids
+        }
+        if not user_ids:
+            return summaries
+        try:
+            if self.db.pg_enabled:
+                result = await self.db.execute_query(
+                    SPENDING_BY_USERS_SQL,
+                    [list(user_ids), month_start, week_start, day_start]
+                )
+                for row in result.rows:
+                    summaries[row["user_id"]].update(row)
+                return summaries
+            
+            supabase = self.db.get_client()
+            if supabase:
+                result = supabase.table("billing_records").select("user_id, amount, created_at").in_("user_id", list(user_ids)).execute()
+                records = result.data or []
+            else:
+                memory_store = self.db.get_memory_store()
+                records = [
+                    record
+                    for user_id in summaries
+                    for record in memory_store["billing_by_user"].get(user_id, [])
+                ]
+            
+            for record in records:
+                summary = summaries[record["user_id"]]
+                created_at = record.get("created_at") or datetime.min
+                if isinstance(created_at, str):
+                    created_at = datetime.fromisoformat(created_at.replace("Z", "+00:00")).replace(tzinfo=None)
+                amount = float(record["amount"])
+                summary["credit_history_count"] += 1
+                if summary["last_transaction"] is None or created_at > summary["last_transaction"]:
+                    summary["last_transaction"] = created_at
+                if amount > 0 and created_at >= month_start:
+                    summary["monthly_spending"] += amount
+                    if created_at >= week_start:
+                        summary["weekly_spending"] += amount
+                        if created_at >= day_start:
+                            summary["daily_spending"] += amount
+            return summaries
+        except Exception as e:
+            self.logger.error(f"Error getting spending by users: {e}")
+            raise ServiceError("Failed to retrieve spending summaries", "BILLING_SPENDING_ERROR")
+    
     async def get_usage_summary(self, user_id: str, period_days: int = 30) -> UsageSummary:
         """Get user's usage summary for a period"""
+        cached = _usage_summary_cache.get(user_id)
+        if cached and period_days in cached:
+            return cached[period_days]
+        
         try:
             # Calculate period dates
             end_date = datetime.utcnow()
             start_date = end_date - timedelta(days=period_days)
             
-            # Get user's current credits
-            current_credits = await self.get_user_credits(user_id)
-            
-            # Calculate spending statistics
-            spending_stats = await self._calculate_spending_stats(user_id, start_date, end_date)
-            
-            # Get VM statistics
-            vm_stats = await self._get_vm_statistics(user_id)
-            
-            # Calculate current hourly cost
-            hourly_cost = await self._calculate_current_hourly_cost(user_id)
+            # Credits, period spending, VM counts and hourly cost are independent lookups
+            current_credits, spending_stats, vm_stats, hourly_cost = await asyncio.gather(
+                self.get_user_credits(user_id),
+                self._calculate_spending_stats(user_id, start_date, end_date),
+                self._get_vm_statistics(user_id),
+                self._calculate_current_hourly_cost(user_id)
+            )
             
-            return UsageSummary(
+            summary = UsageSummary(
                 user_id=user_id,
                 current_credits=current_credits,
                 total_spent=spending_stats["total_spent"],
@@ -87,8 +266,10 @@ class BillingService(BaseService):
                 period_start=start_date,
                 period_end=end_date,
                 hourly_cost=hourly_cost,
-                projected_monthly_cost=hourly_cost * 24 * 30
+                projected_monthly_cost=hourly_cost * HOURS_PER_MONTH
             )
+            _usage_summary_cache.setdefault(user_id, {})[period_days] = summary
+            return summary
             
         except Exception as e:
             self.logger.error(f"Error getting usage summary: {e}")
@@ -100,22 +281,11 @@ class BillingService(BaseService):
             if amount <= 0:
                 raise ValidationError("Credit amount must be positive")
             
-            # Get current credits
-            current_credits = await self.get_user_credits(user_id)
-            
-            # Update user credits
-            new_credits = current_credits + amount
-            success = await self.update_user_credits(user_id, new_credits)
-            if not success:
+            record = await self._apply_credit_delta(user_id, amount, CREDIT_ADD_ACTION, description)
+            if not record:
                 raise ServiceError("Failed to update user credits", "CREDIT_UPDATE_FAILED")
             
-            # Record the transaction
-            return await self.record_transaction(
-                user_id=user_id,
-                action_type=BillingActionType.CREDIT_ADD.value,
-                amount=amount,
-                description=description
-            )
+            return record
             
         except ServiceError:
             raise
@@ -129,25 +299,14 @@ class BillingService(BaseService):
             if amount <= 0:
                 raise ValidationError("Deduction amount must be positive")
             
-            # Get current credits
-            current_credits = await self.get_user_credits(user_id)
-            
-            if current_credits < amount:
+            # Negative for deduction
+            record = await self._apply_credit_delta(user_id, -amount, CREDIT_DEDUCT_ACTION, description)
+            if not record:
+                # Only read the balance back to explain the rejection
+                current_credits = await self.get_user_credits(user_id)
                 raise ValidationError(f"Insufficient credits. Available: ${current_credits:.2f}, Required: ${amount:.2f}")
             
-            # Update user credits
-            new_credits = current_credits - amount
-            success = await self.update_user_credits(user_id, new_credits)
-            if not success:
-                raise ServiceError("Failed to update user credits", "CREDIT_UPDATE_FAILED")
-            
-            # Record the transaction
-            return await self.record_transaction(
-                user_id=user_id,
-                action_type=BillingActionType.CREDIT_DEDUCT.value,
-                amount=-amount,  # Negative for deduction
-                description=description
-            )
+            return record
             
         except ServiceError:
             raise
@@ -159,9 +318,9 @@ class BillingService(BaseService):
         """Calculate VM costs for user"""
         try:
             # Get all user's VMs
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                result = supabase.table("vms").select("*").eq("user_id", user_id).execute()
+            supabase = self.db.get_client()
+            if supabase:
+                result = supabase.table("vms").select(VM_COST_COLUMNS).eq("user_id", user_id).execute()
                 vms = result.data or []
             else:
                 memory_store = self.db.get_memory_store()
@@ -192,8 +351,8 @@ class BillingService(BaseService):
             return {
                 "total_cost": total_cost,
                 "running_cost_per_hour": running_cost_per_hour,
-                "projected_daily_cost": running_cost_per_hour * 24,
-                "projected_monthly_cost": running_cost_per_hour * 24 * 30,
+                "projected_daily_cost": running_cost_per_hour * HOURS_PER_DAY,
+                "projected_monthly_cost": running_cost_per_hour * HOURS_PER_MONTH,
                 "vm_costs": vm_costs
             }
             
@@ -203,16 +362,27 @@ class BillingService(BaseService):
     
     async def health_check(self) -> Dict[str, Any]:
         """Billing service health check"""
+        now = time.monotonic()
+        if BillingService._health_status and now - BillingService._health_checked_at < HEALTH_CHECK_INTERVAL_SECONDS:
+            return BillingService._health_status
+        
         try:
-            # Test billing record lookup
-            test_result = await self._get_billing_records_by_user("test-user-id", 1)
+            # Cheapest read that proves the billing table is reachable
+            if self.db.pg_enabled:
+                await self.db.execute_query("SELECT 1 FROM billing_records LIMIT 1", fetch_mode="val")
+            else:
+                supabase = self.db.get_client()
+                if supabase:
+                    supabase.table("billing_records").select("id").limit(1).execute()
             
-            return {
+            BillingService._health_status = {
                 "service": "billing",
                 "status": "healthy",
                 "database_connection": "ok",
                 "billing_operations": "ok"
             }
+            BillingService._health_checked_at = now
+            return BillingService._health_status
         except Exception as e:
             return {
                 "service": "billing",
@@ -236,74 +406,207 @@ class BillingService(BaseService):
         if not description:
             raise ValidationError("Description is required")
     
+    async def _apply_credit_delta(self, user_id: str, delta: float, action_type: str, description: str, vm_id: Optional[str] = None) -> Optional[BillingRecord]:
+        """Change a user's credits and record the transaction atomically
+        
+        Returns None when the user does not exist or the balance would go negative.
+        """
+        await self._validate_transaction(user_id, action_type, delta, description)
+        invalidate_cached_user(user_id)
+        
+        record_id = self.generate_id()
+        if self.db.pg_enabled:
+            result = await self.db.execute_query(
+                APPLY_CREDIT_DELTA_SQL,
+                [record_id, user_id, delta, action_type, description, vm_id],
+                fetch_mode="one"
+            )
+            row = result.rows[0] if result.rows else None
+        else:
+            supabase = self.db.get_client()
+            if supabase:
+                result = supabase.rpc("apply_credit_delta", {
+                    "p_id": record_id,
+                    "p_user_id": user_id,
+                    "p_delta": delta,
+                    "p_action_type": action_type,
+                    "p_description": description,
+                    "p_vm_id": vm_id
+                }).execute()
+                row = result.data[0] if result.data else None
+            else:
+                # No await between the balance check and the writes keeps this atomic
+                memory_store = self.db.get_memory_store()
+                user_data = memory_store["users_by_id"].get(user_id)
+                row = None
+                if user_data and float(user_data.get("credits", 0.0)) + delta >= 0:
+                    user_data["credits"] = float(user_data.get("credits", 0.0)) + delta
+                    row = {
+                        "id": record_id,
+                        "user_id": user_id,
+                        "vm_id": vm_id,
+                        "action_type": action_type,
+                        "amount": delta,
+                        "description": description,
+                        "created_at": datetime.utcnow()
+                    }
+                    self._add_memory_billing_record(memory_store, row)
+        
+        if not row:
+            return None
+        
+        invalidate_usage_summary(user_id)
+        await self.log_audit_event(
+            user_id=user_id,
+            action="billing_transaction",
+            resource_type="billing_records",
+            resource_id=row["id"],
+            details={
+                "action_type": action_type,
+                "amount": delta,
+                "vm_id": vm_id
+            }
+        )
+        
+        return BillingRecord(**row)
+    
     async def _create_billing_record(self, billing_record: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Create billing record in database"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                result = supabase.table("billing_records").insert(billing_record).execute()
+            supabase = self.db.get_client()
+            if supabase:
+                result = supabase.table("billing_records").insert(self.json_ready(billing_record)).execute()
                 return result.data[0] if result.data else None
             else:
                 memory_store = self.db.get_memory_store()
-                memory_store["billing_records"].append(billing_record)
+                self._add_memory_billing_record(memory_store, billing_record)
                 return billing_record
         except Exception as e:
             self.logger.error(f"Error creating billing record: {e}")
             return None
     
-    async def _get_billing_records_by_user(self, user_id: str, limit: int = 50, action_type: Optional[BillingActionType] = None) -> List[Dict[str, Any]]:
-        """Get billing records by user"""
-        try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                query = supabase.table("billing_records").select("*").eq("user_id", user_id)
-                
-                if action_type:
-                    query = query.eq("action_type", action_type.value)
-                
-                result = query.order("created_at", desc=True).limit(limit).execute()
-                return result.data or []
-            else:
-                memory_store = self.db.get_memory_store()
-                records = [
-                    record for record in memory_store["billing_records"] 
-                    if record.get("user_id") == user_id
-                ]
-                
-                if action_type:
-                    records = [
-                        record for record in records 
-                        if record.get("action_type") == action_type.value
-                    ]
+    @staticmethod
+    def _add_memory_billing_record(memory_store: Dict[str, Any], billing_record: Dict[str, Any]):
+        """Store a billing record in memory and in its user's created_at-ordered list"""
+        memory_store["billing_records"].append(billing_record)
+        bisect.insort(
+            memory_store["billing_by_user"].setdefault(billing_record["user_id"], []),
+            billing_record,
+            key=_created_at
+        )
+    
+    async def _create_billing_record_with_audit(self, billing_record: Dict[str, Any], audit_details: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Create a billing record and its audit event in one database call"""
+        if self.db.pg_enabled or self.db.get_client():
+            audit_record = {
+                "id": self.generate_id(),
+                "action": "billing_transaction",
+                "resource_id": billing_record["id"],
+                "details": audit_details
+            }
+            if not self.db.pg_enabled and _billing_writer_task is not None and not _billing_writer_task.done():
+                future = asyncio.get_running_loop().create_future()
+                _billing_queue.put_nowait((billing_record, audit_record, future))
+                return await future
+            
+            try:
+                if self.db.pg_enabled:
+                    result = await self.db.execute_query(
+                        RECORD_BILLING_WITH_AUDIT_SQL,
+                        [orjson.dumps(billing_record).decode(), orjson.dumps(audit_record).decode()],
+                        fetch_mode="one"
+                    )
+                    return result.rows[0] if result.rows else None
                 
-                # Sort by created_at descending and limit
-                records = sorted(records, key=lambda x: x.get("created_at", datetime.min), reverse=True)
-                return records[:limit]
+                supabase = self.db.get_client()
+                result = supabase.rpc("record_billing_with_audit", {
+                    "payload": self.json_ready(billing_record),
+                    "audit": self.json_ready(audit_record)
+                }).execute()
+                return result.data[0] if result.data else None
+            except Exception as e:
+                self.logger.error(f"Error creating billing record: {e}")
+                return None
+        
+        created_record = await self._create_billing_record(billing_record)
+        if created_record:
+            await self.log_audit_event(
+                user_id=billing_record["user_id"],
+                action="billing_transaction",
+                resource_type="billing_records",
+                resource_id=created_record["id"],
+                details=audit_details
+            )
+        return created_record
+    
+    async def _get_billing_records_by_user(self, user_id: str, limit: int = 50, action_type: Optional[BillingActionType] = None, offset: int = 0) -> List[Dict[str, Any]]:
+        """Get billing records by user, newest first"""
+        try:
+            return await self._fetch_billing_records_by_user(user_id, limit, action_type, offset)
         except Exception as e:
             self.logger.error(f"Error getting billing records: {e}")
             return []
     
+    async def _fetch_billing_records_by_user(self, user_id: str, limit: int, action_type: Optional[BillingActionType] = None, offset: int = 0) -> List[Dict[str, Any]]:
+        """Get a page of billing records by user, newest first, letting database errors propagate"""
+        supabase = self.db.get_client()
+        if supabase:
+            query = supabase.table("billing_records").select("*").eq("user_id", user_id)
+            
+            if action_type:
+                query = query.eq("action_type", action_type.value)
+            
+            result = query.order("created_at", desc=True).range(offset, offset + limit - 1).execute()
+            return result.data or []
+        
+        memory_store = self.db.get_memory_store()
+        records = memory_store["billing_by_user"].get(user_id, [])
+        
+        if action_type:
+            action_value = action_type.value
+            records = [
+                record for record in records 
+                if record.get("action_type") == action_value
+            ]
+        
+        # Records are kept oldest first, so the newest are at the tail
+        end = len(records) - offset
+        return records[max(end - limit, 0):end][::-1] if limit > 0 and end > 0 else []
+    
     async def _calculate_spending_stats(self, user_id: str, start_date: datetime, end_date: datetime) -> Dict[str, Any]:
         """Calculate spending statistics for a period"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                result = supabase.table("billing_records").select("amount").eq("user_id", user_id).gte("created_at", start_date.isoformat()).lte("created_at", end_date.isoformat()).execute()
-                records = result.data or []
+            stats = {"total_spent": 0.0, "record_count": 0}
+            if self.db.pg_enabled:
+                result = await self.db.execute_query(SPENDING_STATS_SQL, [user_id, start_date, end_date], fetch_mode="one")
+                if result.rows:
+                    stats.update(result.rows[0])
+                return stats
+            
+            supabase = self.db.get_client()
+            if supabase:
+                result = supabase.rpc("get_spending_stats", {
+                    "uid": user_id,
+                    "start_date": start_date.isoformat(),
+                    "end_date": end_date.isoformat()
+                }).execute()
+                if result.data:
+                    row = result.data[0]
+                    stats["total_spent"] = float(row["total_spent"] or 0.0)
+                    stats["record_count"] = int(row["record_count"] or 0)
             else:
                 memory_store = self.db.get_memory_store()
-                records = [
-                    record for record in memory_store["billing_records"]
-                    if (record.get("user_id") == user_id and
-                        start_date <= datetime.fromisoformat(record.get("created_at", "1970-01-01")) <= end_date)
-                ]
-            
-            total_spent = sum(float(record["amount"]) for record in records if float(record["amount"]) > 0)
+                records = memory_store["billing_by_user"].get(user_id, [])
+                
+                # created_at is stored as a datetime in order, so the period is a slice
+                first = bisect.bisect_left(records, start_date, key=_created_at)
+                last = bisect.bisect_right(records, end_date, key=_created_at)
+                stats["record_count"] = last - first
+                stats["total_spent"] = sum(
+                    amount for record in records[first:last] if (amount := record["amount"]) > 0
+                )
             
-            return {
-                "total_spent": total_spent,
-                "record_count": len(records)
-            }
+            return stats
         except Exception as e:
             self.logger.error(f"Error calculating spending stats: {e}")
             return {"total_spent": 0.0, "record_count": 0}
@@ -311,26 +614,28 @@ class BillingService(BaseService):
     async def _get_vm_statistics(self, user_id: str) -> Dict[str, int]:
         """Get VM statistics for user"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                
-                # Total VMs
-                total_result = supabase.table("vms").select("*", count="exact").eq("user_id", user_id).execute()
-                total_vms = total_result.count or 0
-                
-                # Active VMs
-                active_result = supabase.table("vms").select("*", count="exact").eq("user_id", user_id).eq("status", "running").execute()
-                active_vms = active_result.count or 0
+            stats = {"total_vms": 0, "active_vms": 0}
+            if self.db.pg_enabled:
+                result = await self.db.execute_query(VM_COUNTS_SQL, [user_id], fetch_mode="one")
+                if result.rows:
+                    stats.update(result.rows[0])
+                return stats
+            
+            supabase = self.db.get_client()
+            if supabase:
+                result = supabase.rpc("vm_counts", {"uid": user_id}).execute()
+                if result.data:
+                    row = result.data[0]
+                    stats["total_vms"] = int(row["total_vms"] or 0)
+                    stats["active_vms"] = int(row["active_vms"] or 0)
             else:
                 memory_store = self.db.get_memory_store()
-                user_vms = [vm for vm in memory_store["vms"] if vm.get("user_id") == user_id]
-                total_vms = len(user_vms)
-                active_vms = len([vm for vm in user_vms if vm.get("status") == "running"])
+                for vm in memory_store["vms"]:
+                    if vm.get("user_id") == user_id:
+                        stats["total_vms"] += 1
+                        stats["active_vms"] += vm.get("status") == "running"
             
-            return {
-                "total_vms": total_vms,
-                "active_vms": active_vms
-            }
+            return stats
         except Exception as e:
             self.logger.error(f"Error getting VM statistics: {e}")
             return {"total_vms": 0, "active_vms": 0}
@@ -338,18 +643,98 @@ class BillingService(BaseService):
     async def _calculate_current_hourly_cost(self, user_id: str) -> float:
         """Calculate current hourly cost for running VMs"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                result = supabase.table("vms").select("cost_per_hour").eq("user_id", user_id).eq("status", "running").execute()
-                vms = result.data or []
-            else:
-                memory_store = self.db.get_memory_store()
-                vms = [
-                    vm for vm in memory_store["vms"] 
-                    if vm.get("user_id") == user_id and vm.get("status") == "running"
-                ]
+            if self.db.pg_enabled:
+                result = await self.db.execute_query(RUNNING_COST_SQL, [user_id], fetch_mode="val")
+                return float(result.rows[0]["value"]) if result.rows else 0.0
             
-            return sum(float(vm.get("cost_per_hour", 0.0)) for vm in vms)
+            supabase = self.db.get_client()
+            if supabase:
+                result = supabase.rpc("sum_running_cost", {"uid": user_id}).execute()
+                return float(result.data or 0.0)
+            
+            memory_store = self.db.get_memory_store()
+            return sum(
+                float(vm.get("cost_per_hour", 0.0)) for vm in memory_store["vms"]
+                if vm.get("user_id") == user_id and vm.get("status") == "running"
+            )
         except Exception as e:
             self.logger.error(f"Error calculating hourly cost: {e}")
-            return 0.0
\ No newline at end of file
+            return 0.0
+
+def _record_billing_batch(batch: List[Tuple[Dict[str, Any], Dict[str, Any], asyncio.Future]]) -> Dict[str, Dict[str, Any]]:
+    """Write billing records with their audit events in one call, returning the created rows by ID"""
+    supabase = db.get_client()
+    if not supabase:
+        return {}
+    result = supabase.rpc("record_billing_batch_with_audit", {
+        "payloads": BaseService.json_ready([record for record, _, _ in batch]),
+        "audits": BaseService.json_ready([audit for _, audit, _ in batch])
+    }).execute()
+    return {row["id"]: row for row in result.data or []}
+
+async def _insert_billing_batch(batch: List[Tuple[Dict[str, Any], Dict[str, Any], asyncio.Future]]):
+    """Write a batch of billing records and hand each waiter its row
+    
+    The batch is one statement, so a single bad record rolls back all of them; when that
+    happens the records are retried one by one and only the bad ones fail.
+    """
+    loop = asyncio.get_running_loop()
+    # The Supabase client blocks, so keep it off the event loop
+    try:
+        created = await loop.run_in_executor(None, _record_billing_batch, batch)
+    except Exception as e:
+        _billing_logger.warning(f"Batch write of {len(batch)} billing records failed, retrying individually: {e}")
+        created = {}
+        for item in batch:
+            try:
+                created.update(await loop.run_in_executor(None, _record_billing_batch, [item]))
+            except Exception as e:
+                _billing_logger.error(f"Failed to write billing record {item[0]['id']}: {e}")
+    
+    for record, _, future in batch:
+        if not future.done():
+            future.set_result(created.get(record["id"]))
+
+async def _write_billing_records_loop(batch_size: int, interval: float):
+    """Collect queued billing records until the batch fills or the interval passes, then insert them"""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _billing_queue.get()]
+        deadline = loop.time() + interval
+        try:
+            while len(batch) < batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(_billing_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            # Also runs on cancellation so no caller is left waiting
+            await _insert_billing_batch(batch)
+
+def start_billing_record_writer(batch_size: int = BILLING_BATCH_SIZE, interval: float = BILLING_FLUSH_INTERVAL_SECONDS):
+    """Start the background billing record writer (called on app startup)"""
+    global _billing_queue, _billing_writer_task
+    if _billing_writer_task is None or _billing_writer_task.done():
+        # Created here so the queue belongs to the running event loop
+        _billing_queue = asyncio.Queue()
+        _billing_writer_task = asyncio.create_task(_write_billing_records_loop(batch_size, interval))
+
+async def stop_billing_record_writer():
+    """Stop the billing record writer and flush whatever is still queued (called on app shutdown)"""
+    global _billing_writer_task
+    if _billing_writer_task is not None:
+        _billing_writer_task.cancel()
+        try:
+            await _billing_writer_task
+        except asyncio.CancelledError:
+            pass
+        _billing_writer_task = None
+    
+    pending = []
+    while _billing_queue is not None and not _billing_queue.empty():
+        pending.append(_billing_queue.get_nowait())
+    for start in range(0, len(pending), BILLING_BATCH_SIZE):
+        await _insert_billing_batch(pending[start:start + BILLING_BATCH_SIZE])
@@ -1,9 +1,42 @@
+import asyncio
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timedelta
 from models import VMMetrics, VMMetricsCreate
 from .base_service import BaseService, ServiceError, ValidationError, NotFoundError
+import numpy as np
 import random
 
+# Metric columns reported by the VM metrics summary, in sample array order
+SUMMARY_FIELDS = ("cpu_usage", "memory_usage", "disk_usage", "network_in", "network_out")
+
+# Metric columns that get an increasing/decreasing/stable trend, taken from the front of the sample array
+TREND_FIELDS = SUMMARY_FIELDS[:3]
+
+# Per-VM latest-metrics requests in flight at once on the Supabase path
+LATEST_METRICS_CONCURRENCY = 16
+
+# Running VMs with their most recent metrics sample in one round-trip
+RUNNING_VMS_LATEST_METRICS_SQL = """
+    SELECT
+        v.id::text AS id, v.name, v.instance_type,
+        m.id::text AS metrics_id,
+        m.cpu_usage::float8 AS cpu_usage,
+        m.memory_usage::float8 AS memory_usage,
+        m.disk_usage::float8 AS disk_usage,
+        m.network_in::float8 AS network_in,
+        m.network_out::float8 AS network_out,
+        m.recorded_at
+    FROM vms v
+    LEFT JOIN LATERAL (
+        SELECT id, cpu_usage, memory_usage, disk_usage, network_in, network_out, recorded_at
+        FROM vm_metrics
+        WHERE vm_id = v.id
+        ORDER BY recorded_at DESC
+        LIMIT 1
+    ) m ON TRUE
+    WHERE v.user_id = $1 AND v.status = 'running'
+"""
+
 class MonitoringService(BaseService):
     """VM monitoring and metrics service"""
     
@@ -128,41 +161,24 @@ class MonitoringService(BaseService):
                     "trends": {}
                 }
             
-            # Calculate averages
-            avg_cpu = sum(m.cpu_usage for m in metrics) / len(metrics)
-            avg_memory = sum(m.memory_usage for m in metrics) / len(metrics)
-            avg_disk = sum(m.disk_usage for m in metrics) / len(metrics)
-            avg_network_in = sum(m.network_in for m in metrics) / len(metrics)
-            avg_network_out = sum(m.network_out for m in metrics) / len(metrics)
-            
-            # Calculate peaks
-            peak_cpu = max(m.cpu_usage for m in metrics)
-            peak_memory = max(m.memory_usage for m in metrics)
-            peak_disk = max(m.disk_usage for m in metrics)
-            peak_network_in = max(m.network_in for m in metrics)
-            peak_network_out = max(m.network_out for m in metrics)
-            
-            # Calculate trends (simple linear trend)
-            trends = await self._calculate_trends(metrics)
+            # One row per sample, one column per metric, read from the models in a single pass
+            samples = np.fromiter(
+                (value for m in metrics for value in (m.cpu_usage, m.memory_usage, m.disk_usage, m.network_in, m.network_out)),
+                dtype=np.float64,
+                count=len(metrics) * len(SUMMARY_FIELDS)
+            ).reshape(-1, len(SUMMARY_FIELDS))
+            averages = np.round(samples.mean(axis=0), 2).tolist()
+            peaks = np.round(samples.max(axis=0), 2).tolist()
+
+            # Calculate trends (simple linear trend) from the same sample array
+            trends = self._calculate_trends(samples[:, :len(TREND_FIELDS)])
             
             return {
                 "vm_id": vm_id,
                 "period_hours": hours,
                 "data_points": len(metrics),
-                "averages": {
-                    "cpu_usage": round(avg_cpu, 2),
-                    "memory_usage": round(avg_memory, 2),
-                    "disk_usage": round(avg_disk, 2),
-                    "network_in": round(avg_network_in, 2),
-                    "network_out": round(avg_network_out, 2)
-                },
-                "peaks": {
-                    "cpu_usage": round(peak_cpu, 2),
-                    "memory_usage": round(peak_memory, 2),
-                    "disk_usage": round(peak_disk, 2),
-                    "network_in": round(peak_network_in, 2),
-                    "network_out": round(peak_network_out, 2)
-                },
+                "averages": dict(zip(SUMMARY_FIELDS, averages)),
+                "peaks": dict(zip(SUMMARY_FIELDS, peaks)),
                 "trends": trends,
                 "latest_metrics": metrics[0] if metrics else None
             }
@@ -176,17 +192,35 @@ class MonitoringService(BaseService):
     async def get_user_monitoring_overview(self, user_id: str) -> Dict[str, Any]:
         """Get monitoring overview for all user's VMs"""
         try:
-            # Get user's VMs
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                result = supabase.table("vms").select("*").eq("user_id", user_id).eq("status", "running").execute()
-                vms = result.data or []
+            # Get user's running VMs and their latest metrics
+            if self.db.pg_enabled:
+                result = await self.db.execute_query(RUNNING_VMS_LATEST_METRICS_SQL, [user_id])
+                vms = result.rows
+                latest_by_vm = {
+                    row["id"]: {
+                        "id": row["metrics_id"],
+                        "vm_id": row["id"],
+                        "cpu_usage": row["cpu_usage"],
+                        "memory_usage": row["memory_usage"],
+                        "disk_usage": row["disk_usage"],
+                        "network_in": row["network_in"],
+                        "network_out": row["network_out"],
+                        "recorded_at": row["recorded_at"]
+                    }
+                    for row in vms if row["metrics_id"]
+                }
             else:
-                memory_store = self.db.get_memory_store()
-                vms = [
-                    vm for vm in memory_store["vms"] 
-                    if vm.get("user_id") == user_id and vm.get("status") == "running"
-                ]
+                supabase = self.db.get_client()
+                if supabase:
+                    result = supabase.table("vms").select("id, name, instance_type").eq("user_id", user_id).eq("status", "running").execute()
+                    vms = result.data or []
+                else:
+                    memory_store = self.db.get_memory_store()
+                    vms = [
+                        vm for vm in memory_store["vms"] 
+                        if vm.get("user_id") == user_id and vm.get("status") == "running"
+                    ]
+                latest_by_vm = await self._get_latest_metrics_by_vms([vm["id"] for vm in vms])
             
             vm_summaries = []
             total_avg_cpu = 0
@@ -194,8 +228,7 @@ class MonitoringService(BaseService):
             total_vms = len(vms)
             
             for vm in vms:
-                # Get latest metrics for each VM
-                latest_metrics = await self._get_latest_metrics_by_vm(vm["id"])
+                latest_metrics = latest_by_vm.get(vm["id"])
                 
                 if latest_metrics:
                     vm_summary = {
@@ -279,9 +312,9 @@ class MonitoringService(BaseService):
     async def _create_metrics_record(self, metrics_record: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Create metrics record in database"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                result = supabase.table("vm_metrics").insert(metrics_record).execute()
+            supabase = self.db.get_client()
+            if supabase:
+                result = supabase.table("vm_metrics").insert(self.json_ready(metrics_record)).execute()
                 return result.data[0] if result.data else None
             else:
                 memory_store = self.db.get_memory_store()
@@ -294,8 +327,8 @@ class MonitoringService(BaseService):
     async def _get_metrics_by_vm(self, vm_id: str, start_time: datetime, end_time: datetime, limit: int) -> List[Dict[str, Any]]:
         """Get metrics by VM and time range"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
+            supabase = self.db.get_client()
+            if supabase:
                 result = supabase.table("vm_metrics").select("*").eq("vm_id", vm_id).gte("recorded_at", start_time.isoformat()).lte("recorded_at", end_time.isoformat()).order("recorded_at", desc=True).limit(limit).execute()
                 return result.data or []
             else:
@@ -315,9 +348,11 @@ class MonitoringService(BaseService):
     async def _get_latest_metrics_by_vm(self, vm_id: str) -> Optional[Dict[str, Any]]:
         """Get latest metrics for a VM"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                result = supabase.table("vm_metrics").select("*").eq("vm_id", vm_id).order("recorded_at", desc=True).limit(1).execute()
+            supabase = self.db.get_client()
+            if supabase:
+                query = supabase.table("vm_metrics").select("*").eq("vm_id", vm_id).order("recorded_at", desc=True).limit(1)
+                # The Supabase client blocks, so run it on a worker thread to let lookups overlap
+                result = await asyncio.get_running_loop().run_in_executor(None, query.execute)
                 return result.data[0] if result.data else None
             else:
                 memory_store = self.db.get_memory_store()
@@ -332,6 +367,30 @@ class MonitoringService(BaseService):
             self.logger.error(f"Error getting latest metrics: {e}")
             return None
     
+    async def _get_latest_metrics_by_vms(self, vm_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Get latest metrics for several VMs, keyed by VM ID"""
+        if self.db.get_client():
+            semaphore = asyncio.Semaphore(LATEST_METRICS_CONCURRENCY)
+            
+            async def fetch(vm_id: str) -> Optional[Dict[str, Any]]:
+                async with semaphore:
+                    return await self._get_latest_metrics_by_vm(vm_id)
+            
+            results = await asyncio.gather(*(fetch(vm_id) for vm_id in vm_ids))
+            return {vm_id: latest_metrics for vm_id, latest_metrics in zip(vm_ids, results) if latest_metrics}
+        
+        # Single pass over the in-memory metrics instead of one scan per VM
+        wanted = set(vm_ids)
+        latest_by_vm = {}
+        for metric in self.db.get_memory_store()["vm_metrics"]:
+            vm_id = metric.get("vm_id")
+            if vm_id not in wanted:
+                continue
+            current = latest_by_vm.get(vm_id)
+            if current is None or metric.get("recorded_at", datetime.min) > current.get("recorded_at", datetime.min):
+                latest_by_vm[vm_id] = metric
+        return latest_by_vm
+    
     async def _cleanup_old_metrics(self, vm_id: str, keep_count: int = 1000):
         """Clean up old metrics, keeping only the most recent records"""
         try:
@@ -359,10 +418,10 @@ class MonitoringService(BaseService):
         except Exception as e:
             self.logger.warning(f"Error cleaning up old metrics: {e}")
     
-    async def _calculate_trends(self, metrics: List[VMMetrics]) -> Dict[str, str]:
-        """Calculate simple trends for metrics"""
+    def _calculate_trends(self, samples: np.ndarray) -> Dict[str, str]:
+        """Calculate simple trends from newest-first samples with one column per TREND_FIELDS entry"""
         try:
-            if len(metrics) < 2:
+            if len(samples) < 2:
                 return {
                     "cpu_usage": "stable",
                     "memory_usage": "stable",
@@ -370,35 +429,15 @@ class MonitoringService(BaseService):
                 }
             
             # Simple trend calculation: compare first half with second half
-            mid_point = len(metrics) // 2
-            first_half = metrics[mid_point:]  # Older data (metrics are sorted desc)
-            second_half = metrics[:mid_point]  # Newer data
-            
-            def calculate_trend(first_values, second_values):
-                first_avg = sum(first_values) / len(first_values)
-                second_avg = sum(second_values) / len(second_values)
-                
-                if second_avg > first_avg * 1.1:
-                    return "increasing"
-                elif second_avg < first_avg * 0.9:
-                    return "decreasing"
-                else:
-                    return "stable"
+            mid_point = len(samples) // 2
+            first_avgs = samples[mid_point:].mean(axis=0)  # Older data (metrics are sorted desc)
+            second_avgs = samples[:mid_point].mean(axis=0)  # Newer data
             
-            return {
-                "cpu_usage": calculate_trend(
-                    [m.cpu_usage for m in first_half],
-                    [m.cpu_usage for m in second_half]
-                ),
-                "memory_usage": calculate_trend(
-                    [m.memory_usage for m in first_half],
-                    [m.memory_usage for m in second_half]
-                ),
-                "disk_usage": calculate_trend(
-                    [m.disk_usage for m in first_half],
-                    [m.disk_usage for m in second_half]
-                )
-            }
+            trends = np.where(
+                second_avgs > first_avgs * 1.1, "increasing",
+                np.where(second_avgs < first_avgs * 0.9, "decreasing", "stable")
+            )
+            return dict(zip(TREND_FIELDS, trends.tolist()))
         except Exception as e:
             self.logger.error(f"Error calculating trends: {e}")
             return {
@@ -1,8 +1,38 @@
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 from datetime import datetime
 from models import ProjectCreate, ProjectUpdate, ProjectResponse, ProjectWithVMs, VMResponse
 from .base_service import BaseService, ServiceError, ValidationError, NotFoundError
 
+# A user's project and all of its VMs in one round-trip; vm_id is NULL for an empty project
+PROJECT_WITH_VMS_SQL = """
+    SELECT
+        p.id::text AS id, p.name, p.description, p.user_id::text AS user_id,
+        p.created_at, p.updated_at,
+        v.id::text AS vm_id, v.name AS vm_name, v.instance_type, v.image, v.status,
+        host(v.ip_address) AS ip_address,
+        v.cost_per_hour::float8 AS cost_per_hour,
+        v.uptime_hours::float8 AS uptime_hours,
+        v.total_cost::float8 AS total_cost,
+        v.created_at AS vm_created_at, v.updated_at AS vm_updated_at,
+        v.last_started, v.last_stopped
+    FROM projects p
+    LEFT JOIN vms v ON v.project_id = p.id
+    WHERE p.id = $1 AND p.user_id = $2
+    ORDER BY v.created_at DESC
+"""
+
+# VM statistics for a batch of projects, grouped server-side
+PROJECT_STATS_SQL = """
+    SELECT
+        project_id::text AS project_id,
+        COUNT(*) AS vm_count,
+        COUNT(*) FILTER (WHERE status = 'running') AS active_vm_count,
+        COALESCE(SUM(total_cost), 0)::float8 AS total_cost
+    FROM vms
+    WHERE project_id = ANY($1::uuid[])
+    GROUP BY project_id
+"""
+
 class ProjectService(BaseService):
     """Project management service"""
     
@@ -71,12 +101,26 @@ class ProjectService(BaseService):
         try:
             projects = await self._get_projects_by_user(user_id)
             
-            # Update project statistics
+            # Update project statistics from one batched VM query
+            stats_by_project = await self._calculate_projects_stats([project["id"] for project in projects])
             for project in projects:
-                stats = await self._calculate_project_stats(project["id"])
-                project.update(stats)
-            
-            return [ProjectResponse(**project) for project in projects]
+                project.update(stats_by_project[project["id"]])
+            
+            # Rows come straight from the database, so skip model validation
+            return [
+                ProjectResponse.model_construct(
+                    id=project["id"],
+                    name=project["name"],
+                    description=project.get("description"),
+                    user_id=project["user_id"],
+                    vm_count=project["vm_count"],
+                    active_vm_count=project["active_vm_count"],
+                    total_cost=project["total_cost"],
+                    created_at=self.parse_timestamp(project["created_at"]),
+                    updated_at=self.parse_timestamp(project.get("updated_at"))
+                )
+                for project in projects
+            ]
             
         except Exception as e:
             self.logger.error(f"Error getting user projects: {e}")
@@ -85,6 +129,16 @@ class ProjectService(BaseService):
     async def get_project(self, project_id: str, user_id: str, include_vms: bool = False) -> ProjectResponse:
         """Get a specific project"""
         try:
+            if include_vms:
+                # Ownership, project and VMs in a single fetch; stats come from the VMs
+                project_with_vms = await self._get_project_with_vms(project_id, user_id)
+                if not project_with_vms:
+                    raise NotFoundError("Project", project_id)
+                
+                project_record, vm_records = project_with_vms
+                vms = [self.vm_service._build_vm_response(vm) for vm in vm_records]
+                return ProjectWithVMs(**project_record, vms=vms)
+            
             # Validate ownership
             if not await self.validate_user_ownership(user_id, "projects", project_id):
                 raise NotFoundError("Project", project_id)
@@ -97,11 +151,6 @@ class ProjectService(BaseService):
             stats = await self._calculate_project_stats(project_id)
             project_record.update(stats)
             
-            if include_vms:
-                # Get VMs for this project
-                vms = await self.vm_service.get_user_vms(user_id, project_id=project_id)
-                return ProjectWithVMs(**project_record, vms=vms)
-            
             return ProjectResponse(**project_record)
             
         except ServiceError:
@@ -257,9 +306,9 @@ class ProjectService(BaseService):
     async def _project_name_exists_for_user(self, name: str, user_id: str) -> bool:
         """Check if project name exists for user"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                result = supabase.table("projects").select("id").eq("name", name).eq("user_id", user_id).execute()
+            supabase = self.db.get_client()
+            if supabase:
+                result = supabase.table("projects").select("id").eq("name", name).eq("user_id", user_id).limit(1).execute()
                 return bool(result.data)
             else:
                 memory_store = self.db.get_memory_store()
@@ -275,9 +324,9 @@ class ProjectService(BaseService):
     async def _create_project_record(self, project_record: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Create project record in database"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                result = supabase.table("projects").insert(project_record).execute()
+            supabase = self.db.get_client()
+            if supabase:
+                result = supabase.table("projects").insert(self.json_ready(project_record)).execute()
                 return result.data[0] if result.data else None
             else:
                 memory_store = self.db.get_memory_store()
@@ -290,8 +339,8 @@ class ProjectService(BaseService):
     async def _get_project_by_id(self, project_id: str) -> Optional[Dict[str, Any]]:
         """Get project by ID"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
+            supabase = self.db.get_client()
+            if supabase:
                 result = supabase.table("projects").select("*").eq("id", project_id).execute()
                 return result.data[0] if result.data else None
             else:
@@ -304,11 +353,67 @@ class ProjectService(BaseService):
             self.logger.error(f"Error getting project by ID: {e}")
             return None
     
+    async def _get_project_with_vms(self, project_id: str, user_id: str) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+        """Get a user's project together with its VMs, newest first"""
+        try:
+            if self.db.pg_enabled:
+                result = await self.db.execute_query(PROJECT_WITH_VMS_SQL, [project_id, user_id])
+                if not result.rows:
+                    return None
+                
+                first = result.rows[0]
+                project = {key: first[key] for key in ("id", "name", "description", "user_id", "created_at", "updated_at")}
+                vms = [
+                    {
+                        "id": row["vm_id"],
+                        "name": row["vm_name"],
+                        "instance_type": row["instance_type"],
+                        "image": row["image"],
+                        "status": row["status"],
+                        "ip_address": row["ip_address"],
+                        "user_id": row["user_id"],
+                        "project_id": row["id"],
+                        "cost_per_hour": row["cost_per_hour"],
+                        "uptime_hours": row["uptime_hours"],
+                        "total_cost": row["total_cost"],
+                        "created_at": row["vm_created_at"],
+                        "updated_at": row["vm_updated_at"],
+                        "last_started": row["last_started"],
+                        "last_stopped": row["last_stopped"]
+                    }
+                    for row in result.rows if row["vm_id"]
+                ]
+                return project, vms
+            elif self.db.get_client():
+                supabase = self.db.get_client()
+                # Embedded resource: PostgREST joins the VMs into the project row
+                result = supabase.table("projects").select("*, vms(*)").eq("id", project_id).eq("user_id", user_id).order("created_at", desc=True, foreign_table="vms").execute()
+                if not result.data:
+                    return None
+                
+                project = result.data[0]
+                vms = project.pop("vms", None) or []
+                return project, vms
+            else:
+                memory_store = self.db.get_memory_store()
+                project = next(
+                    (p for p in memory_store["projects"] if p.get("id") == project_id and p.get("user_id") == user_id),
+                    None
+                )
+                if not project:
+                    return None
+                
+                vms = [vm for vm in memory_store["vms"] if vm.get("project_id") == project_id]
+                return dict(project), sorted(vms, key=lambda x: x.get("created_at", datetime.min), reverse=True)
+        except Exception as e:
+            self.logger.error(f"Error getting project with VMs: {e}")
+            return None
+    
     async def _get_projects_by_user(self, user_id: str) -> List[Dict[str, Any]]:
         """Get projects by user"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
+            supabase = self.db.get_client()
+            if supabase:
                 result = supabase.table("projects").select("*").eq("user_id", user_id).order("created_at", desc=True).execute()
                 return result.data or []
             else:
@@ -322,9 +427,9 @@ class ProjectService(BaseService):
     async def _update_project_record(self, project_id: str, update_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Update project record in database"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                result = supabase.table("projects").update(update_data).eq("id", project_id).execute()
+            supabase = self.db.get_client()
+            if supabase:
+                result = supabase.table("projects").update(self.json_ready(update_data)).eq("id", project_id).execute()
                 return result.data[0] if result.data else None
             else:
                 memory_store = self.db.get_memory_store()
@@ -340,8 +445,8 @@ class ProjectService(BaseService):
     async def _delete_project_record(self, project_id: str) -> bool:
         """Delete project record from database"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
+            supabase = self.db.get_client()
+            if supabase:
                 result = supabase.table("projects").delete().eq("id", project_id).execute()
                 return bool(result.data)
             else:
@@ -358,41 +463,51 @@ class ProjectService(BaseService):
     
     async def _calculate_project_stats(self, project_id: str) -> Dict[str, Any]:
         """Calculate project statistics"""
-        try:
-            stats = {
+        stats_by_project = await self._calculate_projects_stats([project_id])
+        return stats_by_project[project_id]
+    
+    async def _calculate_projects_stats(self, project_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Calculate statistics for several projects in one query"""
+        stats_by_project = {
+            project_id: {
                 "vm_count": 0,
                 "active_vm_count": 0,
                 "total_cost": 0.0
             }
-            
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                
-                # Count VMs
-                vm_result = supabase.table("vms").select("*", count="exact").eq("project_id", project_id).execute()
-                stats["vm_count"] = vm_result.count or 0
-                
-                # Count active VMs
-                active_vm_result = supabase.table("vms").select("*", count="exact").eq("project_id", project_id).eq("status", "running").execute()
-                stats["active_vm_count"] = active_vm_result.count or 0
-                
-                # Calculate total cost
-                cost_result = supabase.table("vms").select("total_cost").eq("project_id", project_id).execute()
-                if cost_result.data:
-                    stats["total_cost"] = sum(float(vm.get("total_cost", 0)) for vm in cost_result.data)
+            for project_id in project_ids
+        }
+        if not project_ids:
+            return stats_by_project
+        try:
+            if self.db.pg_enabled:
+                result = await self.db.execute_query(PROJECT_STATS_SQL, [list(project_ids)])
+                for row in result.rows:
+                    stats_by_project[row.pop("project_id")].update(row)
+                return stats_by_project
+            
+            supabase = self.db.get_client()
+            if supabase:
+                result = supabase.table("vms").select("project_id, status, total_cost").in_("project_id", list(project_ids)).execute()
+                vms = result.data or []
             else:
                 memory_store = self.db.get_memory_store()
-                project_vms = [vm for vm in memory_store["vms"] if vm.get("project_id") == project_id]
-                
-                stats["vm_count"] = len(project_vms)
-                stats["active_vm_count"] = len([vm for vm in project_vms if vm.get("status") == "running"])
-                stats["total_cost"] = sum(float(vm.get("total_cost", 0)) for vm in project_vms)
+                vms = [vm for vm in memory_store["vms"] if vm.get("project_id") in stats_by_project]
+            
+            for vm in vms:
+                stats = stats_by_project[vm["project_id"]]
+                stats["vm_count"] += 1
+                if vm.get("status") == "running":
+                    stats["active_vm_count"] += 1
+                stats["total_cost"] += float(vm.get("total_cost") or 0)
             
-            return stats
+            return stats_by_project
         except Exception as e:
             self.logger.error(f"Error calculating project stats: {e}")
             return {
-                "vm_count": 0,
-                "active_vm_count": 0,
-                "total_cost": 0.0
-            }
\ No newline at end of file
+                project_id: {
+                    "vm_count": 0,
+                    "active_vm_count": 0,
+                    "total_cost": 0.0
+                }
+                for project_id in project_ids
+            }
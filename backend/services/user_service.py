@@ -2,6 +2,10 @@ from typing import List, Optional, Dict, Any
 from datetime import datetime
 from models import UserResponse, CreditUpdate
 from .base_service import BaseService, ServiceError, ValidationError, NotFoundError
+from auth import invalidate_cached_user
+
+# Defined in migrations/006_user_stats_function.sql
+USER_STATS_SQL = "SELECT vm_count, active_vm_count, project_count, total_spent FROM get_user_stats($1::uuid)"
 
 class UserService(BaseService):
     """User management service"""
@@ -29,7 +33,7 @@ class UserService(BaseService):
             stats = await self._calculate_user_stats(user_id)
             user_record.update(stats)
             
-            return UserResponse(**user_record)
+            return self.build_user_response(user_record)
             
         except ServiceError:
             raise
@@ -110,8 +114,8 @@ class UserService(BaseService):
         """Get user's recent activity log"""
         try:
             # Get audit logs for user
-            if self.db.get_client():
-                supabase = self.db.get_client()
+            supabase = self.db.get_client()
+            if supabase:
                 result = supabase.table("audit_logs").select("*").eq("user_id", user_id).order("timestamp", desc=True).limit(limit).execute()
                 logs = result.data or []
             else:
@@ -163,7 +167,7 @@ class UserService(BaseService):
                 }
             )
             
-            return UserResponse(**updated_user)
+            return self.build_user_response(updated_user)
             
         except ServiceError:
             raise
@@ -206,7 +210,7 @@ class UserService(BaseService):
                 }
             )
             
-            return UserResponse(**updated_user)
+            return self.build_user_response(updated_user)
             
         except ServiceError:
             raise
@@ -238,34 +242,31 @@ class UserService(BaseService):
     async def _get_user_record(self, user_id: str) -> Optional[Dict[str, Any]]:
         """Get user record from database"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
+            supabase = self.db.get_client()
+            if supabase:
                 result = supabase.table("users").select("*").eq("id", user_id).execute()
                 return result.data[0] if result.data else None
             else:
                 memory_store = self.db.get_memory_store()
-                for user_data in memory_store["users"].values():
-                    if user_data.get("id") == user_id:
-                        return user_data
-                return None
+                return memory_store["users_by_id"].get(user_id)
         except Exception as e:
             self.logger.error(f"Error getting user record: {e}")
             return None
     
     async def _update_user_record(self, user_id: str, update_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Update user record in database"""
+        invalidate_cached_user(user_id)
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                result = supabase.table("users").update(update_data).eq("id", user_id).execute()
+            supabase = self.db.get_client()
+            if supabase:
+                result = supabase.table("users").update(self.json_ready(update_data)).eq("id", user_id).execute()
                 return result.data[0] if result.data else None
             else:
                 memory_store = self.db.get_memory_store()
-                for email, user_data in memory_store["users"].items():
-                    if user_data.get("id") == user_id:
-                        user_data.update(update_data)
-                        return user_data
-                return None
+                user_data = memory_store["users_by_id"].get(user_id)
+                if user_data:
+                    user_data.update(update_data)
+                return user_data
         except Exception as e:
             self.logger.error(f"Error updating user record: {e}")
             return None
@@ -280,42 +281,36 @@ class UserService(BaseService):
                 "total_spent": 0.0
             }
             
-            if self.db.get_client():
+            # All four aggregates come from get_user_stats in one round-trip
+            if self.db.pg_enabled:
+                result = await self.db.execute_query(USER_STATS_SQL, [user_id], fetch_mode="one")
+                if result.rows:
+                    stats.update(result.rows[0])
+            elif self.db.get_client():
                 supabase = self.db.get_client()
-                
-                # Count VMs
-                vm_result = supabase.table("vms").select("*", count="exact").eq("user_id", user_id).execute()
-                stats["vm_count"] = vm_result.count or 0
-                
-                # Count active VMs
-                active_vm_result = supabase.table("vms").select("*", count="exact").eq("user_id", user_id).eq("status", "running").execute()
-                stats["active_vm_count"] = active_vm_result.count or 0
-                
-                # Count projects
-                project_result = supabase.table("projects").select("*", count="exact").eq("user_id", user_id).execute()
-                stats["project_count"] = project_result.count or 0
-                
-                # Calculate total spent
-                billing_result = supabase.table("billing_records").select("amount").eq("user_id", user_id).execute()
-                if billing_result.data:
-                    stats["total_spent"] = sum(float(record["amount"]) for record in billing_result.data if float(record["amount"]) > 0)
+                result = supabase.rpc("get_user_stats", {"uid": user_id}).execute()
+                if result.data:
+                    row = result.data[0]
+                    stats["vm_count"] = int(row["vm_count"] or 0)
+                    stats["active_vm_count"] = int(row["active_vm_count"] or 0)
+                    stats["project_count"] = int(row["project_count"] or 0)
+                    stats["total_spent"] = float(row["total_spent"] or 0.0)
             else:
                 memory_store = self.db.get_memory_store()
                 
-                # Count VMs
-                stats["vm_count"] = len([vm for vm in memory_store["vms"] if vm.get("user_id") == user_id])
-                
-                # Count active VMs
-                stats["active_vm_count"] = len([vm for vm in memory_store["vms"] if vm.get("user_id") == user_id and vm.get("status") == "running"])
+                # Count VMs and active VMs in one pass
+                for vm in memory_store["vms"]:
+                    if vm.get("user_id") == user_id:
+                        stats["vm_count"] += 1
+                        if vm.get("status") == "running":
+                            stats["active_vm_count"] += 1
                 
                 # Count projects
-                stats["project_count"] = len([project for project in memory_store["projects"] if project.get("user_id") == user_id])
+                stats["project_count"] = sum(1 for project in memory_store["projects"] if project.get("user_id") == user_id)
                 
-                # Calculate total spent
-                stats["total_spent"] = sum(
-                    float(record["amount"]) for record in memory_store["billing_records"]
-                    if record.get("user_id") == user_id and float(record["amount"]) > 0
-                )
+                # Calculate total spent, converting each amount once
+                amounts = (float(record["amount"]) for record in memory_store["billing_by_user"].get(user_id, []))
+                stats["total_spent"] = sum(amount for amount in amounts if amount > 0)
             
             return stats
         except Exception as e:
@@ -333,8 +328,8 @@ class UserService(BaseService):
             stats = await self._calculate_user_stats(user_id)
             
             # Add more detailed breakdowns
-            if self.db.get_client():
-                supabase = self.db.get_client()
+            supabase = self.db.get_client()
+            if supabase:
                 
                 # VM status breakdown
                 vm_statuses = {}
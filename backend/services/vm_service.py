@@ -1,11 +1,94 @@
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Callable, Awaitable
 from datetime import datetime
+from postgrest.exceptions import APIError
+import random
 from models import (
     VMCreate, VMResponse, VMStatus, InstanceType, VMImage, 
     INSTANCE_SPECS, UserResponse, APIResponse
 )
 from .base_service import BaseService, ServiceError, ValidationError, NotFoundError, InsufficientCreditsError
-import random
+from .billing_service import invalidate_usage_summary
+from auth import invalidate_cached_user
+from database import DatabaseError
+from response_cache import invalidate_vm_metadata
+
+# Unique index on the addresses of non-terminated VMs (migration 014) and the draws allowed before giving up
+ACTIVE_IP_ADDRESS_INDEX = "idx_vms_active_ip_address"
+IP_ALLOCATION_ATTEMPTS = 5
+
+# PostgreSQL unique_violation
+UNIQUE_VIOLATION = "23505"
+
+# Charge the creation fee, insert the running VM, its billing record and the billing audit entry
+# in one atomic statement. No row comes back when the user can no longer cover the fee.
+CREATE_VM_WITH_CHARGE_SQL = """
+    WITH charged AS (
+        UPDATE users SET credits = credits - $8
+        WHERE id = $6::uuid AND credits >= $8
+        RETURNING id
+    ), created AS (
+        INSERT INTO vms (id, name, instance_type, image, status, ip_address, user_id, project_id, cost_per_hour, total_cost, last_started)
+        SELECT $1::uuid, $2, $3, $4, 'running', $5::inet, charged.id, $7::uuid, $9, $8, CURRENT_TIMESTAMP
+        FROM charged
+        RETURNING *
+    ), billed AS (
+        INSERT INTO billing_records (user_id, vm_id, action_type, amount, description)
+        SELECT user_id, id, 'vm_create', $8, $10
+        FROM created
+        RETURNING id, user_id, vm_id, created_at
+    ), logged AS (
+        INSERT INTO audit_logs (id, user_id, action, resource_type, resource_id, new_values, created_at)
+        SELECT
+            $11::uuid, user_id, 'billing_transaction', 'billing_records', id,
+            jsonb_build_object('action_type', 'vm_create', 'amount', $8::float8, 'vm_id', vm_id::text),
+            created_at
+        FROM billed
+    )
+    SELECT
+        id::text AS id, name, instance_type, image, status,
+        host(ip_address) AS ip_address,
+        user_id::text AS user_id, project_id::text AS project_id,
+        cost_per_hour::float8 AS cost_per_hour,
+        uptime_hours::float8 AS uptime_hours,
+        total_cost::float8 AS total_cost,
+        created_at, updated_at, last_started, last_stopped
+    FROM created
+"""
+
+# A user's VMs in one fetch, newest first; a NULL $2 lists every project
+USER_VMS_SQL = """
+    SELECT
+        id::text AS id, name, instance_type, image, status,
+        host(ip_address) AS ip_address,
+        user_id::text AS user_id, project_id::text AS project_id,
+        cost_per_hour::float8 AS cost_per_hour,
+        uptime_hours::float8 AS uptime_hours,
+        total_cost::float8 AS total_cost,
+        created_at, updated_at, last_started, last_stopped
+    FROM vms
+    WHERE user_id = $1::uuid AND ($2::uuid IS NULL OR project_id = $2::uuid)
+    ORDER BY created_at DESC
+"""
+
+# Status that rules out each power operation, with the error reported for it
+STATE_CHANGE_CONFLICTS = {
+    "start": {
+        VMStatus.RUNNING: "VM is already running",
+        VMStatus.TERMINATED: "Cannot start a terminated VM"
+    },
+    "stop": {
+        VMStatus.STOPPED: "VM is already stopped",
+        VMStatus.TERMINATED: "Cannot stop a terminated VM"
+    },
+    "restart": {
+        VMStatus.TERMINATED: "Cannot restart a terminated VM"
+    }
+}
+
+class IPAddressConflictError(ServiceError):
+    """Another active VM already holds the address"""
+    def __init__(self, address: str):
+        super().__init__(f"IP address already in use: {address}", "IP_ADDRESS_CONFLICT", {"ip_address": address})
 
 class VMService(BaseService):
     """Virtual Machine management service"""
@@ -50,7 +133,7 @@ class VMService(BaseService):
                 "instance_type": vm_data.instance_type.value,
                 "image": vm_data.image.value,
                 "status": VMStatus.CREATING.value,
-                "ip_address": self._generate_ip_address(),
+                "ip_address": None,
                 "user_id": user.id,
                 "project_id": vm_data.project_id,
                 "cost_per_hour": cost_per_hour,
@@ -63,28 +146,42 @@ class VMService(BaseService):
                 "last_stopped": None
             }
             
-            # Create VM in database
-            created_vm = await self._create_vm_record(vm_record)
-            if not created_vm:
-                raise ServiceError("Failed to create VM", "VM_CREATION_FAILED")
-            
-            # Deduct creation cost from user credits
-            new_credits = user.credits - creation_cost
-            await self.update_user_credits(user.id, new_credits)
-            
-            # Record billing transaction
-            await self.billing_service.record_transaction(
-                user_id=user.id,
-                vm_id=created_vm["id"],
-                action_type="vm_create",
-                amount=creation_cost,
-                description=f"VM creation: {vm_data.name} ({vm_data.instance_type.value})"
-            )
-            
-            # Start VM automatically
-            await self._update_vm_status(created_vm["id"], VMStatus.RUNNING.value)
-            created_vm["status"] = VMStatus.RUNNING.value
-            created_vm["last_started"] = datetime.utcnow()
+            billing_description = f"VM creation: {vm_data.name} ({vm_data.instance_type.value})"
+            
+            if self.db.pg_enabled:
+                # Charge, insert and start in a single round-trip; the credit check is re-done atomically
+                result = await self._insert_with_ip_address(
+                    vm_record,
+                    lambda: self._create_vm_with_charge(vm_record, creation_cost, billing_description)
+                )
+                invalidate_cached_user(user.id)
+                invalidate_usage_summary(user.id)
+                if not result.rows:
+                    raise InsufficientCreditsError(creation_cost, await self.get_user_credits(user.id))
+                created_vm = result.rows[0]
+            else:
+                # Create VM in database
+                created_vm = await self._insert_with_ip_address(vm_record, lambda: self._create_vm_record(vm_record))
+                if not created_vm:
+                    raise ServiceError("Failed to create VM", "VM_CREATION_FAILED")
+                
+                # Deduct creation cost from user credits
+                new_credits = user.credits - creation_cost
+                await self.update_user_credits(user.id, new_credits)
+                
+                # Record billing transaction
+                await self.billing_service.record_transaction(
+                    user_id=user.id,
+                    vm_id=created_vm["id"],
+                    action_type="vm_create",
+                    amount=creation_cost,
+                    description=billing_description
+                )
+                
+                # Start VM automatically
+                await self._update_vm_status(created_vm["id"], VMStatus.RUNNING.value)
+                created_vm["status"] = VMStatus.RUNNING.value
+                created_vm["last_started"] = datetime.utcnow()
             
             # Log audit event
             await self.log_audit_event(
@@ -137,24 +234,26 @@ class VMService(BaseService):
             self.logger.error(f"Error getting user VMs: {e}")
             raise ServiceError("Failed to retrieve VMs", "VM_RETRIEVAL_ERROR")
     
+    async def check_state_change(self, vm_id: str, user_id: str, action: str) -> Dict[str, Any]:
+        """Validate that a start/stop/restart can be applied, without applying it"""
+        if not await self.validate_user_ownership(user_id, "vms", vm_id):
+            raise NotFoundError("VM", vm_id)
+        
+        vm_record = await self._get_vm_by_id(vm_id)
+        if not vm_record:
+            raise NotFoundError("VM", vm_id)
+        
+        conflict = STATE_CHANGE_CONFLICTS[action].get(VMStatus(vm_record["status"]))
+        if conflict:
+            raise ValidationError(conflict)
+        
+        return vm_record
+    
     async def start_vm(self, vm_id: str, user_id: str) -> APIResponse:
         """Start a stopped VM"""
         try:
-            # Validate ownership
-            if not await self.validate_user_ownership(user_id, "vms", vm_id):
-                raise NotFoundError("VM", vm_id)
-            
-            vm_record = await self._get_vm_by_id(vm_id)
-            if not vm_record:
-                raise NotFoundError("VM", vm_id)
-            
-            current_status = VMStatus(vm_record["status"])
-            
-            if current_status == VMStatus.RUNNING:
-                raise ValidationError("VM is already running")
-            
-            if current_status == VMStatus.TERMINATED:
-                raise ValidationError("Cannot start a terminated VM")
+            # Validate ownership and current status
+            vm_record = await self.check_state_change(vm_id, user_id, "start")
             
             # Update VM status and timestamps
             update_data = {
@@ -185,22 +284,10 @@ class VMService(BaseService):
     async def stop_vm(self, vm_id: str, user_id: str) -> APIResponse:
         """Stop a running VM"""
         try:
-            # Validate ownership
-            if not await self.validate_user_ownership(user_id, "vms", vm_id):
-                raise NotFoundError("VM", vm_id)
-            
-            vm_record = await self._get_vm_by_id(vm_id)
-            if not vm_record:
-                raise NotFoundError("VM", vm_id)
-            
+            # Validate ownership and current status
+            vm_record = await self.check_state_change(vm_id, user_id, "stop")
             current_status = VMStatus(vm_record["status"])
             
-            if current_status == VMStatus.STOPPED:
-                raise ValidationError("VM is already stopped")
-            
-            if current_status == VMStatus.TERMINATED:
-                raise ValidationError("Cannot stop a terminated VM")
-            
             # Calculate session cost if VM was running
             if current_status == VMStatus.RUNNING and vm_record.get("last_started"):
                 session_hours = self._calculate_session_hours(vm_record["last_started"])
@@ -261,19 +348,10 @@ class VMService(BaseService):
     async def restart_vm(self, vm_id: str, user_id: str) -> APIResponse:
         """Restart a VM (stop then start)"""
         try:
-            # Validate ownership
-            if not await self.validate_user_ownership(user_id, "vms", vm_id):
-                raise NotFoundError("VM", vm_id)
-            
-            vm_record = await self._get_vm_by_id(vm_id)
-            if not vm_record:
-                raise NotFoundError("VM", vm_id)
-            
+            # Validate ownership and current status
+            vm_record = await self.check_state_change(vm_id, user_id, "restart")
             current_status = VMStatus(vm_record["status"])
             
-            if current_status == VMStatus.TERMINATED:
-                raise ValidationError("Cannot restart a terminated VM")
-            
             # Stop the VM if it's running
             if current_status == VMStatus.RUNNING:
                 await self.stop_vm(vm_id, user_id)
@@ -402,9 +480,9 @@ class VMService(BaseService):
     async def _vm_name_exists_in_project(self, name: str, project_id: str) -> bool:
         """Check if VM name exists in project"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                result = supabase.table("vms").select("id").eq("name", name).eq("project_id", project_id).neq("status", "terminated").execute()
+            supabase = self.db.get_client()
+            if supabase:
+                result = supabase.table("vms").select("id").eq("name", name).eq("project_id", project_id).neq("status", "terminated").limit(1).execute()
                 return bool(result.data)
             else:
                 memory_store = self.db.get_memory_store()
@@ -422,17 +500,56 @@ class VMService(BaseService):
         """Generate a random IP address for simulation"""
         return f"192.168.{random.randint(1, 254)}.{random.randint(1, 254)}"
     
+    async def _insert_with_ip_address(self, vm_record: Dict[str, Any], insert: Callable[[], Awaitable[Any]]) -> Any:
+        """Run an insert with a random address, drawing again while another active VM holds it"""
+        for _ in range(IP_ALLOCATION_ATTEMPTS):
+            vm_record["ip_address"] = self._generate_ip_address()
+            try:
+                return await insert()
+            except IPAddressConflictError as e:
+                self.logger.info(e.message)
+        raise ServiceError("No free IP address found", "IP_ALLOCATION_FAILED")
+    
+    async def _create_vm_with_charge(self, vm_record: Dict[str, Any], creation_cost: float, billing_description: str):
+        """Charge the creation fee and insert the running VM on PostgreSQL"""
+        try:
+            return await self.db.execute_query(
+                CREATE_VM_WITH_CHARGE_SQL,
+                [
+                    vm_record["id"], vm_record["name"], vm_record["instance_type"], vm_record["image"],
+                    vm_record["ip_address"], vm_record["user_id"], vm_record["project_id"],
+                    creation_cost, vm_record["cost_per_hour"], billing_description, self.generate_id()
+                ],
+                fetch_mode="one"
+            )
+        except DatabaseError as e:
+            if ACTIVE_IP_ADDRESS_INDEX in str(e):
+                raise IPAddressConflictError(vm_record["ip_address"])
+            raise
+    
     async def _create_vm_record(self, vm_record: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """Create VM record in database"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                result = supabase.table("vms").insert(vm_record).execute()
+            supabase = self.db.get_client()
+            if supabase:
+                try:
+                    result = supabase.table("vms").insert(self.json_ready(vm_record)).execute()
+                except APIError as e:
+                    if e.code == UNIQUE_VIOLATION and ACTIVE_IP_ADDRESS_INDEX in (e.message or ""):
+                        raise IPAddressConflictError(vm_record["ip_address"])
+                    raise
                 return result.data[0] if result.data else None
             else:
                 memory_store = self.db.get_memory_store()
+                if any(
+                    vm.get("ip_address") == vm_record["ip_address"] and vm.get("status") != VMStatus.TERMINATED.value
+                    for vm in memory_store["vms"]
+                ):
+                    raise IPAddressConflictError(vm_record["ip_address"])
                 memory_store["vms"].append(vm_record)
                 return vm_record
+        except IPAddressConflictError:
+            raise
         except Exception as e:
             self.logger.error(f"Error creating VM record: {e}")
             return None
@@ -440,9 +557,9 @@ class VMService(BaseService):
     async def _update_vm_status(self, vm_id: str, status: str):
         """Update VM status"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                supabase.table("vms").update({"status": status, "updated_at": datetime.utcnow()}).eq("id", vm_id).execute()
+            supabase = self.db.get_client()
+            if supabase:
+                supabase.table("vms").update(self.json_ready({"status": status, "updated_at": datetime.utcnow()})).eq("id", vm_id).execute()
             else:
                 memory_store = self.db.get_memory_store()
                 for vm in memory_store["vms"]:
@@ -452,12 +569,14 @@ class VMService(BaseService):
                         break
         except Exception as e:
             self.logger.error(f"Error updating VM status: {e}")
+        finally:
+            invalidate_vm_metadata(vm_id)
     
     async def _get_vm_by_id(self, vm_id: str) -> Optional[Dict[str, Any]]:
         """Get VM by ID"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
+            supabase = self.db.get_client()
+            if supabase:
                 result = supabase.table("vms").select("*").eq("id", vm_id).execute()
                 return result.data[0] if result.data else None
             else:
@@ -473,7 +592,10 @@ class VMService(BaseService):
     async def _get_vms_by_user(self, user_id: str, project_id: Optional[str] = None) -> List[Dict[str, Any]]:
         """Get VMs by user, optionally filtered by project"""
         try:
-            if self.db.get_client():
+            if self.db.pg_enabled:
+                result = await self.db.execute_query(USER_VMS_SQL, [user_id, project_id])
+                return result.rows
+            elif self.db.get_client():
                 supabase = self.db.get_client()
                 query = supabase.table("vms").select("*").eq("user_id", user_id)
                 
@@ -500,9 +622,9 @@ class VMService(BaseService):
     async def _update_vm_record(self, vm_id: str, update_data: Dict[str, Any]) -> bool:
         """Update VM record in database"""
         try:
-            if self.db.get_client():
-                supabase = self.db.get_client()
-                result = supabase.table("vms").update(update_data).eq("id", vm_id).execute()
+            supabase = self.db.get_client()
+            if supabase:
+                result = supabase.table("vms").update(self.json_ready(update_data)).eq("id", vm_id).execute()
                 return bool(result.data)
             else:
                 memory_store = self.db.get_memory_store()
@@ -514,6 +636,9 @@ class VMService(BaseService):
         except Exception as e:
             self.logger.error(f"Error updating VM record: {e}")
             return False
+        finally:
+            # Monitoring caches status and last_started per VM
+            invalidate_vm_metadata(vm_id)
     
     def _calculate_session_hours(self, start_time) -> float:
         """Calculate hours between start time and now"""
@@ -535,28 +660,30 @@ class VMService(BaseService):
         """Build VM response from database record"""
         # Get instance specs
         instance_type = InstanceType(vm_record["instance_type"])
+        instance_specs = INSTANCE_SPECS[instance_type]
         specs = {
-            "cpu": INSTANCE_SPECS[instance_type]["cpu"],
-            "ram": INSTANCE_SPECS[instance_type]["ram"],
-            "storage": INSTANCE_SPECS[instance_type]["storage"]
+            "cpu": instance_specs["cpu"],
+            "ram": instance_specs["ram"],
+            "storage": instance_specs["storage"]
         }
         
-        return VMResponse(
+        # Database rows are trusted: coerce the few loose types here and skip model validation
+        return VMResponse.model_construct(
             id=vm_record["id"],
             name=vm_record["name"],
-            instance_type=instance_type,
-            image=VMImage(vm_record["image"]),
-            status=VMStatus(vm_record["status"]),
+            instance_type=instance_type.value,
+            image=VMImage(vm_record["image"]).value,
+            status=VMStatus(vm_record["status"]).value,
             ip_address=vm_record.get("ip_address"),
             user_id=vm_record["user_id"],
             project_id=vm_record["project_id"],
             specs=specs,
-            cost_per_hour=vm_record.get("cost_per_hour", 0.0),
-            uptime_hours=vm_record.get("uptime_hours", 0.0),
-            total_cost=vm_record.get("total_cost", 0.0),
-            current_session_hours=vm_record.get("current_session_hours", 0.0),
-            created_at=vm_record["created_at"],
-            updated_at=vm_record.get("updated_at"),
-            last_started=vm_record.get("last_started"),
-            last_stopped=vm_record.get("last_stopped")
+            cost_per_hour=float(vm_record.get("cost_per_hour") or instance_specs["cost_per_hour"]),
+            uptime_hours=float(vm_record.get("uptime_hours") or 0.0),
+            total_cost=float(vm_record.get("total_cost") or 0.0),
+            current_session_hours=float(vm_record.get("current_session_hours") or 0.0),
+            created_at=self.parse_timestamp(vm_record["created_at"]),
+            updated_at=self.parse_timestamp(vm_record.get("updated_at")),
+            last_started=self.parse_timestamp(vm_record.get("last_started")),
+            last_stopped=self.parse_timestamp(vm_record.get("last_stopped"))
         )
\ No newline at end of file
@@ -0,0 +1,109 @@
+"""
+Test billing endpoints
+"""
+
+import pytest
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock, patch
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+import auth
+from auth import create_access_token
+
+ADMIN_ID = "0192a1b0-0000-7000-8000-000000000001"
+USER_ID = "0192a1b0-0000-7000-8000-000000000002"
+
+
+@pytest.fixture
+def billing_router():
+    from routers import billing
+    return billing
+
+
+@pytest.fixture
+def billing_client(billing_router):
+    """Billing router alone, so the test does not depend on the rest of the app"""
+    app = FastAPI()
+    app.include_router(billing_router.router)
+    return TestClient(app)
+
+
+def _user_record(user_id: str, email: str, role: str):
+    return {
+        "id": user_id,
+        "email": email,
+        "name": "Test User",
+        "credits": 50.0,
+        "role": role,
+        "is_active": True,
+        "created_at": datetime.utcnow()
+    }
+
+
+def _auth_headers(email: str):
+    return {"Authorization": f"Bearer {create_access_token({'sub': email})}"}
+
+
+class TestBulkCreditBalances:
+    """Test the multi-user spending summary endpoint"""
+
+    @pytest.fixture
+    def mock_billing_service(self, billing_router):
+        service = MagicMock()
+        service.get_spending_by_users = AsyncMock(side_effect=lambda user_ids: {
+            user_id: {"user_id": user_id, "monthly_spending": 0.0} for user_id in user_ids
+        })
+        with patch.object(billing_router.service_container, 'get_billing_service', return_value=service):
+            yield service
+
+    def test_admin_can_request_other_users(self, billing_client, mock_billing_service):
+        """Test an admin's role reaches the endpoint and unlocks other users' summaries"""
+        admin = _user_record(ADMIN_ID, "admin@example.com", "admin")
+
+        with patch('auth.get_user_by_email', new_callable=AsyncMock, return_value=admin):
+            response = billing_client.get(
+                "/billing/credits/bulk",
+                params={"user_ids": [USER_ID]},
+                headers=_auth_headers(admin["email"])
+            )
+
+        assert response.status_code == 200
+        assert list(response.json()["users"]) == [USER_ID]
+        auth.invalidate_cached_user(ADMIN_ID)
+
+    def test_non_admin_cannot_request_other_users(self, billing_client, mock_billing_service):
+        """Test a regular user asking for someone else's summary is refused"""
+        user = _user_record(USER_ID, "user@example.com", "user")
+
+        with patch('auth.get_user_by_email', new_callable=AsyncMock, return_value=user):
+            response = billing_client.get(
+                "/billing/credits/bulk",
+                params={"user_ids": [ADMIN_ID]},
+                headers=_auth_headers(user["email"])
+            )
+
+        assert response.status_code == 403
+        mock_billing_service.get_spending_by_users.assert_not_awaited()
+        auth.invalidate_cached_user(USER_ID)
+
+    def test_user_ids_normalised_and_validated(self, billing_client, mock_billing_service):
+        """Test upper-case IDs are matched in canonical form and malformed IDs are rejected up front"""
+        user = _user_record(USER_ID, "user@example.com", "user")
+
+        with patch('auth.get_user_by_email', new_callable=AsyncMock, return_value=user):
+            response = billing_client.get(
+                "/billing/credits/bulk",
+                params={"user_ids": [USER_ID.upper()]},
+                headers=_auth_headers(user["email"])
+            )
+            invalid = billing_client.get(
+                "/billing/credits/bulk",
+                params={"user_ids": ["not-a-uuid"]},
+                headers=_auth_headers(user["email"])
+            )
+
+        assert response.status_code == 200
+        assert list(response.json()["users"]) == [USER_ID]
+        assert invalid.status_code == 422
+        mock_billing_service.get_spending_by_users.assert_awaited_once()
+        auth.invalidate_cached_user(USER_ID)
@@ -1,6 +1,7 @@
+import asyncio
 import pytest
 from unittest.mock import AsyncMock, MagicMock, patch
-from datetime import datetime
+from datetime import datetime, timedelta
 from services.auth_service import AuthService
 from services.vm_service import VMService
 from services.project_service import ProjectService
@@ -10,7 +11,7 @@ from services.user_service import UserService
 from services.base_service import ServiceError, ValidationError, NotFoundError, InsufficientCreditsError
 from models import (
     UserSignup, UserLogin, UserUpdate, VMCreate, ProjectCreate, 
-    InstanceType, VMImage, VMStatus, BillingActionType, VMMetricsCreate
+    InstanceType, VMImage, VMStatus, BillingActionType, VMMetricsCreate, UserResponse, BillingRecord, VMMetrics
 )
 
 class TestAuthService:
@@ -48,8 +49,7 @@ class TestAuthService:
             password="password123"
         )
         
-        with patch.object(auth_service, '_user_exists', return_value=False), \
-             patch.object(auth_service, '_create_user', return_value=mock_user_data), \
+        with patch.object(auth_service, '_create_user', return_value=mock_user_data), \
              patch.object(auth_service, 'log_audit_event', new_callable=AsyncMock), \
              patch('services.auth_service.get_password_hash', return_value="hashed_password"), \
              patch('services.auth_service.create_access_token', return_value="test_token"):
@@ -61,20 +61,59 @@ class TestAuthService:
             assert result.user.name == "Test User"
     
     @pytest.mark.asyncio
-    async def test_signup_user_exists(self, auth_service):
+    async def test_signup_user_exists(self, auth_service, mock_user_data):
         """Test signup with existing user"""
         signup_data = UserSignup(
             email="test@example.com",
             name="Test User",
             password="password123"
         )
+        memory_store = {"users": {"test@example.com": mock_user_data}, "users_by_id": {}}
         
-        with patch.object(auth_service, '_user_exists', return_value=True):
+        with patch.object(auth_service.db, 'get_client', return_value=None), \
+             patch.object(auth_service.db, 'get_memory_store', return_value=memory_store), \
+             patch('services.auth_service.get_password_hash', return_value="hashed_password"):
             with pytest.raises(ValidationError) as exc_info:
                 await auth_service.signup(signup_data)
             
             assert "Email already registered" in str(exc_info.value)
     
+    @pytest.mark.asyncio
+    async def test_signup_duplicate_email_rejected_by_insert(self, auth_service, mock_user_data):
+        """Test a duplicate email is detected from the insert's unique violation"""
+        from postgrest.exceptions import APIError
+        signup_data = UserSignup(
+            email="test@example.com",
+            name="Test User",
+            password="password123"
+        )
+        mock_client = MagicMock()
+        mock_client.table.return_value.insert.return_value.execute.side_effect = APIError({
+            "code": "23505",
+            "message": "duplicate key value violates unique constraint \"users_email_key\""
+        })
+        
+        with patch.object(auth_service.db, 'get_client', return_value=mock_client), \
+             patch('services.auth_service.get_password_hash', return_value="hashed_password"):
+            with pytest.raises(ValidationError) as exc_info:
+                await auth_service.signup(signup_data)
+        
+        assert "Email already registered" in str(exc_info.value)
+        mock_client.table.return_value.select.assert_not_called()
+    
+    @pytest.mark.asyncio
+    async def test_update_profile_unchanged_name_skips_write(self, auth_service, mock_user_data):
+        """Test an update that changes nothing neither writes nor audits"""
+        with patch.object(auth_service, '_get_user_by_id', return_value=mock_user_data), \
+             patch.object(auth_service, '_update_user', new_callable=AsyncMock) as mock_update, \
+             patch.object(auth_service, 'log_audit_event', new_callable=AsyncMock) as mock_audit:
+            
+            result = await auth_service.update_user_profile(mock_user_data["id"], UserUpdate(name=mock_user_data["name"]))
+        
+        assert result.name == mock_user_data["name"]
+        mock_update.assert_not_awaited()
+        mock_audit.assert_not_awaited()
+    
     @pytest.mark.asyncio
     async def test_login_success(self, auth_service, mock_user_data):
         """Test successful user login"""
@@ -96,6 +135,55 @@ class TestAuthService:
             assert result.access_token == "test_token"
             assert result.user.email == "test@example.com"
     
+    @pytest.mark.asyncio
+    async def test_login_does_not_wait_for_last_login_update(self, auth_service, mock_user_data):
+        """Test the last login write runs after the token is returned"""
+        login_data = UserLogin(
+            email="test@example.com",
+            password="password123"
+        )
+        release = asyncio.Event()
+        
+        async def slow_update(user_id, now=None):
+            await release.wait()
+        
+        with patch.object(auth_service, '_get_user_by_email', return_value=mock_user_data), \
+             patch.object(auth_service, '_update_last_login', side_effect=slow_update), \
+             patch.object(auth_service, 'log_audit_event', new_callable=AsyncMock), \
+             patch('services.auth_service.check_rate_limit', return_value=True), \
+             patch('services.auth_service.verify_password', return_value=True), \
+             patch('services.auth_service.clear_failed_login'), \
+             patch('services.auth_service.create_access_token', return_value="test_token"):
+            
+            result = await asyncio.wait_for(auth_service.login(login_data), timeout=1)
+            release.set()
+            await asyncio.sleep(0)
+        
+        assert result.access_token == "test_token"
+    
+    @pytest.mark.asyncio
+    async def test_login_upgrades_bcrypt_hash(self, auth_service, mock_user_data):
+        """Test a legacy bcrypt hash is replaced with Argon2id on login"""
+        login_data = UserLogin(
+            email="test@example.com",
+            password="password123"
+        )
+        legacy_user = {**mock_user_data, "hashed_password": "$2b$12$" + "a" * 53}
+        
+        with patch.object(auth_service, '_get_user_by_email', return_value=legacy_user), \
+             patch.object(auth_service, '_update_user', new_callable=AsyncMock) as mock_update, \
+             patch.object(auth_service, '_update_last_login', new_callable=AsyncMock), \
+             patch.object(auth_service, 'log_audit_event', new_callable=AsyncMock), \
+             patch('services.auth_service.check_rate_limit', return_value=True), \
+             patch('services.auth_service.verify_password', return_value=True), \
+             patch('services.auth_service.clear_failed_login'), \
+             patch('services.auth_service.create_access_token', return_value="test_token"):
+            
+            await auth_service.login(login_data)
+        
+        mock_update.assert_awaited_once()
+        assert mock_update.await_args.args[1]["hashed_password"].startswith("$argon2id$")
+    
     @pytest.mark.asyncio
     async def test_login_invalid_credentials(self, auth_service):
         """Test login with invalid credentials"""
@@ -112,6 +200,140 @@ class TestAuthService:
                 await auth_service.login(login_data)
             
             assert "Invalid email or password" in str(exc_info.value)
+    
+    @pytest.mark.asyncio
+    async def test_login_unknown_email_still_hashes(self, auth_service):
+        """Test an unknown email runs a dummy password check before failing"""
+        login_data = UserLogin(
+            email="missing@example.com",
+            password="password123"
+        )
+        
+        with patch.object(auth_service, '_get_user_by_email', return_value=None), \
+             patch('services.auth_service.check_rate_limit', return_value=True), \
+             patch('services.auth_service.record_failed_login'), \
+             patch('auth.pwd_context.dummy_verify') as mock_dummy_verify:
+            
+            with pytest.raises(ValidationError):
+                await auth_service.login(login_data)
+        
+        mock_dummy_verify.assert_called_once()
+    
+    def test_generate_id_time_ordered(self, auth_service):
+        """Test generated IDs are unique version 7 UUIDs that sort by creation time"""
+        import time
+        import uuid
+        earlier = auth_service.generate_id()
+        time.sleep(0.002)
+        ids = [auth_service.generate_id() for _ in range(500)]
+        
+        assert uuid.UUID(earlier).version == 7
+        assert len(set(ids)) == 500
+        assert all(earlier < later for later in ids)
+    
+    @pytest.mark.asyncio
+    async def test_user_lookup_by_email_cached(self, auth_service, mock_user_data):
+        """Test repeated email lookups hit Supabase once until the user changes"""
+        import auth
+        mock_client = MagicMock()
+        mock_client.table.return_value.select.return_value.eq.return_value.execute.return_value = MagicMock(data=[mock_user_data])
+        auth._user_record_cache.clear()
+        
+        with patch.object(auth_service.db, 'get_client', return_value=mock_client):
+            first = await auth_service._get_user_by_email("test@example.com")
+            second = await auth_service._get_user_by_email("test@example.com")
+            assert mock_client.table.return_value.select.call_count == 1
+            
+            auth.invalidate_cached_user(mock_user_data["id"])
+            await auth_service._get_user_by_email("test@example.com")
+            assert mock_client.table.return_value.select.call_count == 2
+        
+        assert first == second == mock_user_data
+        auth._user_record_cache.clear()
+    
+    @pytest.mark.asyncio
+    async def test_last_login_update_keeps_cached_user(self, auth_service, mock_user_data):
+        """Test recording a login refreshes the cached user row instead of evicting it"""
+        import auth
+        mock_client = MagicMock()
+        updated = {**mock_user_data, "last_login": "2024-01-01T12:00:00"}
+        mock_client.table.return_value.update.return_value.eq.return_value.execute.return_value = MagicMock(data=[updated])
+        
+        with patch.object(auth_service.db, 'get_client', return_value=mock_client), \
+             patch('services.auth_service.invalidate_cached_user') as mock_invalidate:
+            await auth_service._update_last_login(mock_user_data["id"], datetime(2024, 1, 1, 12, 0))
+        
+        mock_invalidate.assert_not_called()
+        assert auth.get_cached_user_record(mock_user_data["email"]) == updated
+        auth.invalidate_cached_user(mock_user_data["id"])
+    
+    @pytest.mark.asyncio
+    async def test_audit_events_written_in_batches(self, auth_service):
+        """Test queued audit events reach Supabase as one insert"""
+        from services import base_service
+        mock_client = MagicMock()
+        
+        with patch.object(auth_service.db, 'get_client', return_value=mock_client):
+            base_service.start_audit_log_writer(interval=0.05)
+            for i in range(3):
+                await auth_service.log_audit_event(
+                    user_id="test-user-id",
+                    action="user_login",
+                    resource_type="users",
+                    resource_id=f"event-{i}"
+                )
+            await asyncio.sleep(0.1)
+            await base_service.stop_audit_log_writer()
+        
+        mock_client.table.return_value.insert.assert_called_once()
+        batch = mock_client.table.return_value.insert.call_args.args[0]
+        assert [record["resource_id"] for record in batch] == ["event-0", "event-1", "event-2"]
+    
+    @pytest.mark.asyncio
+    async def test_audit_details_made_json_safe(self, auth_service):
+        """Test audit details holding datetimes are converted before insert"""
+        import json
+        mock_client = MagicMock()
+        
+        with patch.object(auth_service.db, 'get_client', return_value=mock_client):
+            await auth_service.log_audit_event(
+                user_id="test-user-id",
+                action="profile_update",
+                resource_type="users",
+                details={"name": "New Name", "updated_at": datetime(2024, 1, 1, 12, 0)}
+            )
+        
+        record = mock_client.table.return_value.insert.call_args.args[0]
+        assert record["details"] == {"name": "New Name", "updated_at": "2024-01-01T12:00:00"}
+        json.dumps(record)
+    
+    @pytest.mark.asyncio
+    async def test_current_user_cached_per_token(self, mock_user_data):
+        """Test the resolved user is cached by token until the user's record changes"""
+        import auth
+        from fastapi import HTTPException
+        from fastapi.security import HTTPAuthorizationCredentials
+        from models import TokenData
+        credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials="cached-token")
+        
+        with patch('auth.verify_token', return_value=TokenData(email="test@example.com")), \
+             patch('auth.get_user_by_email', new_callable=AsyncMock, return_value=mock_user_data) as mock_lookup:
+            
+            first = await auth.get_current_user(credentials)
+            second = await auth.get_current_user(credentials)
+            assert second is first
+            assert mock_lookup.await_count == 1
+            
+            auth.invalidate_cached_user("test-user-id")
+            await auth.get_current_user(credentials)
+            assert mock_lookup.await_count == 2
+        
+        with patch('auth.verify_token', return_value=None):
+            with pytest.raises(HTTPException) as exc_info:
+                await auth.get_current_user(credentials)
+        
+        assert exc_info.value.status_code == 401
+        auth.invalidate_cached_token("cached-token")
 
 class TestVMService:
     """Test cases for VMService"""
@@ -172,6 +394,76 @@ class TestVMService:
             assert result.instance_type == InstanceType.SMALL
             assert result.status == VMStatus.RUNNING
     
+    @pytest.mark.asyncio
+    async def test_create_vm_single_statement_on_postgres(self, vm_service, mock_user, mock_vm_data):
+        """Test VM creation charges, inserts and bills in one query on the PostgreSQL path"""
+        from services import billing_service as billing_module
+        billing_module._usage_summary_cache["test-user-id"] = {30: MagicMock()}
+        created_row = {
+            "id": "test-vm-id",
+            "name": "test-vm",
+            "instance_type": "small",
+            "image": "ubuntu-22.04",
+            "status": "running",
+            "ip_address": "192.168.1.10",
+            "user_id": "test-user-id",
+            "project_id": "test-project-id",
+            "cost_per_hour": 0.05,
+            "uptime_hours": 0.0,
+            "total_cost": 0.05,
+            "created_at": datetime.utcnow()
+        }
+        
+        with patch.object(type(vm_service.db), 'pg_enabled', new=True), \
+             patch.object(vm_service.db, 'execute_query', new_callable=AsyncMock) as mock_query, \
+             patch.object(vm_service, 'validate_user_ownership', return_value=True), \
+             patch.object(vm_service, '_vm_name_exists_in_project', return_value=False), \
+             patch.object(vm_service, 'update_user_credits', new_callable=AsyncMock) as mock_update_credits, \
+             patch.object(vm_service, 'log_audit_event', new_callable=AsyncMock):
+            
+            mock_query.return_value = MagicMock(rows=[created_row])
+            result = await vm_service.create_vm(mock_vm_data, mock_user)
+            
+            mock_query.return_value = MagicMock(rows=[])
+            with patch.object(vm_service, 'get_user_credits', return_value=0.01):
+                with pytest.raises(InsufficientCreditsError):
+                    await vm_service.create_vm(mock_vm_data, mock_user)
+        
+        assert result.status == VMStatus.RUNNING
+        assert mock_query.await_count == 2
+        assert "INSERT INTO audit_logs" in mock_query.await_args.args[0]
+        assert "test-user-id" not in billing_module._usage_summary_cache
+        mock_update_credits.assert_not_awaited()
+    
+    @pytest.mark.asyncio
+    async def test_get_user_vms_single_fetch_on_postgres(self, vm_service):
+        """Test listing VMs reads every row in one query on the PostgreSQL path"""
+        rows = [
+            {
+                "id": f"vm-{i}",
+                "name": f"vm-{i}",
+                "instance_type": "small",
+                "image": "ubuntu-22.04",
+                "status": "running",
+                "ip_address": f"192.168.1.{10 + i}",
+                "user_id": "test-user-id",
+                "project_id": "test-project-id",
+                "cost_per_hour": 0.05,
+                "uptime_hours": 0.0,
+                "total_cost": 0.05,
+                "created_at": datetime.utcnow()
+            }
+            for i in range(3)
+        ]
+        
+        with patch.object(type(vm_service.db), 'pg_enabled', new=True), \
+             patch.object(vm_service.db, 'execute_query', new_callable=AsyncMock, return_value=MagicMock(rows=rows)) as mock_query:
+            result = await vm_service.get_user_vms("test-user-id")
+        
+        assert [vm.id for vm in result] == ["vm-0", "vm-1", "vm-2"]
+        mock_query.assert_awaited_once()
+        assert mock_query.await_args.args[1] == ["test-user-id", None]
+    
     @pytest.mark.asyncio
     async def test_create_vm_insufficient_credits(self, vm_service, mock_vm_data):
         """Test VM creation with insufficient credits"""
@@ -189,6 +481,51 @@ class TestVMService:
             
             with pytest.raises(InsufficientCreditsError):
                 await vm_service.create_vm(mock_vm_data, poor_user)
+    
+    @pytest.mark.asyncio
+    async def test_create_vm_redraws_ip_address_on_conflict(self, vm_service):
+        """Test an address held by another active VM is rejected by the insert and a new one drawn"""
+        from services.vm_service import IPAddressConflictError
+        vm_record = {"id": "test-vm-id", "ip_address": None}
+        insert = AsyncMock(side_effect=[IPAddressConflictError("192.168.1.10"), vm_record])
+        
+        with patch.object(vm_service, '_generate_ip_address', side_effect=["192.168.1.10", "192.168.1.11"]):
+            result = await vm_service._insert_with_ip_address(vm_record, insert)
+        
+        assert result["ip_address"] == "192.168.1.11"
+        assert insert.await_count == 2
+    
+    @pytest.mark.asyncio
+    async def test_vm_update_drops_cached_metadata(self, vm_service):
+        """Test a VM write drops the metadata cached for the monitoring endpoints"""
+        from response_cache import vm_metadata_cache
+        vm_metadata_cache["test-vm-id"] = {"id": "test-vm-id", "status": "running"}
+        
+        with patch.object(vm_service.db, 'get_client', return_value=MagicMock()):
+            await vm_service._update_vm_record("test-vm-id", {"status": "stopped"})
+        
+        assert "test-vm-id" not in vm_metadata_cache
+    
+    @pytest.mark.asyncio
+    async def test_check_state_change(self, vm_service):
+        """Test power operations are rejected up front for conflicting statuses"""
+        vm_record = {"id": "test-vm-id", "name": "test-vm", "status": "stopped"}
+        
+        with patch.object(vm_service, 'validate_user_ownership', return_value=True), \
+             patch.object(vm_service, '_get_vm_by_id', return_value=vm_record):
+            
+            assert await vm_service.check_state_change("test-vm-id", "test-user-id", "start") == vm_record
+            assert await vm_service.check_state_change("test-vm-id", "test-user-id", "restart") == vm_record
+            
+            with pytest.raises(ValidationError) as exc_info:
+                await vm_service.check_state_change("test-vm-id", "test-user-id", "stop")
+            
+            assert "already stopped" in str(exc_info.value)
+        
+        with patch.object(vm_service, 'validate_user_ownership', return_value=False):
+            
+            with pytest.raises(NotFoundError):
+                await vm_service.check_state_change("test-vm-id", "other-user-id", "start")
 
 class TestProjectService:
     """Test cases for ProjectService"""
@@ -238,6 +575,66 @@ class TestProjectService:
                 await project_service.create_project(mock_project_data, "test-user-id")
             
             assert "already exists" in str(exc_info.value)
+    
+    @pytest.mark.asyncio
+    async def test_get_project_with_vms_single_fetch(self, project_service):
+        """Test project detail loads the project and its VMs without per-VM lookups"""
+        now = datetime.utcnow()
+        project_record = {
+            "id": "test-project-id",
+            "name": "test-project",
+            "description": "",
+            "user_id": "test-user-id",
+            "created_at": now,
+            "updated_at": None
+        }
+        vm_records = [
+            {"id": f"test-vm-{status}", "name": status, "instance_type": "small", "image": "ubuntu-22.04",
+             "status": status, "user_id": "test-user-id", "project_id": "test-project-id",
+             "total_cost": 1.5, "created_at": now}
+            for status in ("running", "stopped")
+        ]
+        
+        with patch.object(project_service, '_get_project_with_vms', return_value=(project_record, vm_records)) as mock_fetch, \
+             patch.object(project_service, 'validate_user_ownership', new_callable=AsyncMock) as mock_ownership, \
+             patch.object(project_service, '_calculate_project_stats', new_callable=AsyncMock) as mock_stats:
+            
+            result = await project_service.get_project("test-project-id", "test-user-id", include_vms=True)
+        
+        mock_fetch.assert_awaited_once_with("test-project-id", "test-user-id")
+        mock_ownership.assert_not_awaited()
+        mock_stats.assert_not_awaited()
+        assert [vm.id for vm in result.vms] == ["test-vm-running", "test-vm-stopped"]
+        assert result.vm_count == 2
+        assert result.active_vm_count == 1
+        assert result.total_cost == 3.0
+    
+    @pytest.mark.asyncio
+    async def test_get_user_projects_batches_stats(self, project_service):
+        """Test project listing computes VM statistics for all projects in one pass"""
+        now = datetime.utcnow()
+        memory_store = {
+            "projects": [
+                {"id": f"test-project-{i}", "name": f"project-{i}", "description": "", "user_id": "test-user-id",
+                 "created_at": now - timedelta(minutes=i), "updated_at": None}
+                for i in range(2)
+            ],
+            "vms": [
+                {"id": "test-vm-a", "project_id": "test-project-0", "status": "running", "total_cost": 2.0},
+                {"id": "test-vm-b", "project_id": "test-project-0", "status": "stopped", "total_cost": 1.0},
+                {"id": "test-vm-c", "project_id": "other-project", "status": "running", "total_cost": 5.0}
+            ]
+        }
+        
+        with patch.object(type(project_service.db), 'pg_enabled', new=False), \
+             patch.object(project_service.db, 'get_client', return_value=None), \
+             patch.object(project_service.db, 'get_memory_store', return_value=memory_store), \
+             patch.object(project_service, '_calculate_projects_stats', wraps=project_service._calculate_projects_stats) as mock_stats:
+            
+            projects = await project_service.get_user_projects("test-user-id")
+        
+        mock_stats.assert_awaited_once_with(["test-project-0", "test-project-1"])
+        assert [(p.vm_count, p.active_vm_count, p.total_cost) for p in projects] == [(2, 1, 3.0), (0, 0, 0.0)]
 
 class TestBillingService:
     """Test cases for BillingService"""
@@ -274,19 +671,398 @@ class TestBillingService:
             assert result.amount == 0.05
             assert result.action_type == "vm_create"
     
+    @pytest.mark.asyncio
+    async def test_record_transaction_writes_audit_in_same_call(self, billing_service):
+        """Test the billing record and its audit event go out in one rpc call"""
+        mock_client = MagicMock()
+        mock_client.rpc.return_value.execute.return_value = MagicMock(data=[{
+            "id": "test-billing-id",
+            "user_id": "test-user-id",
+            "vm_id": None,
+            "action_type": "vm_create",
+            "amount": 0.05,
+            "description": "VM creation cost",
+            "created_at": datetime.utcnow().isoformat()
+        }])
+        
+        with patch.object(type(billing_service.db), 'pg_enabled', new=False), \
+             patch.object(billing_service.db, 'get_client', return_value=mock_client), \
+             patch.object(billing_service, 'log_audit_event', new_callable=AsyncMock) as mock_audit:
+            result = await billing_service.record_transaction("test-user-id", "vm_create", 0.05, "VM creation cost")
+        
+        name, params = mock_client.rpc.call_args[0]
+        assert name == "record_billing_with_audit"
+        assert isinstance(params["payload"]["created_at"], str)
+        assert params["audit"]["details"] == {"action_type": "vm_create", "amount": 0.05, "vm_id": None}
+        mock_client.table.assert_not_called()
+        mock_audit.assert_not_called()
+        assert result.id == "test-billing-id"
+    
+    @pytest.mark.asyncio
+    async def test_billing_insert_payload_is_json_ready(self, billing_service):
+        """Test datetimes are serialised before the record reaches Supabase"""
+        created_at = datetime(2024, 1, 2, 3, 4, 5)
+        mock_client = MagicMock()
+        mock_client.table.return_value.insert.return_value.execute.return_value = MagicMock(data=[{"id": "test-billing-id"}])
+        
+        with patch.object(billing_service.db, 'get_client', return_value=mock_client):
+            await billing_service._create_billing_record({"id": "test-billing-id", "created_at": created_at})
+        
+        payload = mock_client.table.return_value.insert.call_args[0][0]
+        assert payload == {"id": "test-billing-id", "created_at": "2024-01-02T03:04:05"}
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_transactions_share_one_insert(self, billing_service):
+        """Test concurrent billing writes are coalesced into one Supabase call"""
+        from services import billing_service as billing_module
+        mock_client = MagicMock()
+        
+        def rpc(name, params):
+            call = MagicMock()
+            call.execute.return_value = MagicMock(data=params["payloads"])
+            return call
+        mock_client.rpc.side_effect = rpc
+        
+        with patch.object(type(billing_service.db), 'pg_enabled', new=False), \
+             patch.object(billing_service.db, 'get_client', return_value=mock_client):
+            billing_module.start_billing_record_writer(interval=0.05)
+            results = await asyncio.gather(*(
+                billing_service.record_transaction("test-user-id", "vm_running", 0.01 * (i + 1), f"Charge {i}")
+                for i in range(3)
+            ))
+            await billing_module.stop_billing_record_writer()
+        
+        mock_client.rpc.assert_called_once()
+        name, params = mock_client.rpc.call_args.args
+        assert name == "record_billing_batch_with_audit"
+        assert [audit["resource_id"] for audit in params["audits"]] == [record.id for record in results]
+        assert [record.description for record in results] == ["Charge 0", "Charge 1", "Charge 2"]
+    
+    @pytest.mark.asyncio
+    async def test_failed_billing_batch_retries_records_individually(self, billing_service):
+        """Test one bad record in a batch only fails its own transaction"""
+        from services import billing_service as billing_module
+        mock_client = MagicMock()
+        
+        def rpc(name, params):
+            call = MagicMock()
+            if any(payload["description"] == "Bad charge" for payload in params["payloads"]):
+                call.execute.side_effect = Exception("violates foreign key constraint")
+            else:
+                call.execute.return_value = MagicMock(data=params["payloads"])
+            return call
+        mock_client.rpc.side_effect = rpc
+        
+        with patch.object(type(billing_service.db), 'pg_enabled', new=False), \
+             patch.object(billing_service.db, 'get_client', return_value=mock_client):
+            billing_module.start_billing_record_writer(interval=0.05)
+            results = await asyncio.gather(*(
+                billing_service.record_transaction("test-user-id", "vm_running", 0.01, description)
+                for description in ["Charge 0", "Bad charge", "Charge 2"]
+            ), return_exceptions=True)
+            await billing_module.stop_billing_record_writer()
+        
+        assert mock_client.rpc.call_count == 4
+        assert results[0].description == "Charge 0"
+        assert isinstance(results[1], ServiceError)
+        assert results[1].error_code == "BILLING_RECORD_FAILED"
+        assert results[2].description == "Charge 2"
+    
     @pytest.mark.asyncio
     async def test_add_credits_success(self, billing_service):
         """Test successful credit addition"""
-        with patch.object(billing_service, 'get_user_credits', return_value=50.0), \
-             patch.object(billing_service, 'update_user_credits', return_value=True), \
-             patch.object(billing_service, 'record_transaction', new_callable=AsyncMock) as mock_record:
+        mock_client = MagicMock()
+        mock_client.rpc.return_value.execute.return_value = MagicMock(data=[{
+            "id": "test-billing-id",
+            "user_id": "test-user-id",
+            "vm_id": None,
+            "action_type": BillingActionType.CREDIT_ADD.value,
+            "amount": 25.0,
+            "description": "Credit addition",
+            "created_at": datetime.utcnow().isoformat(),
+            "credits": 75.0
+        }])
+        
+        with patch.object(type(billing_service.db), 'pg_enabled', new=False), \
+             patch.object(billing_service.db, 'get_client', return_value=mock_client), \
+             patch.object(billing_service, 'log_audit_event', new_callable=AsyncMock):
             
-            await billing_service.add_credits("test-user-id", 25.0, "Credit addition")
+            result = await billing_service.add_credits("test-user-id", 25.0, "Credit addition")
+            
+            mock_client.rpc.assert_called_once()
+            name, params = mock_client.rpc.call_args[0]
+            assert name == "apply_credit_delta"
+            assert params["p_delta"] == 25.0
+            assert params["p_action_type"] == BillingActionType.CREDIT_ADD.value
+            mock_client.table.assert_not_called()
+            assert result.amount == 25.0
+    
+    @pytest.mark.asyncio
+    async def test_concurrent_deductions_cannot_overdraw(self, billing_service):
+        """Test concurrent deductions are applied atomically against the balance"""
+        memory_store = {"users_by_id": {"test-user-id": {"id": "test-user-id", "credits": 10.0}}, "billing_records": [], "billing_by_user": {}}
+        
+        with patch.object(type(billing_service.db), 'pg_enabled', new=False), \
+             patch.object(billing_service.db, 'get_client', return_value=None), \
+             patch.object(billing_service.db, 'get_memory_store', return_value=memory_store), \
+             patch.object(billing_service, 'log_audit_event', new_callable=AsyncMock):
+            results = await asyncio.gather(
+                *(billing_service.deduct_credits("test-user-id", 4.0) for _ in range(3)),
+                return_exceptions=True
+            )
+        
+        assert sum(isinstance(result, BillingRecord) for result in results) == 2
+        assert sum(isinstance(result, ValidationError) for result in results) == 1
+        assert memory_store["users_by_id"]["test-user-id"]["credits"] == 2.0
+        assert [record["amount"] for record in memory_store["billing_records"]] == [-4.0, -4.0]
+        assert memory_store["billing_by_user"]["test-user-id"] == memory_store["billing_records"]
+
+    @pytest.mark.asyncio
+    async def test_health_check_probes_once_per_interval(self, billing_service):
+        """Test repeated health probes reuse a recent healthy result"""
+        mock_client = MagicMock()
+        
+        with patch.object(BillingService, '_health_status', None), \
+             patch.object(type(billing_service.db), 'pg_enabled', new=False), \
+             patch.object(billing_service.db, 'get_client', return_value=mock_client):
+            first = await billing_service.health_check()
+            second = await BillingService().health_check()
+        
+        assert first["status"] == "healthy"
+        assert second == first
+        mock_client.table.assert_called_once_with("billing_records")
+        mock_client.table.return_value.select.assert_called_once_with("id")
+    
+    @pytest.mark.asyncio
+    async def test_get_last_transaction_id(self, billing_service):
+        """Test last transaction lookup used for billing ETags"""
+        mock_records = [{"id": "latest-billing-id", "user_id": "test-user-id"}]
+
+        with patch.object(billing_service.db, 'get_client', return_value=None), \
+             patch.object(billing_service, '_get_billing_records_by_user', return_value=mock_records):
+
+            assert await billing_service.get_last_transaction_id("test-user-id") == "latest-billing-id"
+
+        with patch.object(billing_service.db, 'get_client', return_value=None), \
+             patch.object(billing_service, '_get_billing_records_by_user', return_value=[]):
+
+            assert await billing_service.get_last_transaction_id("test-user-id") is None
+    
+    @pytest.mark.asyncio
+    async def test_get_spending_by_users(self, billing_service):
+        """Test batched spending windows for several users"""
+        now = datetime.utcnow()
+        memory_store = {
+            "billing_records": [
+                {"user_id": "user-a", "amount": 2.0, "created_at": now - timedelta(hours=2)},
+                {"user_id": "user-a", "amount": 1.0, "created_at": now - timedelta(days=10)},
+                {"user_id": "user-a", "amount": -5.0, "created_at": now - timedelta(hours=1)},
+                {"user_id": "user-c", "amount": 9.0, "created_at": now}
+            ]
+        }
+        memory_store["billing_by_user"] = {}
+        for record in memory_store["billing_records"]:
+            memory_store["billing_by_user"].setdefault(record["user_id"], []).append(record)
+        
+        with patch.object(type(billing_service.db), 'pg_enabled', new=False), \
+             patch.object(billing_service.db, 'get_client', return_value=None), \
+             patch.object(billing_service.db, 'get_memory_store', return_value=memory_store):
             
-            mock_record.assert_called_once()
-            args = mock_record.call_args[1]
-            assert args['amount'] == 25.0
-            assert args['action_type'] == BillingActionType.CREDIT_ADD.value
+            summaries = await billing_service.get_spending_by_users(["user-a", "user-b"], now)
+        
+        assert set(summaries) == {"user-a", "user-b"}
+        assert summaries["user-a"]["monthly_spending"] == 3.0
+        assert summaries["user-a"]["weekly_spending"] == 2.0
+        assert summaries["user-a"]["daily_spending"] == 2.0
+        assert summaries["user-a"]["credit_history_count"] == 3
+        assert summaries["user-b"]["credit_history_count"] == 0
+        assert summaries["user-b"]["last_transaction"] is None
+    
+    @pytest.mark.asyncio
+    async def test_billing_history_uses_per_user_index(self, billing_service):
+        """Test in-memory billing history reads only the user's ordered records"""
+        now = datetime.utcnow()
+        memory_store = {"billing_records": [], "billing_by_user": {}}
+        for hours, user_id in [(3, "user-a"), (1, "user-b"), (1, "user-a"), (2, "user-a")]:
+            billing_service._add_memory_billing_record(memory_store, {
+                "id": f"{user_id}-{hours}",
+                "user_id": user_id,
+                "amount": 1.0,
+                "created_at": now - timedelta(hours=hours)
+            })
+        
+        with patch.object(billing_service.db, 'get_client', return_value=None), \
+             patch.object(billing_service.db, 'get_memory_store', return_value=memory_store):
+            records = await billing_service._get_billing_records_by_user("user-a", limit=2)
+        
+        assert [record["id"] for record in records] == ["user-a-1", "user-a-2"]
+        assert len(memory_store["billing_records"]) == 4
+    
+    @pytest.mark.asyncio
+    async def test_iter_billing_history_pages_through_records(self, billing_service):
+        """Test streamed billing history walks every page newest first"""
+        now = datetime.utcnow()
+        memory_store = {"billing_records": [], "billing_by_user": {}}
+        for hours in range(5):
+            billing_service._add_memory_billing_record(memory_store, {
+                "id": f"bill-{hours}",
+                "user_id": "test-user-id",
+                "action_type": "vm_running",
+                "amount": 1.0,
+                "description": "VM usage",
+                "created_at": now - timedelta(hours=hours)
+            })
+        
+        with patch.object(billing_service.db, 'get_client', return_value=None), \
+             patch.object(billing_service.db, 'get_memory_store', return_value=memory_store), \
+             patch.object(billing_service, '_fetch_billing_records_by_user', wraps=billing_service._fetch_billing_records_by_user) as mock_fetch:
+            records = [record async for record in billing_service.iter_user_billing_history("test-user-id", page_size=2)]
+        
+        assert [record.id for record in records] == [f"bill-{hours}" for hours in range(5)]
+        assert mock_fetch.call_count == 3
+    
+    @pytest.mark.asyncio
+    async def test_iter_billing_history_raises_on_page_error(self, billing_service):
+        """Test a failed page ends the stream with an error instead of looking complete"""
+        pages = [[{
+            "id": "bill-0",
+            "user_id": "test-user-id",
+            "action_type": "vm_running",
+            "amount": 1.0,
+            "description": "VM usage",
+            "created_at": datetime.utcnow()
+        }], Exception("connection reset")]
+        
+        with patch.object(billing_service, '_fetch_billing_records_by_user', side_effect=pages):
+            records = []
+            with pytest.raises(Exception, match="connection reset"):
+                async for record in billing_service.iter_user_billing_history("test-user-id", page_size=1):
+                    records.append(record)
+        
+        assert [record.id for record in records] == ["bill-0"]
+    
+    @pytest.mark.asyncio
+    async def test_spending_stats_in_memory_period(self, billing_service):
+        """Test in-memory period spending only counts records inside the window"""
+        now = datetime.utcnow()
+        memory_store = {"billing_records": [], "billing_by_user": {}}
+        for days, amount in [(40, 9.0), (20, 2.0), (10, -1.0), (1, 3.0)]:
+            billing_service._add_memory_billing_record(memory_store, {
+                "user_id": "test-user-id",
+                "amount": amount,
+                "created_at": now - timedelta(days=days)
+            })
+        
+        with patch.object(type(billing_service.db), 'pg_enabled', new=False), \
+             patch.object(billing_service.db, 'get_client', return_value=None), \
+             patch.object(billing_service.db, 'get_memory_store', return_value=memory_store):
+            stats = await billing_service._calculate_spending_stats("test-user-id", now - timedelta(days=30), now)
+        
+        assert stats == {"total_spent": 5.0, "record_count": 3}
+    
+    @pytest.mark.asyncio
+    async def test_spending_stats_single_rpc(self, billing_service):
+        """Test period spending comes from one get_spending_stats call on Supabase"""
+        mock_client = MagicMock()
+        mock_client.rpc.return_value.execute.return_value = MagicMock(data=[{
+            "total_spent": "7.25",
+            "record_count": 4
+        }])
+        end_date = datetime.utcnow()
+        start_date = end_date - timedelta(days=30)
+        
+        with patch.object(type(billing_service.db), 'pg_enabled', new=False), \
+             patch.object(billing_service.db, 'get_client', return_value=mock_client):
+            stats = await billing_service._calculate_spending_stats("test-user-id", start_date, end_date)
+        
+        mock_client.rpc.assert_called_once_with("get_spending_stats", {
+            "uid": "test-user-id",
+            "start_date": start_date.isoformat(),
+            "end_date": end_date.isoformat()
+        })
+        mock_client.table.assert_not_called()
+        assert stats == {"total_spent": 7.25, "record_count": 4}
+    
+    @pytest.mark.asyncio
+    async def test_usage_summary_lookups_run_concurrently(self, billing_service):
+        """Test the usage summary starts all of its lookups before waiting on any"""
+        started = []
+        all_started = asyncio.Event()
+        
+        def lookup(name, value):
+            async def run(*args):
+                started.append(name)
+                if len(started) == 4:
+                    all_started.set()
+                await all_started.wait()
+                return value
+            return run
+        
+        with patch.object(billing_service, 'get_user_credits', side_effect=lookup("credits", 40.0)), \
+             patch.object(billing_service, '_calculate_spending_stats', side_effect=lookup("spending", {"total_spent": 5.0, "record_count": 2})), \
+             patch.object(billing_service, '_get_vm_statistics', side_effect=lookup("vms", {"total_vms": 3, "active_vms": 1})), \
+             patch.object(billing_service, '_calculate_current_hourly_cost', side_effect=lookup("hourly", 0.5)):
+            summary = await asyncio.wait_for(billing_service.get_usage_summary("test-user-id"), timeout=1)
+        
+        assert sorted(started) == ["credits", "hourly", "spending", "vms"]
+        assert summary.current_credits == 40.0
+        assert summary.total_spent == 5.0
+        assert summary.billing_records_count == 2
+        assert summary.total_vms == 3
+        assert summary.active_vms == 1
+        assert summary.projected_monthly_cost == 0.5 * 24 * 30
+    
+    @pytest.mark.asyncio
+    async def test_hourly_cost_summed_by_database(self, billing_service):
+        """Test the running hourly cost is one sum_running_cost call on Supabase"""
+        mock_client = MagicMock()
+        mock_client.rpc.return_value.execute.return_value = MagicMock(data=0.75)
+        
+        with patch.object(type(billing_service.db), 'pg_enabled', new=False), \
+             patch.object(billing_service.db, 'get_client', return_value=mock_client):
+            hourly_cost = await billing_service._calculate_current_hourly_cost("test-user-id")
+        
+        mock_client.rpc.assert_called_once_with("sum_running_cost", {"uid": "test-user-id"})
+        mock_client.table.assert_not_called()
+        assert hourly_cost == 0.75
+    
+    @pytest.mark.asyncio
+    async def test_usage_summary_cached_until_billing_changes(self, billing_service):
+        """Test repeated usage summaries are served from cache until a transaction lands"""
+        with patch('services.billing_service._usage_summary_cache', {}), \
+             patch.object(billing_service, 'get_user_credits', new_callable=AsyncMock, return_value=40.0) as mock_credits, \
+             patch.object(billing_service, '_calculate_spending_stats', new_callable=AsyncMock, return_value={"total_spent": 0.0, "record_count": 0}), \
+             patch.object(billing_service, '_get_vm_statistics', new_callable=AsyncMock, return_value={"total_vms": 0, "active_vms": 0}), \
+             patch.object(billing_service, '_calculate_current_hourly_cost', new_callable=AsyncMock, return_value=0.0), \
+             patch.object(billing_service, '_create_billing_record_with_audit', new_callable=AsyncMock, return_value={
+                 "id": "test-billing-id",
+                 "user_id": "test-user-id",
+                 "action_type": "vm_create",
+                 "amount": 0.05,
+                 "description": "VM creation cost"
+             }):
+            first = await billing_service.get_usage_summary("test-user-id")
+            second = await billing_service.get_usage_summary("test-user-id")
+            await billing_service.record_transaction("test-user-id", "vm_create", 0.05, "VM creation cost")
+            third = await billing_service.get_usage_summary("test-user-id")
+        
+        assert second is first
+        assert third is not first
+        assert mock_credits.await_count == 2
+    
+    @pytest.mark.asyncio
+    async def test_vm_statistics_single_rpc(self, billing_service):
+        """Test VM counts come from one vm_counts call on Supabase"""
+        mock_client = MagicMock()
+        mock_client.rpc.return_value.execute.return_value = MagicMock(data=[{"total_vms": 5, "active_vms": 2}])
+        
+        with patch.object(type(billing_service.db), 'pg_enabled', new=False), \
+             patch.object(billing_service.db, 'get_client', return_value=mock_client):
+            stats = await billing_service._get_vm_statistics("test-user-id")
+        
+        mock_client.rpc.assert_called_once_with("vm_counts", {"uid": "test-user-id"})
+        mock_client.table.assert_not_called()
+        assert stats == {"total_vms": 5, "active_vms": 2}
 
 class TestMonitoringService:
     """Test cases for MonitoringService"""
@@ -350,6 +1126,73 @@ class TestMonitoringService:
                 )
             
             assert "CPU usage must be between 0 and 100" in str(exc_info.value)
+    
+    @pytest.mark.asyncio
+    async def test_get_user_monitoring_overview_latest_metrics(self, monitoring_service):
+        """Test overview picks each running VM's latest metrics in one pass"""
+        now = datetime.utcnow()
+        memory_store = {
+            "vms": [
+                {"id": "test-vm-a", "user_id": "test-user-id", "name": "a", "instance_type": "small", "status": "running"},
+                {"id": "test-vm-b", "user_id": "test-user-id", "name": "b", "instance_type": "small", "status": "running"},
+                {"id": "test-vm-c", "user_id": "test-user-id", "name": "c", "instance_type": "small", "status": "stopped"}
+            ],
+            "vm_metrics": [
+                {"vm_id": "test-vm-a", "cpu_usage": 10.0, "memory_usage": 20.0, "disk_usage": 5.0, "recorded_at": now - timedelta(minutes=5)},
+                {"vm_id": "test-vm-a", "cpu_usage": 40.0, "memory_usage": 60.0, "disk_usage": 5.0, "recorded_at": now},
+                {"vm_id": "test-vm-c", "cpu_usage": 90.0, "memory_usage": 90.0, "disk_usage": 5.0, "recorded_at": now}
+            ]
+        }
+        
+        with patch.object(type(monitoring_service.db), 'pg_enabled', new=False), \
+             patch.object(monitoring_service.db, 'get_client', return_value=None), \
+             patch.object(monitoring_service.db, 'get_memory_store', return_value=memory_store):
+            
+            overview = await monitoring_service.get_user_monitoring_overview("test-user-id")
+        
+        assert overview["total_running_vms"] == 2
+        assert overview["monitored_vms"] == 1
+        assert overview["overall_averages"] == {"cpu_usage": 20.0, "memory_usage": 30.0}
+        summaries = {summary["vm_id"]: summary for summary in overview["vm_summaries"]}
+        assert summaries["test-vm-a"]["latest_metrics"].cpu_usage == 40.0
+        assert summaries["test-vm-b"]["status"] == "no_data"
+    
+    @pytest.mark.asyncio
+    async def test_latest_metrics_fetched_concurrently(self, monitoring_service):
+        """Test per-VM latest metrics lookups on Supabase overlap instead of running in turn"""
+        vm_ids = ["test-vm-a", "test-vm-b", "test-vm-c"]
+        started = []
+        all_started = asyncio.Event()
+        
+        async def latest(vm_id):
+            started.append(vm_id)
+            if len(started) == len(vm_ids):
+                all_started.set()
+            await all_started.wait()
+            return None if vm_id == "test-vm-b" else {"vm_id": vm_id}
+        
+        with patch.object(monitoring_service.db, 'get_client', return_value=MagicMock()), \
+             patch.object(monitoring_service, '_get_latest_metrics_by_vm', side_effect=latest):
+            latest_by_vm = await asyncio.wait_for(monitoring_service._get_latest_metrics_by_vms(vm_ids), timeout=1)
+        
+        assert latest_by_vm == {"test-vm-a": {"vm_id": "test-vm-a"}, "test-vm-c": {"vm_id": "test-vm-c"}}
+    
+    @pytest.mark.asyncio
+    async def test_vm_metrics_summary_aggregates(self, monitoring_service):
+        """Test summary averages and peaks per metric"""
+        metrics = [
+            VMMetrics(vm_id="test-vm-id", cpu_usage=cpu, memory_usage=memory, disk_usage=30.0, network_in=net, network_out=net / 2)
+            for cpu, memory, net in [(80.0, 50.0, 100.0), (60.0, 50.0, 50.0), (20.0, 50.0, 20.0), (10.0, 50.0, 10.0)]
+        ]
+        
+        with patch.object(monitoring_service, 'get_vm_metrics', new_callable=AsyncMock, return_value=metrics):
+            summary = await monitoring_service.get_vm_metrics_summary("test-vm-id", "test-user-id")
+        
+        assert summary["data_points"] == 4
+        assert summary["averages"] == {"cpu_usage": 42.5, "memory_usage": 50.0, "disk_usage": 30.0, "network_in": 45.0, "network_out": 22.5}
+        assert summary["peaks"] == {"cpu_usage": 80.0, "memory_usage": 50.0, "disk_usage": 30.0, "network_in": 100.0, "network_out": 50.0}
+        assert summary["trends"] == {"cpu_usage": "increasing", "memory_usage": "stable", "disk_usage": "stable"}
+        assert all(type(value) is float for value in summary["averages"].values())
 
 class TestUserService:
     """Test cases for UserService"""
@@ -397,6 +1240,39 @@ class TestUserService:
                 await user_service.get_user_by_id("non-existent-id")
             
             assert "User not found" in str(exc_info.value)
+    
+    def test_build_user_response_matches_validation(self, user_service, mock_user_record):
+        """Test the unvalidated user response stays in step with the UserResponse schema"""
+        supabase_row = {
+            **mock_user_record,
+            "created_at": "2024-01-01T12:00:00Z",
+            "last_login": "2024-01-02T08:30:00+00:00",
+            "credits": 50,
+            "hashed_password": "not-part-of-the-response"
+        }
+        
+        built = user_service.build_user_response(supabase_row)
+        
+        assert built.model_dump() == UserResponse.model_validate(supabase_row).model_dump()
+    
+    @pytest.mark.asyncio
+    async def test_calculate_user_stats_single_rpc(self, user_service):
+        """Test user statistics come from one get_user_stats call on Supabase"""
+        mock_client = MagicMock()
+        mock_client.rpc.return_value.execute.return_value = MagicMock(data=[{
+            "vm_count": 3,
+            "active_vm_count": 1,
+            "project_count": 2,
+            "total_spent": "12.5"
+        }])
+        
+        with patch.object(type(user_service.db), 'pg_enabled', new=False), \
+             patch.object(user_service.db, 'get_client', return_value=mock_client):
+            stats = await user_service._calculate_user_stats("test-user-id")
+        
+        mock_client.rpc.assert_called_once_with("get_user_stats", {"uid": "test-user-id"})
+        mock_client.table.assert_not_called()
+        assert stats == {"vm_count": 3, "project_count": 2, "active_vm_count": 1, "total_spent": 12.5}
 
 class TestServiceIntegration:
     """Integration tests for service interactions"""